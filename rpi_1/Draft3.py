@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import os
+import re
 import json
+import math
 import time
 import numpy as np
 import threading
@@ -11,11 +13,30 @@ from firebase_admin import db
 from flask import Flask, request, jsonify
 import tensorflow as tf
 import queue
-import cv2
 from datetime import datetime
-import uuid
 import sys
 import signal
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from threshold_rules import ThresholdRuleEngine
+from fallback_detector import create_detector
+from inference_cache import InferenceCache
+import anomaly_model
+import backends
+import metrics
+from profiler import profiler, timers
+import structured_log
+import firebase_layout
+from persistence_policy import PersistencePolicy
+from cluster import Cluster
+from image_pipeline import ImagePipeline
+from image_store import ImageStore
+from image_relay import ImageRelay
+from shared_vitals import SharedVitals, DeviceView
+from worker_pool import WorkerPool
+from traffic_capture import TrafficCapture
+from model_registry import ModelRegistry
+from inference_guard import InferenceGuard, InferenceUnavailable
 
 # Flask application for handling HTTP requests
 app = Flask(__name__)
@@ -23,7 +44,11 @@ app = Flask(__name__)
 # Global variables
 models = {}
 device_data = {}
-processing_queue = queue.Queue()  # Queue for processing tasks
+processing_queue = queue.Queue()  # Queue for processing tasks (async_server.py swaps in its own)
+outbox = None  # Batched Firebase writer used by async_server.py; None writes directly
+device_store = None  # Shared-memory vitals, in worker mode
+worker_pool = None  # Worker processes handling the devices, in worker mode
+capture = None  # Log of inbound traffic for replay.py, with --capture
 config = {
     "mqtt_broker": "localhost",
     "mqtt_port": 1883,
@@ -35,18 +60,283 @@ config = {
         "spo2_model": "models/spo2_model.eim",
         "keyword_model": "models/keyword_model.eim"
     },
+    # In-process detectors used when a .eim model is missing or fails to init
+    "model_fallbacks": {
+        "bpm_model": "ewma",
+        "spo2_model": "ewma"
+    },
+    # Deadline for each .eim classify() call, and the circuit breaker that
+    # stops calling a model after failure_threshold timeouts or errors in a
+    # row; only the threshold rules raise alerts until it lets a call
+    # through again reset_seconds later
+    "inference_deadlines": {
+        "timeout_ms": {
+            "default": 500,
+            "keyword_model": 2000
+        },
+        "failure_threshold": 3,
+        "reset_seconds": 30
+    },
+    # Replacing a .eim file (mv the new one over it) or changing its path
+    # swaps in the new model once it passes a warm-up inference on
+    # warmup_features (a feature list, or N zeros)
+    "model_reload": {
+        "enabled": True,
+        "watch_interval": 5,
+        "drain_timeout": 30,
+        "warmup_timeout": 10,
+        "warmup_features": {
+            "bpm_model": [75.0, 75.0],
+            "spo2_model": [97.0, 97.0],
+            "keyword_model": 16000
+        }
+    },
+    # LRU cache of .eim results, keyed on features quantized to `quantum`
+    "inference_cache": {
+        "max_size": 4096,
+        "quantum": 0.1
+    },
     "keywords": ["help", "ouch"],
     "http_server_port": 5000,
     "image_save_path": "images",
+    "image_variant_path": "image_variants",
+    # Max dHash bit difference to flag an upload as a near-duplicate of one of
+    # the device's recent images (None disables the check)
+    "image_near_duplicate_distance": 4,
+    # Thumbnail and web-sized variants, built by a process pool off the request thread
+    "image_pipeline": {
+        "enabled": True,
+        "workers": None,  # Defaults to one per core
+        "thumb_size": 160,
+        "web_max_side": 800,
+        "quality": 80
+    },
+    # Stream new uploads straight to the rpi_2 receiver; while it is down they
+    # are journaled and sent again once it is back. When disabled, images are
+    # linked into the outbox for ImagesTrans.py.
+    "image_outbox_path": "images/outbox",
+    "image_relay": {
+        "enabled": False,
+        "url": "http://192.168.58.37:5000/upload",
+        "workers": 2,
+        "queue_size": 64,
+        "timeout": 5.0,
+        "retry_interval": 10.0,
+        "journal_path": "images/relay_journal.jsonl"
+    },
     "audio_save_path": "audio",
     "anomaly_thresholds": {
         "bpm_high": 120,  # Define thresholds for immediate alerts
         "bpm_low": 40,
         "spo2_low": 90
+    },
+    # The firmware dates messages with millis(), its uptime. A "timestamp"
+    # before min_epoch_ms, or more than max_future_seconds ahead of the
+    # server's clock, is kept as "device_ms" and the message is dated by the
+    # time it was received instead.
+    "device_clock": {
+        "min_epoch_ms": firebase_layout.MIN_EPOCH_MS,
+        "max_future_seconds": 300
+    },
+    # Per-minute/per-hour vitals rollups maintained as data arrives (see
+    # firebase_layout.py for the partitioned Firebase layout)
+    "rollups": {
+        "resolutions": ["minute", "hour"],
+        "flush_interval": 10,
+        "grace_seconds": 120
+    },
+    # Report-by-exception: raw vitals are written to Firebase only when they
+    # leave the deadband, every heartbeat_seconds, or around an alert; the
+    # rollups still see every sample
+    "persistence": {
+        "enabled": True,
+        "deadband": {
+            "heart_rate": 3,
+            "spo2": 1
+        },
+        "heartbeat_seconds": 60,
+        "pre_roll_seconds": 30,
+        "post_roll_seconds": 60
+    },
+    "threshold_rules_path": "threshold_rules.json",  # Optional per-device/patient rules, hot-reloaded
+    "vitals_batch_size": 64,
+    "shutdown_drain_seconds": 30,  # Time SIGINT waits for the queued tasks
+    "profiler_max_seconds": 120,
+    "logging": {
+        "level": "INFO",
+        "format": "logfmt",  # or "json"
+        # Maximum records per second for chatty per-message events
+        "rate_limits": {
+            "vitals_invalid": 5,
+            "alert_sent": 20,
+            "alert_received": 20,
+            "image_metadata_received": 20,
+            "image_saved": 20,
+            "audio_processed": 20
+        }
+    },
+    # Several edge nodes sharing the device topics; each device is owned by
+    # one node. On rebalance its state is handed to the new owner over MQTT,
+    # whose messages for it wait up to handoff_timeout_seconds for it; a node
+    # shutting down leaves its devices' state in Firebase instead.
+    "cluster": {
+        "enabled": False,
+        "group": "edge",
+        "node_id": None,  # Defaults to the hostname
+        "heartbeat_seconds": 5,
+        "handoff_timeout_seconds": 10,
+        "state_path": "cluster/state",
+        "max_snapshot_age_seconds": 600
+    },
+    # Single event loop runtime (async_server.py): Firebase writes are
+    # batched through an outbox, and only inference runs on executor threads
+    "async_runtime": {
+        "max_queue": 10000,
+        "outbox_flush_interval": 0.2,
+        "outbox_batch_size": 500,
+        "outbox_max_pending": 100000,
+        "http_keepalive_seconds": 15,
+        "http_max_body_bytes": 16 * 1024 * 1024
+    },
+    # Worker mode (--workers N): N processes each handle a shard of the
+    # devices, with the vitals history in shared memory for the HTTP views
+    "workers": {
+        "count": 0,
+        "max_devices_per_worker": 1024,
+        "history": 128,
+        "meta_bytes": 8192,
+        "batch_size": 64,
+        "queue_size": 10000
+    },
+    # Inbound MQTT messages and uploads appended to a file (--capture PATH)
+    # for replay.py; capturing stops once the file reaches max_bytes
+    "capture": {
+        "path": None,
+        "max_bytes": 1024 ** 3,
+        "flush_interval": 1.0
+    },
+    # "live" uses Firebase, the MQTT broker and .eim models; "memory" swaps in
+    # the in-process implementations from backends.py
+    "backend": "live",
+    "memory_backend": {
+        "db_latency_ms": 0,
+        "db_jitter_ms": 0,
+        "runner_cost_ms": 2.0,
+        "runner_busy": False
     }
 }
 
 client = None  # Global MQTT client
+cluster = None  # Cluster membership, when config["cluster"]["enabled"]
+held_devices = {}  # device_id -> messages waiting for its handoff, oldest first
+handoff_loader = None  # Threads reading handed-off state from Firebase
+
+# MQTT topics carrying device data
+DEVICE_TOPICS = ("health/vitals/#", "health/parameters/#", "health/alerts/#", "health/image_metadata/#")
+
+structured_log.setup_logging(
+    config["logging"]["level"],
+    config["logging"]["format"],
+    config["logging"]["rate_limits"]
+)
+log = structured_log.get_logger("server")
+
+# Content-addressed image blobs with a per-device index
+image_store = ImageStore(
+    config["image_save_path"],
+    config["image_variant_path"],
+    near_duplicate_distance=config["image_near_duplicate_distance"]
+)
+
+# Image variant workers, started from main() before any other thread
+image_pipeline = ImagePipeline(
+    config["image_variant_path"],
+    workers=config["image_pipeline"]["workers"],
+    thumb_size=config["image_pipeline"]["thumb_size"],
+    web_max_side=config["image_pipeline"]["web_max_side"],
+    quality=config["image_pipeline"]["quality"]
+)
+
+# Forwarding of new uploads to rpi_2, started from main()
+image_relay = ImageRelay(
+    config["image_relay"]["url"],
+    config["image_outbox_path"],
+    enabled=config["image_relay"]["enabled"],
+    workers=config["image_relay"]["workers"],
+    queue_size=config["image_relay"]["queue_size"],
+    timeout=config["image_relay"]["timeout"],
+    retry_interval=config["image_relay"]["retry_interval"],
+    journal_path=config["image_relay"]["journal_path"],
+    log=structured_log.get_logger("image_relay")
+)
+
+# Threshold rules, compiled from config["anomaly_thresholds"] and the rules file
+threshold_engine = ThresholdRuleEngine(config["anomaly_thresholds"], config["threshold_rules_path"],
+                                       log=structured_log.get_logger("threshold_rules"))
+
+# Vitals rollups, written to Firebase by rollup_flusher(); a bucket still open
+# from before a restart is merged with its stored rollup
+rollups = firebase_layout.RollupAggregator(
+    tuple(config["rollups"]["resolutions"]),
+    grace=config["rollups"]["grace_seconds"],
+    loader=lambda path: db.reference(path).get()
+)
+
+# Which raw vitals samples are written (None writes every sample)
+persistence = PersistencePolicy(
+    config["persistence"]["deadband"],
+    heartbeat_seconds=config["persistence"]["heartbeat_seconds"],
+    pre_roll_seconds=config["persistence"]["pre_roll_seconds"],
+    post_roll_seconds=config["persistence"]["post_roll_seconds"]
+) if config["persistence"]["enabled"] else None
+
+# Cache of model results for repeated feature vectors
+inference_cache = InferenceCache(config["inference_cache"]["max_size"], config["inference_cache"]["quantum"])
+
+# Loaded models, swapped while serving when their .eim files change
+model_registry = ModelRegistry(
+    models,
+    lambda: config["model_paths"],
+    lambda model_name: load_model(model_name, fallback=False),
+    config["model_reload"],
+    on_swap=inference_cache.invalidate,
+    log=log
+)
+
+# Deadlines and circuit breakers around the .eim calls
+inference_guard = InferenceGuard(model_registry, config["inference_deadlines"], log=log)
+
+# Metrics exported on /metrics
+metric_messages = metrics.registry.counter(
+    "mqtt_messages_total", "MQTT messages received, by topic family", ("topic",))
+metric_decode = metrics.registry.histogram(
+    "mqtt_decode_seconds", "Time to decode an MQTT payload")
+metric_queue_wait = metrics.registry.histogram(
+    "queue_wait_seconds", "Time tasks spend in the processing queue", ("type",))
+metric_feature_build = metrics.registry.histogram(
+    "feature_build_seconds", "Time to build model features", ("model",))
+metric_classify = metrics.registry.histogram(
+    "classify_seconds", "Model classify() time, cache misses only", ("model",))
+metric_firebase_write = metrics.registry.histogram(
+    "firebase_write_seconds", "Firebase write time, by node", ("node",))
+metric_dropped = metrics.registry.counter(
+    "messages_dropped_total", "Messages shed before processing", ("reason",))
+metric_errors = metrics.registry.counter(
+    "errors_total", "Errors, by pipeline stage", ("stage",))
+metric_alerts = metrics.registry.counter(
+    "alerts_total", "Alerts sent", ("alert_type", "source"))
+metric_image_variants = metrics.registry.histogram(
+    "image_variants_seconds", "Time from upload to thumbnail and web variants being ready")
+metric_device_lag = metrics.registry.gauge(
+    "device_lag_seconds", "Delay between a sample's timestamp and its processing, for devices with a wall clock", ("device_id",))
+metric_cluster_forwarded = metrics.registry.counter(
+    "cluster_forwarded_total", "Device messages forwarded to the owning cluster node")
+metric_cluster_handoffs = metrics.registry.counter(
+    "cluster_handoffs_total", "Device states handed to or adopted from other nodes", ("direction",))
+metrics.registry.gauge(
+    "processing_queue_size", "Tasks waiting in the processing queue").set_function(lambda: processing_queue.qsize())
+metrics.registry.gauge(
+    "active_devices", "Devices with in-memory state").set_function(lambda: len(device_data))
 
 # Ensure directories exist
 os.makedirs(config["image_save_path"], exist_ok=True)
@@ -58,89 +348,182 @@ try:
     from edge_impulse_linux.runner import ImpulseRunner
     has_edge_impulse = True
 except ImportError:
-    print("Edge Impulse SDK not installed. Run 'pip install edge_impulse_linux' to install.")
+    log.warning("edge_impulse_missing", hint="pip install edge_impulse_linux")
     has_edge_impulse = False
     
 # Signal handler for graceful shutdown
 def signal_handler(sig, frame):
-    print('Interrupted, shutting down models...')
+    log.info("shutdown", reason="SIGINT")
+    # Finish the queued tasks before anything is torn down
+    stop_intake()
+    if worker_pool is not None:
+        worker_pool.stop()
+        device_store.close()
+    else:
+        drain_processing_queue(config["shutdown_drain_seconds"])
+    if cluster is not None:
+        hand_off_devices(list(device_data))
+        cluster.leave()
+    model_registry.stop()
     unload_models()
+    image_pipeline.shutdown(wait=False)
+    flush_rollups()
+    if capture is not None:
+        capture.close()
+    structured_log.flush()
     sys.exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
+
+# Stop receiving device messages; alerts can still be published
+def stop_intake():
+    if client is None:
+        return
+    if cluster is not None:
+        cluster.unsubscribe(client, DEVICE_TOPICS)
+    else:
+        for topic in DEVICE_TOPICS:
+            client.unsubscribe(topic)
+
+# Wait up to `timeout` seconds for the task processor to finish the queue
+def drain_processing_queue(timeout):
+    deadline = time.monotonic() + timeout
+    while processing_queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if processing_queue.unfinished_tasks:
+        log.warning("shutdown_tasks_abandoned", queued=processing_queue.unfinished_tasks)
     
-# Load machine learning models (.EIM format)
+# Load machine learning models (.EIM format, or "builtin:<detector>" for an
+# in-process fallback detector)
 def load_models():
-    print("Loading Edge Impulse ML models...")
+    log.info("models_loading")
     if not has_edge_impulse:
-        print("Edge Impulse SDK not available. Models will not be loaded.")
-        return
+        log.warning("edge_impulse_unavailable", detail="only fallback detectors will be loaded")
         
     try:
-        # Load BPM anomaly detection model
-        if os.path.exists(config["model_paths"]["bpm_model"]):
-            models["bpm_model"] = ImpulseRunner(config["model_paths"]["bpm_model"])
-            try:
-                model_info = models["bpm_model"].init()
-                print(f"BPM model loaded successfully: {model_info['project']['name']}")
-            except Exception as e:
-                print(f"Failed to initialize BPM model: {e}")
-                models["bpm_model"] = None
-        else:
-            print(f"BPM model not found at {config['model_paths']['bpm_model']}")
-            
-        # Load SpO2 anomaly detection model
-        if os.path.exists(config["model_paths"]["spo2_model"]):
-            models["spo2_model"] = ImpulseRunner(config["model_paths"]["spo2_model"])
-            try:
-                # Make the SpO2 model executable if needed
-                os.chmod(config["model_paths"]["spo2_model"], 0o755)
-                model_info = models["spo2_model"].init()
-                print(f"SpO2 model loaded successfully: {model_info['project']['name']}")
-            except Exception as e:
-                print(f"Failed to initialize SpO2 model: {e}")
-                models["spo2_model"] = None
-        else:
-            print(f"SpO2 model not found at {config['model_paths']['spo2_model']}")
-            
-        # Load keyword detection model
-        if os.path.exists(config["model_paths"]["keyword_model"]):
-            models["keyword_model"] = ImpulseRunner(config["model_paths"]["keyword_model"])
-            try:
-                model_info = models["keyword_model"].init()
-                print(f"Keyword model loaded successfully: {model_info['project']['name']}")
-            except Exception as e:
-                print(f"Failed to initialize keyword model: {e}")
-                models["keyword_model"] = None
-        else:
-            print(f"Keyword model not found at {config['model_paths']['keyword_model']}")
+        for model_name in config["model_paths"]:
+            model_registry.install(model_name, load_model(model_name))
     except Exception as e:
-        print(f"Error loading models: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("models_load_failed", error=str(e))
+
+# Create the runner for one entry of config["model_paths"], falling back to
+# config["model_fallbacks"] when the .eim model can't be used (or returning
+# None, without `fallback`)
+def load_model(model_name, fallback=True):
+    model_path = config["model_paths"][model_name]
+    if model_path.startswith("builtin:"):
+        return load_builtin_model(model_name, model_path[len("builtin:"):])
+    
+    if not has_edge_impulse:
+        return load_fallback_model(model_name) if fallback else None
+    needs_model_file = getattr(ImpulseRunner, "needs_model_file", True)
+    if needs_model_file and not os.path.exists(model_path):
+        log.warning("model_missing", model=model_name, path=model_path)
+        return load_fallback_model(model_name) if fallback else None
+        
+    runner = ImpulseRunner(model_path)
+    try:
+        # Make the model executable if needed
+        if needs_model_file:
+            os.chmod(model_path, 0o755)
+        model_info = runner.init()
+        log.info("model_loaded", model=model_name, project=model_info['project']['name'])
+        return runner
+    except Exception as e:
+        log.error("model_init_failed", model=model_name, error=str(e))
+        try:
+            runner.stop()
+        except Exception:
+            pass
+        return load_fallback_model(model_name) if fallback else None
+
+def load_fallback_model(model_name):
+    kind = config["model_fallbacks"].get(model_name)
+    if not kind:
+        log.warning("model_no_fallback", model=model_name)
+        return None
+    return load_builtin_model(model_name, kind)
+
+def load_builtin_model(model_name, kind):
+    try:
+        detector = create_detector(kind)
+        model_info = detector.init()
+        log.info("model_fallback", model=model_name, detector=model_info['project']['name'])
+        return detector
+    except Exception as e:
+        log.error("model_fallback_failed", model=model_name, detector=kind, error=str(e))
+        return None
 
 # Unload models properly
 def unload_models():
-    print("Unloading Edge Impulse ML models...")
-    for model_name, model in models.items():
-        try:
-            if model:
-                model.stop()
-                print(f"Model {model_name} unloaded successfully")
-        except Exception as e:
-            print(f"Error unloading model {model_name}: {e}")
+    log.info("models_unloading")
+    model_registry.unload()
+    inference_guard.shutdown()
+        
+# Swap the Firebase, MQTT and Edge Impulse globals for in-process
+# implementations, so the server can run without any external service.
+# Servers given the same `broker` and `database` run as one cluster.
+def configure_backends(backend, broker=None, database=None):
+    global db, mqtt, ImpulseRunner, has_edge_impulse
+    config["backend"] = backend
+    if backend == "live":
+        return
+    if backend != "memory":
+        raise ValueError(f"Unknown backend: {backend}")
         
+    options = config["memory_backend"]
+    db = database or backends.MemoryDatabase(
+        latency=options["db_latency_ms"] / 1000.0,
+        jitter=options["db_jitter_ms"] / 1000.0
+    )
+    mqtt = backends.LoopbackMqtt(broker or backends.LoopbackBroker())
+    ImpulseRunner = backends.scripted_runner(
+        cost=options["runner_cost_ms"] / 1000.0,
+        busy=options["runner_busy"]
+    )
+    has_edge_impulse = True
+    log.info("backends_configured", backend="memory")
+
 # Initialize Firebase
 def initialize_firebase():
-    print("Initializing Firebase...")
+    if config["backend"] == "memory":
+        log.info("firebase_skipped", backend="memory")
+        return
+    log.info("firebase_initializing")
     try:
         cred = credentials.Certificate("smart-healthcare-3a0d6-firebase-adminsdk-fbsvc-e3b80a3443.json")
         firebase_admin.initialize_app(cred, {
             'databaseURL': config["firebase_db_url"]
         })
-        print("Firebase initialized successfully")
+        log.info("firebase_initialized")
     except Exception as e:
-        print(f"Error initializing Firebase: {e}")
+        log.error("firebase_init_failed", error=str(e))
+
+# Push a record to Firebase, timing the write under `node` (by default the
+# last path segment)
+def firebase_push(path, value, node=None):
+    node = node or path.rsplit('/', 1)[-1]
+    if outbox is not None:
+        return outbox.push(path, value, node)
+    start = time.perf_counter()
+    with timers.time(f"firebase.push.{node}"):
+        ref = db.reference(path).push(value)
+    metric_firebase_write.labels(node).observe(time.perf_counter() - start)
+    return ref
+
+# Update an existing Firebase record, timing the write
+def firebase_update(ref, value, node):
+    if outbox is not None:
+        outbox.update(ref.path, value, node)
+        return
+    start = time.perf_counter()
+    with timers.time(f"firebase.update.{node}"):
+        ref.update(value)
+    metric_firebase_write.labels(node).observe(time.perf_counter() - start)
+
+# Write several locations in one multi-path update from the root
+def firebase_update_paths(updates, node):
+    firebase_update(db.reference('/'), updates, node)
 
 # Flask routes for receiving data from ESP32
 @app.route('/upload', methods=['POST'])
@@ -153,30 +536,74 @@ def upload_image():
         # Get device ID from header or default to "unknown"
         device_id = request.headers.get('Device-ID', 'unknown')
         
-        # Generate a unique filename
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{device_id}{timestamp}{uuid.uuid4().hex[:8]}.jpg"
-        filepath = os.path.join(config["image_save_path"], filename)
-        
-        # Save the image
-        with open(filepath, 'wb') as f:
-            f.write(request.data)
+        # Save the image under its content hash; identical frames are stored once
+        entry = image_store.put(device_id, request.data)
+        filename = entry["filename"]
+        filepath = entry["path"]
+        if capture is not None:
+            capture.record_http('/upload', captured_headers(), filepath, len(request.data))
         
         # Store image info in Firebase
         image_info = {
             "filename": filename,
             "device_id": device_id,
-            "timestamp": int(time.time() * 1000),
-            "path": filepath
+            "timestamp": entry["timestamp"],
+            "path": filepath,
+            "hash": entry["hash"]
         }
-        db.reference(f'devices/{device_id}/images').push(image_info)
+        if entry["duplicate"]:
+            image_info["duplicate"] = True
+        image_ref = firebase_push(
+            firebase_layout.record_path("images", device_id, entry["timestamp"]), image_info, "images")
+        firebase_update_paths({firebase_layout.latest_path(device_id, "image"): image_info}, "latest")
         
-        print(f"Image saved: {filepath}")
-        return jsonify({"status": "success", "filename": filename}), 200
+        # Ship new content to rpi_2, and decode and build the variants off
+        # the request thread; a duplicate has already been through both
+        if not entry["duplicate"]:
+            image_relay.submit(device_id, entry, request.data)
+        if image_pipeline.started and not entry["duplicate"]:
+            submitted = time.perf_counter()
+            image_pipeline.submit(
+                filepath,
+                lambda result, error: record_image_variants(device_id, entry["hash"], image_ref, submitted, result, error),
+                out_dir=image_store.variant_dir(entry["hash"])
+            )
+        
+        log.info("image_saved", device_id=device_id, path=filepath, duplicate=entry["duplicate"])
+        return jsonify({"status": "success", "filename": filename, "hash": entry["hash"]}), 200
     except Exception as e:
-        print(f"Error saving image: {e}")
+        metric_errors.labels("upload").inc()
+        log.error("image_save_failed", error=str(e))
         return jsonify({"error": str(e)}), 500
 
+# Record the thumbnail and web variant paths once the pipeline has built them
+def record_image_variants(device_id, digest, image_ref, submitted, result, error):
+    if error is not None:
+        metric_errors.labels("image_variants").inc()
+        log.error("image_variants_failed", device_id=device_id, error=str(error))
+        return
+    try:
+        metric_image_variants.observe(time.perf_counter() - submitted)
+        fields = {
+            "thumbnail_path": result["thumbnail_path"],
+            "web_path": result["web_path"],
+            "width": result["width"],
+            "height": result["height"],
+            "dhash": result["dhash"]
+        }
+        near_duplicate_of = image_store.find_near_duplicate(device_id, digest, result["dhash"])
+        if near_duplicate_of:
+            fields["near_duplicate_of"] = near_duplicate_of
+        image_store.annotate(device_id, digest, fields)
+        firebase_update(image_ref, fields, "image_variants")
+    except Exception as e:
+        metric_errors.labels("image_variants").inc()
+        log.error("image_variants_failed", device_id=device_id, error=str(e))
+
+# Request headers an upload needs to be replayed
+def captured_headers():
+    return {name: request.headers[name] for name in ('Device-ID', 'Content-Type') if name in request.headers}
+
 @app.route('/process_audio', methods=['POST'])
 def process_audio():
     try:
@@ -198,6 +625,8 @@ def process_audio():
         # Save audio file
         with open(filepath, 'wb') as f:
             f.write(request.data)
+        if capture is not None:
+            capture.record_http('/process_audio', captured_headers(), filepath, len(request.data))
             
         # Add to processing queue (non-blocking)
         processing_queue.put({
@@ -205,7 +634,8 @@ def process_audio():
             'device_id': device_id,
             'filepath': filepath,
             'audio_data': audio_data,
-            'timestamp': int(time.time() * 1000)
+            'timestamp': int(time.time() * 1000),
+            'enqueued_at': time.perf_counter()
         })
         
         return jsonify({
@@ -214,7 +644,8 @@ def process_audio():
         }), 200
         
     except Exception as e:
-        print(f"Error processing audio: {e}")
+        metric_errors.labels("process_audio").inc()
+        log.error("audio_upload_failed", error=str(e))
         return jsonify({"error": str(e)}), 500
 
 # Process audio for keyword detection
@@ -236,15 +667,20 @@ def process_audio_task(task):
             "processed": False
         }
         
-        audio_ref = db.reference(f'devices/{device_id}/audio').push(audio_info)
+        audio_ref = firebase_push(f'devices/{device_id}/audio', audio_info)
         
         # Skip processing if keyword model isn't loaded
         if "keyword_model" not in models or not models["keyword_model"]:
-            print("Keyword model not available, skipping audio processing")
+            log.warning("keyword_model_unavailable", device_id=device_id)
             return
             
         # Run inference with Edge Impulse model - using raw audio
-        res = models["keyword_model"].classify(audio_float.tolist())  # Convert to list
+        try:
+            with metric_classify.labels("keyword_model").time(), timers.time("classify.keyword_model"):
+                res = inference_guard.classify("keyword_model", audio_float.tolist())  # Convert to list
+        except InferenceUnavailable as e:
+            log.warning("keyword_model_unavailable", device_id=device_id, error=str(e))
+            return
         
         keyword_detected = False
         detected_keyword = ""
@@ -282,93 +718,329 @@ def process_audio_task(task):
                     send_alert(device_id, alert_data)
                     
                     # Update the audio entry to mark as processed with result
-                    audio_ref.update({
+                    firebase_update(audio_ref, {
                         "processed": True,
                         "keyword_detected": True,
                         "keyword": matched_keyword or detected_keyword,
                         "confidence": float(max_confidence)
-                    })
+                    }, "audio_update")
                     
-                    print(f"Keyword detected: {detected_keyword} with confidence {max_confidence}")
+                    log.info("audio_processed", device_id=device_id, keyword=detected_keyword,
+                             confidence=float(max_confidence))
                     return
         
         # Update the audio entry to mark as processed with no keyword detected
-        audio_ref.update({
+        firebase_update(audio_ref, {
             "processed": True,
             "keyword_detected": False
-        })
-        print(f"No keyword detected in audio from device {device_id}")
+        }, "audio_update")
+        log.info("audio_processed", device_id=device_id, keyword=None)
                 
     except Exception as e:
-        print(f"Error in audio processing task: {e}")
-        import traceback
-        traceback.print_exc()
+        metric_errors.labels("audio_task").inc()
+        log.exception("audio_task_failed", device_id=device_id, error=str(e))
 
-# Connect to MQTT broker
-def connect_mqtt():
+# Metric label for a topic: "health/vitals/dev1" -> "health/vitals"
+def topic_family(topic):
+    return '/'.join(topic.split('/', 2)[:2])
+
+# Decode and route one MQTT message. Alerts and image metadata are handled
+# here; vitals are returned as a task for the processing queue.
+def handle_message(topic, body):
+    try:
+        hops = 0
+        metric_messages.labels(topic_family(topic)).inc()
+        if held_devices:
+            release_expired_devices()
+        
+        # Membership updates, handoffs, and device messages forwarded by
+        # other nodes
+        if cluster is not None and cluster.is_cluster_topic(topic):
+            forwarded = cluster.handle(topic, body)
+            if forwarded is None:
+                return None
+            topic, text, hops = forwarded
+            body = text.encode()
+        
+        start = time.perf_counter()
+        payload = json.loads(body.decode())
+        metric_decode.observe(time.perf_counter() - start)
+        
+        # Make sure device_id exists
+        if "device_id" not in payload:
+            payload["device_id"] = "unknown"
+        
+        device_id = payload["device_id"]
+        device_clock = normalize_timestamp(payload, int(time.time() * 1000))
+        return route_message(topic, device_id, payload, device_clock, body.decode(), hops)
+            
+    except json.JSONDecodeError:
+        metric_dropped.labels("decode_error").inc()
+        log.warning("mqtt_decode_failed", topic=topic, payload=body[:200])
+    except Exception as e:
+        metric_errors.labels("mqtt_message").inc()
+        log.error("mqtt_message_failed", topic=topic, error=str(e))
+    return None
+
+# Process a decoded device message, or in a cluster pass it to the device's
+# owner. Returns a vitals task for the processing queue, or None.
+def route_message(topic, device_id, payload, device_clock, text, hops=0):
+    if cluster is not None:
+        # Only the device's owner processes its messages
+        if not cluster.owns(device_id):
+            if cluster.forward(device_id, topic, text, hops):
+                metric_cluster_forwarded.inc()
+                return None
+        # A device this node just took over waits for its previous owner's state
+        elif device_id not in device_data and hold_message(device_id, (topic, payload, device_clock, text, hops)):
+            return None
+    
+    # Initialize device data if not exists
+    if device_id not in device_data:
+        device_data[device_id] = new_device_entry(device_id)
+    
+    # Process different types of messages
+    if topic.startswith("health/vitals") or topic.startswith("health/parameters"):
+        return {
+            'type': 'vitals',
+            'device_id': device_id,
+            'payload': payload,
+            'device_clock': device_clock,
+            'enqueued_at': time.perf_counter()
+        }
+    elif topic.startswith("health/alerts"):
+        process_alert(device_id, payload)
+    elif topic.startswith("health/image_metadata"):
+        process_image_metadata(device_id, payload)
+    return None
+
+# Make payload["timestamp"] Unix epoch milliseconds, as the partitions,
+# rollups and persistence policy expect. A device timestamp that can't be
+# one moves to "device_ms" and the message is dated `received_ms`, as is one
+# without a timestamp. Returns whether the device's own timestamp was kept.
+def normalize_timestamp(payload, received_ms):
+    timestamp = payload.get("timestamp")
+    if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+        options = config["device_clock"]
+        if options["min_epoch_ms"] <= timestamp <= received_ms + options["max_future_seconds"] * 1000:
+            return True
+    if timestamp is not None:
+        payload["device_ms"] = timestamp
+    payload["timestamp"] = received_ms
+    return False
+
+# MQTT client subscribed to the device topics, with vitals going to the
+# processing queue; not yet connected. In worker mode, messages go to the
+# device's worker undecoded, and the workers' own clients only publish.
+def create_mqtt_client(subscribe=True):
     def on_connect(client, userdata, flags, rc):
         if rc == 0:
-            print("Connected to MQTT Broker!")
-            client.subscribe("health/vitals/#")
-            client.subscribe("health/parameters/#")
-            client.subscribe("health/alerts/#")
-            client.subscribe("health/image_metadata/#")
+            log.info("mqtt_connected")
+            if not subscribe:
+                return
+            if cluster is not None:
+                cluster.subscribe(client, DEVICE_TOPICS)
+            else:
+                for topic in DEVICE_TOPICS:
+                    client.subscribe(topic)
         else:
-            print(f"Failed to connect to MQTT Broker. Return code: {rc}")
+            log.error("mqtt_connect_refused", rc=rc)
 
     def on_message(client, userdata, msg):
-        try:
-            payload = json.loads(msg.payload.decode())
-            topic = msg.topic
-            
-            # Make sure device_id exists
-            if "device_id" not in payload:
-                payload["device_id"] = "unknown"
-            
-            device_id = payload["device_id"]
-            
-            # Initialize device data if not exists
-            if device_id not in device_data:
-                device_data[device_id] = {
-                    "heart_rate": [],
-                    "spo2": [],
-                    "alerts": [],
-                    "images": [],
-                    "last_update": time.time()
-                }
-            
-            # Process different types of messages
-            if topic.startswith("health/vitals") or topic.startswith("health/parameters"):
-                # Add to processing queue
-                processing_queue.put({
-                    'type': 'vitals',
-                    'device_id': device_id,
-                    'payload': payload
-                })
-            elif topic.startswith("health/alerts"):
-                process_alert(device_id, payload)
-            elif topic.startswith("health/image_metadata"):
-                process_image_metadata(device_id, payload)
-                
-        except json.JSONDecodeError:
-            print(f"Error decoding message: {msg.payload}")
-        except Exception as e:
-            print(f"Error processing message: {e}")
+        if capture is not None:
+            capture.record_mqtt(msg.topic, msg.payload)
+        if worker_pool is not None:
+            worker_pool.put({
+                'type': 'message',
+                'device_id': device_key(msg.payload),
+                'topic': msg.topic,
+                'body': msg.payload,
+                'enqueued_at': time.perf_counter()
+            })
+            return
+        task = handle_message(msg.topic, msg.payload)
+        if task is not None:
+            # Add to processing queue
+            processing_queue.put(task)
 
     # Create MQTT client
     client = mqtt.Client()
     client.username_pw_set(config["mqtt_user"], config["mqtt_password"])
     client.on_connect = on_connect
     client.on_message = on_message
-    
+    if cluster is not None:
+        cluster.attach(client)
+    return client
+
+# Connect to MQTT broker
+def connect_mqtt(subscribe=True):
+    client = create_mqtt_client(subscribe)
     try:
         client.connect(config["mqtt_broker"], config["mqtt_port"], 60)
-        print("Connected to MQTT broker")
+        log.info("mqtt_connecting", broker=config["mqtt_broker"], port=config["mqtt_port"])
     except Exception as e:
-        print(f"Error connecting to MQTT broker: {e}")
+        log.error("mqtt_connect_failed", error=str(e))
     
     return client
     
+# In-memory state for a device this node starts handling: `entry` if another
+# cluster node handed it off, else empty. In a worker, the vitals history is
+# moved into shared memory.
+def new_device_entry(device_id, entry=None):
+    if entry is None:
+        entry = {
+            "heart_rate": [],
+            "spo2": [],
+            "alerts": [],
+            "images": [],
+            "last_update": time.time()
+        }
+    if device_store is not None and not device_store.attach(device_id, entry):
+        log.warning("device_not_shared", device_id=device_id, hint="raise workers.max_devices_per_worker")
+    return entry
+
+# Hold a message for a device this node now owns until its previous owner's
+# state is in: the handoff of a live previous owner, or what a departed one
+# left in Firebase. Returns False when there is nothing to wait for.
+def hold_message(device_id, message):
+    held = held_devices.get(device_id)
+    if held is None:
+        previous = cluster.previous_owner(device_id)
+        if previous == cluster.node_id:
+            return False
+        if previous is not None and cluster.is_member(previous):
+            if cluster.handed_off(previous):
+                return False
+        else:
+            previous = cluster.node_id
+            handoff_loader.submit(load_handed_off_state, device_id)
+        held = held_devices[device_id] = {
+            "from": previous,
+            "until": time.monotonic() + config["cluster"]["handoff_timeout_seconds"],
+            "messages": []
+        }
+    held["messages"].append(message)
+    return True
+
+# Read the state a node that left saved for the device, on a loader thread;
+# it comes back through this node's inbox like any other handoff
+def load_handed_off_state(device_id):
+    state = None
+    try:
+        ref = db.reference(f"{config['cluster']['state_path']}/{device_id}")
+        snapshot = ref.get()
+        if snapshot:
+            ref.delete()
+            if time.time() - snapshot["saved_at"] <= config["cluster"]["max_snapshot_age_seconds"]:
+                state = snapshot["data"]
+                log.info("device_state_loaded", device_id=device_id, from_node=snapshot["node_id"])
+    except Exception as e:
+        metric_errors.labels("cluster_adopt").inc()
+        log.error("device_adopt_failed", device_id=device_id, error=str(e))
+    cluster.send_handoff(cluster.node_id, {device_id: state})
+
+# Process the messages held for a device, starting from its handed-off state
+# if that arrived
+def release_device(device_id):
+    held = held_devices.pop(device_id)
+    if device_id not in device_data:
+        device_data[device_id] = new_device_entry(device_id)
+    for topic, payload, device_clock, text, hops in held["messages"]:
+        task = route_message(topic, device_id, payload, device_clock, text, hops)
+        if task is not None:
+            processing_queue.put(task)
+
+# Stop waiting for handoffs that haven't arrived in time; the devices start
+# from empty state
+def release_expired_devices():
+    now = time.monotonic()
+    while held_devices:
+        device_id, held = next(iter(held_devices.items()))
+        if held["until"] > now:
+            return
+        metric_cluster_handoffs.labels("timed_out").inc()
+        log.warning("device_handoff_timed_out", device_id=device_id, from_node=held["from"],
+                    messages=len(held["messages"]))
+        release_device(device_id)
+
+# State handed off by `node` ({device_id: JSON or None}), or loaded from
+# Firebase when `node` is this node. Its handoff also releases the devices
+# it had nothing for.
+def on_handoff(node, devices):
+    try:
+        for device_id, state in devices.items():
+            if state:
+                adopt_device(device_id, json.loads(state), node)
+        for device_id in [d for d, held in held_devices.items()
+                          if d in devices or (held["from"] == node != cluster.node_id)]:
+            release_device(device_id)
+    except Exception as e:
+        metric_errors.labels("cluster_adopt").inc()
+        log.error("device_adopt_failed", from_node=node, error=str(e))
+
+# Take over a device's state; samples taken here while the handoff was on
+# its way follow the handed-off ones
+def adopt_device(device_id, entry, node):
+    current = device_data.get(device_id)
+    if current is None:
+        device_data[device_id] = new_device_entry(device_id, entry)
+    else:
+        for key in ("heart_rate", "spo2", "alerts", "images"):
+            current[key] = entry.get(key, []) + current[key]
+        for key in ("heart_rate", "spo2"):
+            current[key] = current[key][-100:]
+    rollups.adopt(device_id)
+    metric_cluster_handoffs.labels("adopted").inc()
+    log.info("device_adopted", device_id=device_id, from_node=node)
+
+# Drop the local state of devices this node no longer handles, returning it
+# as {device_id: JSON}; rollups are flushed first so the next owner can
+# merge with them
+def release_device_states(device_ids):
+    flush_rollups()
+    states = {}
+    for device_id in device_ids:
+        entry = device_data.pop(device_id, None)
+        if entry is None:
+            continue
+        states[device_id] = json.dumps(entry)
+        threshold_engine.forget(device_id)
+        rollups.forget(device_id)
+        if persistence is not None:
+            persistence.forget(device_id)
+        metric_device_lag.remove(device_id)
+    return states
+
+# Save the devices' state to Firebase for whichever nodes take them over,
+# before this node leaves the cluster
+def hand_off_devices(device_ids):
+    snapshots = {
+        f"{config['cluster']['state_path']}/{device_id}": {
+            "node_id": cluster.node_id,
+            "saved_at": time.time(),
+            "data": state
+        }
+        for device_id, state in release_device_states(device_ids).items()
+    }
+    if snapshots:
+        firebase_update_paths(snapshots, "cluster_handoff")
+        metric_cluster_handoffs.labels("handed_off").inc(len(snapshots))
+        log.info("devices_handed_off", count=len(snapshots), members=sorted(cluster.members))
+
+# Send each other member the state of the devices it took over from this
+# node; the ones that took none get an empty handoff
+def on_cluster_change(old_members, new_members):
+    try:
+        states = release_device_states([d for d in list(device_data) if not cluster.owns(d)])
+        for member in sorted(new_members - {cluster.node_id}):
+            cluster.send_handoff(member, {d: state for d, state in states.items() if cluster.owner(d) == member})
+        if states:
+            metric_cluster_handoffs.labels("handed_off").inc(len(states))
+            log.info("devices_handed_off", count=len(states), members=sorted(new_members))
+    except Exception as e:
+        metric_errors.labels("cluster_handoff").inc()
+        log.error("device_handoff_failed", error=str(e))
+
 # Health check endpoint
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -377,9 +1049,66 @@ def health_check():
         "models_loaded": [name for name, model in models.items() if model is not None],
         "active_devices": len(device_data),
         "queue_size": processing_queue.qsize(),
+        "inference_cache": inference_cache.stats(),
+        "circuit_breakers": inference_guard.status(),
         "timestamp": int(time.time())
     }), 200
 
+# Prometheus metrics endpoint
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return metrics.registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+# Sample every server thread for N seconds and return collapsed stacks,
+# ready for flamegraph.pl or speedscope
+@app.route('/admin/profile', methods=['GET'])
+def admin_profile():
+    try:
+        seconds = min(float(request.args.get('seconds', 10)), config["profiler_max_seconds"])
+        interval = max(float(request.args.get('interval', 0.005)), 0.001)
+    except ValueError:
+        return jsonify({"error": "Invalid seconds or interval parameter"}), 400
+        
+    result = profiler.profile(seconds, interval)
+    if result is None:
+        return jsonify({"error": "A profile is already running"}), 409
+        
+    stacks, samples = result
+    return stacks, 200, {
+        'Content-Type': 'text/plain',
+        'Content-Disposition': f'attachment; filename="profile_{int(time.time())}.folded"',
+        'X-Profile-Samples': str(samples)
+    }
+
+# Switch the per-call timers around classify and Firebase writes on or off
+@app.route('/admin/timers', methods=['GET', 'POST'])
+def admin_timers():
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        enabled = body.get("enabled", request.args.get("enabled"))
+        if enabled in (True, "1", "true", "on"):
+            timers.enable()
+        elif enabled in (False, "0", "false", "off"):
+            timers.disable()
+        else:
+            return jsonify({"error": "Expected enabled=true|false"}), 400
+    return jsonify(timers.snapshot()), 200
+
+# Loaded models; POST {"model": name, "path": path} points a model at a new
+# .eim file, which is swapped in once it has loaded and warmed up
+@app.route('/admin/models', methods=['GET', 'POST'])
+def admin_models():
+    if request.method == 'POST':
+        if worker_pool is not None:
+            return jsonify({"error": "Each worker loads its own models; replace the .eim file instead"}), 409
+        body = request.get_json(silent=True) or {}
+        model_name, path = body.get("model"), body.get("path")
+        if not model_name or not isinstance(path, str) or not path:
+            return jsonify({"error": "Expected {\"model\": name, \"path\": path}"}), 400
+        config["model_paths"][model_name] = path
+        log.info("model_path_changed", model=model_name, path=path)
+    return jsonify({"models": model_registry.status(), "model_paths": config["model_paths"]}), 200
+
 # Get device status endpoint
 @app.route('/device/<device_id>', methods=['GET'])
 def get_device_status(device_id):
@@ -408,29 +1137,56 @@ def get_device_status(device_id):
     else:
         return jsonify({"error": "Device not found"}), 404
 
+# Drop the state of devices that haven't sent data for `max_idle` seconds
+def remove_inactive_devices(max_idle=3600):
+    current_time = time.time()
+    devices_to_remove = []
+    
+    # Find devices that haven't sent data in 1 hour
+    for device_id, data in device_data.items():
+        if current_time - data["last_update"] > max_idle:
+            devices_to_remove.append(device_id)
+    
+    # Remove inactive devices
+    for device_id in devices_to_remove:
+        del device_data[device_id]
+        if device_store is not None:
+            device_store.release(device_id)
+        threshold_engine.forget(device_id)
+        rollups.forget(device_id)
+        if persistence is not None:
+            persistence.forget(device_id)
+        metric_device_lag.remove(device_id)
+        log.info("device_removed", device_id=device_id)
+
 # Function to periodically clean up old data
 def cleanup_old_data():
     while True:
         try:
-            current_time = time.time()
-            devices_to_remove = []
-            
-            # Find devices that haven't sent data in 1 hour
-            for device_id, data in device_data.items():
-                if current_time - data["last_update"] > 3600:  # 1 hour
-                    devices_to_remove.append(device_id)
-            
-            # Remove inactive devices
-            for device_id in devices_to_remove:
-                del device_data[device_id]
-                print(f"Removed inactive device: {device_id}")
+            remove_inactive_devices()
             
             # Sleep for 15 minutes
             time.sleep(900)
         except Exception as e:
-            print(f"Error in cleanup task: {e}")
+            log.error("cleanup_failed", error=str(e))
             time.sleep(60)  # Sleep for 1 minute on error
 
+# Write changed rollups and latest values to Firebase in one update
+def flush_rollups():
+    updates = rollups.flush()
+    if not updates:
+        return
+    try:
+        firebase_update_paths(updates, "rollups")
+    except Exception as e:
+        metric_errors.labels("rollups").inc()
+        log.error("rollup_flush_failed", buckets=len(updates), error=str(e))
+
+def rollup_flusher():
+    while True:
+        time.sleep(config["rollups"]["flush_interval"])
+        flush_rollups()
+
 # Send alert to MQTT and store in Firebase
 def send_alert(device_id, alert_data):
     # Ensure alert has all required fields
@@ -442,271 +1198,296 @@ def send_alert(device_id, alert_data):
         client.publish("health/detected_anomalies", json.dumps(alert_data))
     
     # Store in Firebase
-    alert_ref = db.reference(f'devices/{device_id}/alerts').push(alert_data)
+    alert_ref = firebase_push(
+        firebase_layout.record_path("alerts", device_id, alert_data["timestamp"]), alert_data, "alerts")
+    metric_alerts.labels(alert_data.get("alert_type", "unknown"), alert_data.get("source", "")).inc()
+    write_alert_pre_roll(device_id, alert_data["timestamp"])
     
     # Store in memory
     if device_id not in device_data:
-        device_data[device_id] = {
-            "heart_rate": [],
-            "spo2": [],
-            "alerts": [],
-            "images": [],
-            "last_update": time.time()
-        }
+        device_data[device_id] = new_device_entry(device_id)
         
     if len(device_data[device_id]["alerts"]) > 20:
         device_data[device_id]["alerts"].pop(0)
     device_data[device_id]["alerts"].append(alert_data)
     
-    print(f"Alert sent: {alert_data}")
+    log.info("alert_sent", device_id=device_id, alert_type=alert_data.get("alert_type"),
+             source=alert_data.get("source"), value=alert_data.get("value"))
     
     # Return the Firebase reference key
     return alert_ref.key
 
+# Open the persistence alert window for a device and write the raw samples
+# held back in the pre-roll before the alert
+def write_alert_pre_roll(device_id, timestamp):
+    if persistence is None:
+        return
+    for sample_timestamp, vital_data in persistence.on_alert(device_id, timestamp):
+        firebase_push(firebase_layout.record_path("vitals", device_id, sample_timestamp), vital_data, "vitals")
+
 # Process alert from device
 def process_alert(device_id, payload):
     # Store in Firebase
-    db.reference(f'devices/{device_id}/alerts').push(payload)
+    if "timestamp" not in payload:
+        payload["timestamp"] = int(time.time() * 1000)
+    firebase_push(firebase_layout.record_path("alerts", device_id, payload["timestamp"]), payload, "alerts")
+    write_alert_pre_roll(device_id, payload["timestamp"])
     
     # Store in memory
     if len(device_data[device_id]["alerts"]) > 20:
         device_data[device_id]["alerts"].pop(0)
     device_data[device_id]["alerts"].append(payload)
     
-    print(f"Alert received from device {device_id}: {payload}")
+    log.info("alert_received", device_id=device_id, payload=payload)
 
 # Process image metadata
 def process_image_metadata(device_id, payload):
     # Store metadata in Firebase
-    db.reference(f'devices/{device_id}/images').push(payload)
+    if "timestamp" not in payload:
+        payload["timestamp"] = int(time.time() * 1000)
+    firebase_push(firebase_layout.record_path("images", device_id, payload["timestamp"]), payload, "images")
     
     # Store in memory
     if len(device_data[device_id]["images"]) > 10:
         device_data[device_id]["images"].pop(0)
     device_data[device_id]["images"].append(payload)
     
-    print(f"Image metadata received from device {device_id}: {payload}")
+    log.info("image_metadata_received", device_id=device_id, payload=payload)
 
 # Process vital signs and detect anomalies
 def process_vitals_task(task):
-    device_id = task['device_id']
-    payload = task['payload']
-    
-    # Extract vital signs
-    heart_rate = payload.get("heart_rate", 0)
-    spo2 = payload.get("spo2", 0)
-    timestamp = payload.get("timestamp", int(time.time() * 1000))
-    
-    # Basic validation
-    if heart_rate <= 0 and spo2 <= 0:
-        print(f"Invalid vital signs from device {device_id}: HR={heart_rate}, SpO2={spo2}")
-        return
-    
-    # Store in memory for recent history
-    if len(device_data[device_id]["heart_rate"]) > 100:
-        device_data[device_id]["heart_rate"].pop(0)
-    if len(device_data[device_id]["spo2"]) > 100:
-        device_data[device_id]["spo2"].pop(0)
-    
-    if heart_rate > 0:
-        device_data[device_id]["heart_rate"].append(heart_rate)
-    if spo2 > 0:
-        device_data[device_id]["spo2"].append(spo2)
-        
-    device_data[device_id]["last_update"] = time.time()
+    process_vitals_batch([task])
+
+# Process a batch of vitals tasks; threshold rules are evaluated for the whole
+# batch in one vectorized pass
+def process_vitals_batch(tasks):
+    for device_id, heart_rate, spo2, timestamp, features in record_vitals(tasks):
+        # Then run ML-based anomaly detection if we have enough data points
+        detect_bpm_anomaly(device_id, heart_rate, timestamp, features["bpm"])
+        detect_spo2_anomaly(device_id, spo2, timestamp, features["spo2"])
+
+# A reading is a finite number; 0 (or less) means the sensor had none
+def valid_reading(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+# Validate a batch of vitals tasks, add them to the devices' history, check
+# the threshold rules and store them. Returns the accepted samples as
+# (device_id, heart_rate, spo2, timestamp, features) for the anomaly models,
+# where features maps "bpm" and "spo2" to the model input built from the
+# history as it stood when that sample was added (None if there is none).
+def record_vitals(tasks):
+    samples = []
+    features = []
+    for task in tasks:
+        device_id = task['device_id']
+        payload = task['payload']
+        try:
+            # Handed off to another cluster node while queued
+            if device_id not in device_data:
+                if cluster is not None and cluster.forward(device_id, "health/vitals", json.dumps(payload)):
+                    metric_cluster_forwarded.inc()
+                    continue
+                device_data[device_id] = new_device_entry(device_id)
+            
+            # Extract vital signs
+            heart_rate = payload.get("heart_rate", 0)
+            spo2 = payload.get("spo2", 0)
+            timestamp = payload.get("timestamp", int(time.time() * 1000))
+            
+            # Basic validation
+            if not (valid_reading(heart_rate) and valid_reading(spo2)) or (heart_rate <= 0 and spo2 <= 0):
+                metric_dropped.labels("invalid_vitals").inc()
+                log.warning("vitals_invalid", device_id=device_id, heart_rate=heart_rate, spo2=spo2)
+                continue
+            # Only a device clock tells how long the sample took to get here
+            if task.get('device_clock'):
+                metric_device_lag.labels(device_id).set(time.time() - timestamp / 1000.0)
+            
+            # Store in memory for recent history
+            if len(device_data[device_id]["heart_rate"]) > 100:
+                device_data[device_id]["heart_rate"].pop(0)
+            if len(device_data[device_id]["spo2"]) > 100:
+                device_data[device_id]["spo2"].pop(0)
+            
+            if heart_rate > 0:
+                device_data[device_id]["heart_rate"].append(heart_rate)
+            if spo2 > 0:
+                device_data[device_id]["spo2"].append(spo2)
+                
+            device_data[device_id]["last_update"] = time.time()
+        except Exception as e:
+            metric_errors.labels("vitals").inc()
+            log.exception("vitals_failed", device_id=device_id, error=str(e))
+            continue
+        samples.append((device_id, heart_rate, spo2, timestamp))
+        # The models see the history up to this sample, not the batch's later ones
+        features.append({"bpm": sample_features(device_id, "bpm", heart_rate),
+                         "spo2": sample_features(device_id, "spo2", spo2)})
     
     # First check for immediate threshold-based anomalies
-    if heart_rate > 0:
-        if heart_rate > config["anomaly_thresholds"]["bpm_high"]:
-            alert_data = {
-                "device_id": device_id,
-                "alert_type": "threshold",
-                "source": "bpm_high",
-                "value": float(heart_rate),
-                "threshold": config["anomaly_thresholds"]["bpm_high"],
+    try:
+        for alert_data in threshold_engine.evaluate(samples):
+            send_alert(alert_data["device_id"], alert_data)
+    except Exception as e:
+        metric_errors.labels("threshold_rules").inc()
+        log.exception("threshold_rules_failed", error=str(e))
+    
+    for device_id, heart_rate, spo2, timestamp in samples:
+        # Store vital data in Firebase
+        try:
+            vital_data = {
                 "timestamp": timestamp
             }
-            send_alert(device_id, alert_data)
-            print(f"BPM high threshold alert: {heart_rate} > {config['anomaly_thresholds']['bpm_high']}")
             
-        elif heart_rate < config["anomaly_thresholds"]["bpm_low"]:
-            alert_data = {
-                "device_id": device_id,
-                "alert_type": "threshold",
-                "source": "bpm_low",
-                "value": float(heart_rate),
-                "threshold": config["anomaly_thresholds"]["bpm_low"],
-                "timestamp": timestamp
-            }
-            send_alert(device_id, alert_data)
-            print(f"BPM low threshold alert: {heart_rate} < {config['anomaly_thresholds']['bpm_low']}")
-    
-    if spo2 > 0 and spo2 < config["anomaly_thresholds"]["spo2_low"]:
-        alert_data = {
-            "device_id": device_id,
-            "alert_type": "threshold",
-            "source": "spo2_low",
-            "value": float(spo2),
-            "threshold": config["anomaly_thresholds"]["spo2_low"],
-            "timestamp": timestamp
-        }
-        send_alert(device_id, alert_data)
-        print(f"SpO2 low threshold alert: {spo2} < {config['anomaly_thresholds']['spo2_low']}")
-    
-    # Then run ML-based anomaly detection if we have enough data points
-    detect_bpm_anomaly(device_id, heart_rate, timestamp)
-    detect_spo2_anomaly(device_id, spo2, timestamp)
-    
-    # Store vital data in Firebase
-    try:
-        vital_data = {
-            "timestamp": timestamp
-        }
-        
-        if heart_rate > 0:
-            vital_data["heart_rate"] = float(heart_rate)
-        if spo2 > 0:
-            vital_data["spo2"] = float(spo2)
-        
-        # Store in Firebase
-        db.reference(f'devices/{device_id}/vitals').push(vital_data)
-    except Exception as e:
-        print(f"Error storing vitals in Firebase: {e}")
+            if heart_rate > 0:
+                vital_data["heart_rate"] = float(heart_rate)
+            if spo2 > 0:
+                vital_data["spo2"] = float(spo2)
+            
+            # Store in Firebase unless the persistence policy holds it back,
+            # and fold into the rollups
+            if persistence is None or persistence.should_write(device_id, timestamp, vital_data):
+                firebase_push(firebase_layout.record_path("vitals", device_id, timestamp), vital_data, "vitals")
+            rollups.add(device_id, timestamp, {
+                "heart_rate": vital_data.get("heart_rate"),
+                "spo2": vital_data.get("spo2")
+            })
+        except Exception as e:
+            metric_errors.labels("firebase_vitals").inc()
+            log.error("firebase_vitals_failed", device_id=device_id, error=str(e))
+    return [sample + (sample_features,) for sample, sample_features in zip(samples, features)]
 
-# Detect BPM anomalies
-def detect_bpm_anomaly(device_id, heart_rate, timestamp):
-    if heart_rate <= 0 or "bpm_model" not in models or not models["bpm_model"]:
-        return
+# Run a vitals model, serving repeated feature vectors from the inference
+# cache. In-process detectors are cheap (and stateful), so they bypass it.
+def classify_cached(model_name, features):
+    if getattr(models[model_name], "in_process", False):
+        with metric_classify.labels(model_name).time(), timers.time(f"classify.{model_name}"), \
+                model_registry.use(model_name) as model:
+            return model.classify(features)
         
+    res = inference_cache.get(model_name, features)
+    if res is not None:
+        return res
+    return classify_model(model_name, features)
+
+# Run a .eim vitals model by `deadline` (see InferenceGuard.classify) and
+# cache the result, unless the model was swapped while it ran
+def classify_model(model_name, features, deadline=None):
+    model = models.get(model_name)
+    start = time.perf_counter()
+    with timers.time(f"classify.{model_name}"):
+        res = inference_guard.classify(model_name, features, deadline)
+    elapsed = time.perf_counter() - start
+    metric_classify.labels(model_name).observe(elapsed)
+    if model is models.get(model_name):
+        inference_cache.put(model_name, features, res, elapsed)
+    return res
+
+VITALS_MODELS = anomaly_model.VITALS_MODELS
+
+# Features for the anomaly model of `source` from the device's recent
+# history, or None if the model isn't loaded or there isn't enough data yet
+def anomaly_features(device_id, source, value):
+    model_name, series = VITALS_MODELS[source]
+    if value <= 0 or not models.get(model_name):
+        return None
+    start = time.perf_counter()
+    features = anomaly_model.features(device_data[device_id][series], value)
+    if features is not None:
+        metric_feature_build.labels(model_name).observe(time.perf_counter() - start)
+    return features
+
+# anomaly_features() for a sample just added, or None if they can't be built
+def sample_features(device_id, source, value):
     try:
-        # We need at least a few data points for meaningful detection
-        if len(device_data[device_id]["heart_rate"]) < 5:
-            return
-            
-        # Prepare data for BPM model - use only the 2 features the model expects
-        # Feature 1: Current heart rate
-        # Feature 2: Average of recent heart rates (excluding current)
-        recent_bpm = device_data[device_id]["heart_rate"][-10:]
-        avg_recent_bpm = sum(recent_bpm[:-1]) / len(recent_bpm[:-1]) if len(recent_bpm) > 1 else heart_rate
-        
-        # Format data for Edge Impulse model - only 2 features as expected
-        bpm_data = [float(heart_rate), float(avg_recent_bpm)]
-        
-        # Run inference with Edge Impulse model
-        res = models["bpm_model"].classify(bpm_data)
-        
-        # Process the result based on the model output format
-        bpm_anomaly = False
-        anomaly_score = 0
-        
-        # Check if there's a direct anomaly score
-        if "anomaly" in res["result"]:
-            anomaly_score = res["result"]["anomaly"]
-            bpm_anomaly = anomaly_score > 0.5  # Threshold
-        # Or if it's in the classification dict
-        elif "classification" in res["result"] and "anomaly" in res["result"]["classification"]:
-            anomaly_score = res["result"]["classification"]["anomaly"]
-            bpm_anomaly = anomaly_score > 0.5  # Threshold
-        
-        if bpm_anomaly:
-            alert_data = {
-                "device_id": device_id,
-                "alert_type": "anomaly",
-                "source": "bpm",
-                "value": float(heart_rate),
-                "anomaly_score": float(anomaly_score),
-                "timestamp": timestamp
-            }
-            
-            # Send alert to MQTT and Firebase
-            send_alert(device_id, alert_data)
-            print(f"BPM anomaly detected: {heart_rate} (score: {anomaly_score})")
+        return anomaly_features(device_id, source, value)
     except Exception as e:
-        print(f"Error in BPM anomaly detection: {e}")
-        import traceback
-        traceback.print_exc()
+        metric_errors.labels(f"{source}_detection").inc()
+        log.exception(f"{source}_detection_failed", device_id=device_id, error=str(e))
+        return None
 
-# Detect SpO2 anomalies
-def detect_spo2_anomaly(device_id, spo2, timestamp):
-    if spo2 <= 0 or "spo2_model" not in models or not models["spo2_model"]:
+# Alert for an anomaly model result, or None if it isn't an anomaly
+def anomaly_alert(device_id, source, value, timestamp, res):
+    anomaly_score = anomaly_model.anomaly_score(res)
+    if not anomaly_model.is_anomaly(anomaly_score):
+        return None
+    return anomaly_model.alert(device_id, source, value, anomaly_score, timestamp)
+
+# Run the model on a sample's features and send an alert if it flags an
+# anomaly
+def detect_anomaly(device_id, source, value, timestamp, features):
+    if features is None:
         return
-        
     try:
-        # We need at least a few data points for meaningful detection
-        if len(device_data[device_id]["spo2"]) < 5:
-            return
-            
-        # Prepare data for SpO2 model - use only the 2 features the model expects
-        # Feature 1: Current SpO2
-        # Feature 2: Average of recent SpO2 (excluding current)
-        recent_spo2 = device_data[device_id]["spo2"][-10:]
-        avg_recent_spo2 = sum(recent_spo2[:-1]) / len(recent_spo2[:-1]) if len(recent_spo2) > 1 else spo2
-        
-        # Format data for Edge Impulse model - only 2 features as expected
-        spo2_data = [float(spo2), float(avg_recent_spo2)]
-        
-        # Run inference with Edge Impulse model
-        res = models["spo2_model"].classify(spo2_data)
-        
-        # Process the result based on the model output format
-        spo2_anomaly = False
-        anomaly_score = 0
-        
-        # Check if there's a direct anomaly score
-        if "anomaly" in res["result"]:
-            anomaly_score = res["result"]["anomaly"]
-            spo2_anomaly = anomaly_score > 0.5  # Threshold
-        # Or if it's in the classification dict
-        elif "classification" in res["result"] and "anomaly" in res["result"]["classification"]:
-            anomaly_score = res["result"]["classification"]["anomaly"]
-            spo2_anomaly = anomaly_score > 0.5  # Threshold
-        
-        if spo2_anomaly:
-            alert_data = {
-                "device_id": device_id,
-                "alert_type": "anomaly",
-                "source": "spo2",
-                "value": float(spo2),
-                "anomaly_score": float(anomaly_score),
-                "timestamp": timestamp
-            }
-            
+        res = classify_cached(VITALS_MODELS[source][0], features)
+        alert_data = anomaly_alert(device_id, source, value, timestamp, res)
+        if alert_data:
             # Send alert to MQTT and Firebase
             send_alert(device_id, alert_data)
-            print(f"SpO2 anomaly detected: {spo2} (score: {anomaly_score})")
+    except InferenceUnavailable:
+        # Timed out or circuit open; counted by inference_guard, and the
+        # threshold rules have already run
+        pass
     except Exception as e:
-        print(f"Error in SpO2 anomaly detection: {e}")
-        import traceback
-        traceback.print_exc()
+        metric_errors.labels(f"{source}_detection").inc()
+        log.exception(f"{source}_detection_failed", device_id=device_id, error=str(e))
+
+# Detect BPM anomalies
+def detect_bpm_anomaly(device_id, heart_rate, timestamp, features):
+    detect_anomaly(device_id, "bpm", heart_rate, timestamp, features)
+
+# Detect SpO2 anomalies
+def detect_spo2_anomaly(device_id, spo2, timestamp, features):
+    detect_anomaly(device_id, "spo2", spo2, timestamp, features)
         
 # Task processor thread
 def task_processor():
-    print("Starting task processor thread...")
+    log.info("task_processor_started")
     while True:
+        tasks = []
         try:
-            # Get a task from the queue
-            task = processing_queue.get(block=True, timeout=1)
+            # Get a task from the queue, then drain whatever else is already
+            # waiting so vitals can be evaluated in batches
+            tasks.append(processing_queue.get(block=True, timeout=1))
+            while len(tasks) < config["vitals_batch_size"]:
+                try:
+                    tasks.append(processing_queue.get_nowait())
+                except queue.Empty:
+                    break
+            now = time.perf_counter()
+            for task in tasks:
+                if 'enqueued_at' in task:
+                    metric_queue_wait.labels(task['type']).observe(now - task['enqueued_at'])
             
-            # Process based on task type
-            if task['type'] == 'audio':
-                process_audio_task(task)
-            elif task['type'] == 'vitals':
-                process_vitals_task(task)
+            # Process based on task type, keeping runs of vitals together
+            vitals_batch = []
+            for task in tasks:
+                if task['type'] == 'vitals':
+                    vitals_batch.append(task)
+                    continue
+                if vitals_batch:
+                    process_vitals_batch(vitals_batch)
+                    vitals_batch = []
+                if task['type'] == 'audio':
+                    process_audio_task(task)
+            if vitals_batch:
+                process_vitals_batch(vitals_batch)
                 
-            # Mark task as done
-            processing_queue.task_done()
+            # Mark tasks as done
+            for _ in tasks:
+                processing_queue.task_done()
             
         except queue.Empty:
             # No tasks available, just continue
             pass
         except Exception as e:
-            print(f"Error processing task: {e}")
-            import traceback
-            traceback.print_exc()
+            metric_errors.labels("task_processor").inc()
+            log.exception("task_failed", error=str(e))
             
-            # Mark task as done even on error
+            # Mark tasks as done even on error
             try:
-                processing_queue.task_done()
+                for _ in tasks:
+                    processing_queue.task_done()
             except:
                 pass
                 
@@ -739,6 +1520,23 @@ def get_device_alerts(device_id):
     else:
         return jsonify({"error": "Device not found"}), 404
 
+# List a device's images from the image index, optionally by time range
+@app.route('/images/<device_id>', methods=['GET'])
+def get_device_images(device_id):
+    try:
+        start = request.args.get('start_time', None)
+        end = request.args.get('end_time', None)
+        limit = request.args.get('limit', None)
+        images = image_store.list(
+            device_id,
+            int(start) if start else None,
+            int(end) if end else None,
+            int(limit) if limit else None
+        )
+    except ValueError:
+        return jsonify({"error": "Invalid time or limit parameter"}), 400
+    return jsonify({"device_id": device_id, "images": images}), 200
+
 # Add API endpoint to get vitals history for a device
 @app.route('/vitals_history/<device_id>', methods=['GET'])
 def get_vitals_history(device_id):
@@ -771,15 +1569,188 @@ def get_vitals_history(device_id):
     else:
         return jsonify({"error": "Device not found"}), 404
 
-# Main function to start the server
-def main():
-    print("Starting Health Monitoring Server...")
+# Pre-aggregated vitals for a time range, read from the rollup nodes:
+# GET /device/<id>/rollups?resolution=minute&start=<ms>&end=<ms>
+@app.route('/device/<device_id>/rollups', methods=['GET'])
+def get_device_rollups(device_id):
+    resolution = request.args.get('resolution', 'minute')
+    if resolution not in config["rollups"]["resolutions"]:
+        return jsonify({"error": f"resolution must be one of {config['rollups']['resolutions']}"}), 400
+    try:
+        end = int(request.args.get('end', time.time() * 1000))
+        start = int(request.args.get('start', end - 3600 * 1000))
+    except ValueError:
+        return jsonify({"error": "Invalid start or end parameter"}), 400
+    if start > end:
+        return jsonify({"error": "start must not be after end"}), 400
+    
+    first_key, last_key = firebase_layout.bucket_range(start, end, resolution)
+    query = db.reference(firebase_layout.rollup_path(device_id, resolution)).order_by_key()
+    buckets = query.start_at(first_key).end_at(last_key).get() or {}
+    return jsonify({
+        "device_id": device_id,
+        "resolution": resolution,
+        "buckets": [dict(rollup, key=key) for key, rollup in buckets.items()]
+    }), 200
+
+# Device id of a raw MQTT payload, for routing it to a worker without
+# decoding the whole message
+DEVICE_ID_PATTERN = re.compile(rb'"device_id"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)')
+
+def device_key(body):
+    match = DEVICE_ID_PATTERN.search(body)
+    if match:
+        try:
+            return json.loads(match.group(1))
+        except ValueError:
+            pass
+    return "unknown"
+
+# Start-up of a worker process: its own Firebase app, models and MQTT
+# connection (for publishing alerts), and the threads the parent would run
+def init_worker(index):
+    global client, device_data
+    device_data = {}  # A worker forked again inherits the parent's view
+    device_store.own(index)
+    initialize_firebase()
+    load_models()
+    if config["model_reload"]["enabled"]:
+        model_registry.start()
+    client = connect_mqtt(subscribe=False)
+    client.loop_start()
+    for target in (cleanup_old_data, rollup_flusher):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    log.info("worker_ready", index=index)
+
+# Handle a batch of items routed to this worker: MQTT messages as they came
+# off the broker, and audio tasks. The devices' alerts and images are
+# published to shared memory at the end of the batch.
+def handle_worker_batch(items):
+    now = time.perf_counter()
+    vitals_batch = []
+    for item in items:
+        metric_queue_wait.labels(item['type']).observe(now - item['enqueued_at'])
+        if item['type'] == 'message':
+            task = handle_message(item['topic'], item['body'])
+            if task is not None:
+                vitals_batch.append(task)
+        elif item['type'] == 'audio':
+            process_audio_task(item)
+    if vitals_batch:
+        process_vitals_batch(vitals_batch)
+    for device_id in set(item['device_id'] for item in items):
+        if device_id in device_data:
+            device_store.publish(device_id, device_data[device_id])
+
+def stop_worker():
+    flush_rollups()
+    model_registry.stop()
+    unload_models()
+    structured_log.flush()
+
+# Fork the worker processes. The parent keeps the MQTT subscription and the
+# HTTP server; device_data becomes a read-only view of the shared memory and
+# processing_queue routes tasks to the workers.
+def configure_workers(count):
+    global device_store, worker_pool, device_data, processing_queue
+    options = config["workers"]
+    options["count"] = count
+    device_store = SharedVitals(count, options["max_devices_per_worker"], options["history"], options["meta_bytes"])
+    worker_pool = WorkerPool(
+        count,
+        init_worker,
+        handle_worker_batch,
+        finish=stop_worker,
+        on_exit=device_store.clear,
+        batch_size=options["batch_size"],
+        queue_size=options["queue_size"],
+        log=log
+    )
+    worker_pool.start()
+    device_data = DeviceView(device_store)
+    processing_queue = worker_pool
+    log.info("workers_started", count=count)
+
+def configure_cluster(enabled, node_id=None):
+    global cluster, handoff_loader
+    config["cluster"]["enabled"] = enabled
+    if not enabled:
+        cluster = None
+        return
+    cluster = Cluster(
+        config["cluster"]["group"],
+        node_id=node_id,
+        heartbeat_seconds=config["cluster"]["heartbeat_seconds"],
+        on_change=on_cluster_change,
+        on_handoff=on_handoff,
+        log=log
+    )
+    if handoff_loader is None:
+        handoff_loader = ThreadPoolExecutor(4, thread_name_prefix="handoff")
+    metrics.registry.gauge("cluster_members", "Live nodes in this node's cluster").set_function(
+        lambda: len(cluster.members))
+    log.info("cluster_configured", group=config["cluster"]["group"], node_id=cluster.node_id)
+
+def configure_capture(path):
+    global capture
+    config["capture"]["path"] = path
+    if capture is not None:
+        capture.close()
+        capture = None
+    if path:
+        options = config["capture"]
+        capture = TrafficCapture(path, options["max_bytes"], options["flush_interval"], log=log)
+        log.info("capture_started", path=path)
+
+# Command line options shared by the threaded and asyncio runtimes
+def build_arg_parser(description="Health Monitoring Server"):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--backend", choices=["live", "memory"], default=config["backend"],
+                        help="use live services or in-process fakes for load testing")
+    parser.add_argument("--cluster", action="store_true", default=config["cluster"]["enabled"],
+                        help="share device topics with other edge nodes")
+    parser.add_argument("--node-id", default=config["cluster"]["node_id"],
+                        help="this node's cluster id (default: hostname)")
+    parser.add_argument("--capture", metavar="PATH", default=config["capture"]["path"],
+                        help="append inbound MQTT messages and uploads to PATH, for replay.py")
+    return parser
+
+# Configure the backends and start the services every runtime needs
+def setup(args):
+    configure_backends(args.backend)
+    configure_cluster(args.cluster, args.node_id)
+    configure_capture(getattr(args, "capture", None))
+    
+    # Fork the device and image workers before any other thread is running
+    workers = getattr(args, "workers", 0)
+    if workers:
+        configure_workers(workers)
+    if config["image_pipeline"]["enabled"]:
+        image_pipeline.start()
+    image_relay.start()
     
     # Initialize Firebase
     initialize_firebase()
     
-    # Load Edge Impulse ML models
-    load_models()
+    # Load Edge Impulse ML models; in worker mode each worker loads its own
+    if not workers:
+        load_models()
+        if config["model_reload"]["enabled"]:
+            model_registry.start()
+
+# Main function to start the server
+def main():
+    parser = build_arg_parser()
+    parser.add_argument("--workers", type=int, default=config["workers"]["count"],
+                        help="handle devices in N worker processes (0: in this process)")
+    args = parser.parse_args()
+    if args.workers and args.cluster:
+        parser.error("--workers can't be combined with --cluster")
+    
+    log.info("server_starting")
+    setup(args)
     
     # Connect to MQTT broker
     global client
@@ -789,18 +1760,27 @@ def main():
     mqtt_thread = threading.Thread(target=client.loop_forever)
     mqtt_thread.daemon = True
     mqtt_thread.start()
+    if cluster is not None:
+        cluster.start()
     
-    # Start task processor thread
-    processor_thread = threading.Thread(target=task_processor)
-    processor_thread.daemon = True
-    processor_thread.start()
-    
-    # Start cleanup thread
-    cleanup_thread = threading.Thread(target=cleanup_old_data)
-    cleanup_thread.daemon = True
-    cleanup_thread.start()
+    # In worker mode the workers process the tasks, clean up and flush rollups
+    if worker_pool is None:
+        # Start task processor thread
+        processor_thread = threading.Thread(target=task_processor)
+        processor_thread.daemon = True
+        processor_thread.start()
+        
+        # Start cleanup thread
+        cleanup_thread = threading.Thread(target=cleanup_old_data)
+        cleanup_thread.daemon = True
+        cleanup_thread.start()
+        
+        # Start rollup flusher thread
+        rollup_thread = threading.Thread(target=rollup_flusher)
+        rollup_thread.daemon = True
+        rollup_thread.start()
     
-    print(f"Starting HTTP server on port {config['http_server_port']}...")
+    log.info("http_starting", port=config['http_server_port'])
     
     # Start Flask application
     app.run(host='0.0.0.0', port=config['http_server_port'], debug=False, threaded=True)
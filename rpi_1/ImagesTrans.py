@@ -1,40 +1,337 @@
 import os
+import json
 import time
+import shlex
+import threading
 import subprocess
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 SOURCE_DIR = "images"
+# Draft3.py links each new upload here when its relay to rpi_2 is disabled
+OUTBOX_DIR = os.path.join(SOURCE_DIR, "outbox")
 DEST_IP = "192.168.58.37"
 DEST_USER = "ecelab5"
 DEST_DIR = "/home/ecelab5/Desktop/smart_health/images"
 
+IMAGE_EXTENSIONS = ('.jpg', '.png', '.jpeg')
+QUEUE_PATH = os.path.join(SOURCE_DIR, "replication_queue.jsonl")
+STABLE_SECONDS = 0.5     # A file without close-write events must keep its size this long
+BATCH_SIZE = 64          # Files per rsync invocation
+BATCH_WAIT = 0.2         # Collect files this long before shipping a partial batch
+STREAMS = 3              # Parallel rsync streams, multiplexed over one SSH connection
+RETRY_DELAY = 5.0        # Back-off after a failed batch, doubled up to RETRY_MAX
+RETRY_MAX = 60.0
+REPORT_INTERVAL = 30.0
+
+# One SSH master connection is opened on first use and kept for ControlPersist
+# seconds; every rsync stream runs as a channel on it, so there is no
+# handshake per transfer
+SSH_OPTIONS = [
+    "-o", "ControlMaster=auto",
+    "-o", "ControlPath=~/.ssh/cm-%r@%h:%p",
+    "-o", "ControlPersist=600",
+    "-o", "ServerAliveInterval=15",
+    "-o", "BatchMode=yes",
+]
+
+
+# Resumable replication queue: an append-only journal of "add" and "done"
+# records, replayed on start so files queued before a crash or reboot are
+# still shipped. The journal is compacted once it is mostly done records.
+class ReplicationQueue:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.pending = {}      # path -> time first seen
+        self.in_flight = set()
+        self.done_records = 0
+        self._load()
+        self.journal = open(self.path, 'a')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line after a crash
+                if record["op"] == "add":
+                    self.pending[record["path"]] = record["seen"]
+                else:
+                    self.pending.pop(record["path"], None)
+        # Drop entries whose file has since been removed locally
+        self.pending = {p: seen for p, seen in self.pending.items() if os.path.exists(p)}
+        self._rewrite()
+
+    def _rewrite(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            for path, seen in self.pending.items():
+                f.write(json.dumps({"op": "add", "path": path, "seen": seen}) + '\n')
+        os.replace(tmp_path, self.path)
+        self.done_records = 0
+
+    def _append(self, records):
+        self.journal.write(''.join(json.dumps(r) + '\n' for r in records))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def add(self, path, seen):
+        with self.lock:
+            if path in self.pending:
+                return
+            self.pending[path] = seen
+            self._append([{"op": "add", "path": path, "seen": seen}])
+            self.ready.notify()
+
+    # Wait for files to ship: returns up to `limit` (path, seen) pairs, waiting
+    # up to `wait` seconds after the first one for the batch to fill
+    def take(self, limit, wait):
+        with self.lock:
+            while len(self.pending) == len(self.in_flight):
+                self.ready.wait()
+            if len(self.pending) - len(self.in_flight) < limit:
+                self.ready.wait(wait)
+            batch = []
+            for path, seen in self.pending.items():
+                if path not in self.in_flight:
+                    batch.append((path, seen))
+                    self.in_flight.add(path)
+                    if len(batch) >= limit:
+                        break
+            return batch
+
+    def complete(self, paths):
+        with self.lock:
+            for path in paths:
+                self.pending.pop(path, None)
+                self.in_flight.discard(path)
+            self._append([{"op": "done", "path": path} for path in paths])
+            self.done_records += len(paths)
+            if self.done_records > 1000 and self.done_records > 4 * len(self.pending):
+                self.journal.close()
+                self._rewrite()
+                self.journal = open(self.path, 'a')
+
+    def release(self, paths):
+        with self.lock:
+            for path in paths:
+                self.in_flight.discard(path)
+            self.ready.notify_all()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+
+class TransferStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+        self.lags = []
+
+    def record(self, files, size, elapsed, lags):
+        with self.lock:
+            self.files += files
+            self.bytes += size
+            self.busy_seconds += elapsed
+            self.lags.extend(lags)
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+
+    # Return and reset the counters for the last reporting interval
+    def take(self):
+        with self.lock:
+            snapshot = (self.files, self.bytes, self.failures, self.busy_seconds, sorted(self.lags))
+            self.files = self.bytes = self.failures = 0
+            self.busy_seconds = 0.0
+            self.lags = []
+        return snapshot
+
+
+# Ships queued outbox files with rsync in batches, then removes them from the
+# outbox (they are hard links; the blob itself stays in the store)
+class Replicator:
+    def __init__(self, queue, streams=STREAMS, batch_size=BATCH_SIZE):
+        self.queue = queue
+        self.streams = streams
+        self.batch_size = batch_size
+        self.stats = TransferStats()
+        self.ssh_command = ' '.join(shlex.quote(arg) for arg in ["ssh"] + SSH_OPTIONS)
+
+    def start(self):
+        threads = [threading.Thread(target=self._stream, name=f"replication-{i}") for i in range(self.streams)]
+        threads.append(threading.Thread(target=self._report, name="replication-report"))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def _stream(self):
+        delay = RETRY_DELAY
+        while True:
+            batch = self.queue.take(self.batch_size, BATCH_WAIT)
+            if self._ship(batch):
+                delay = RETRY_DELAY
+            else:
+                self.stats.failed()
+                time.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX)
+
+    def _ship(self, batch):
+        present = [(path, seen) for path, seen in batch if os.path.exists(path)]
+        missing = [path for path, _ in batch if not os.path.exists(path)]
+        if missing:
+            self.queue.complete(missing)
+        if not present:
+            return True
+
+        relative = [os.path.relpath(path, OUTBOX_DIR) for path, _ in present]
+        command = [
+            "rsync", "--archive", "--partial", "--from0", "--files-from=-",
+            "-e", self.ssh_command,
+            OUTBOX_DIR + "/", f"{DEST_USER}@{DEST_IP}:{DEST_DIR}/"
+        ]
+        start = time.monotonic()
+        try:
+            result = subprocess.run(command, input='\0'.join(relative).encode(),
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except OSError as e:
+            print(f"? rsync could not be started: {e}")
+            self.queue.release([path for path, _ in present])
+            return False
+        elapsed = time.monotonic() - start
+
+        paths = [path for path, _ in present]
+        if result.returncode != 0:
+            print(f"? Failed to transfer batch of {len(paths)}: {result.stderr.decode(errors='replace').strip()}")
+            self.queue.release(paths)
+            return False
+
+        now = time.time()
+        size = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+        self.stats.record(len(paths), size, elapsed, [now - seen for _, seen in present])
+        self.queue.complete(paths)
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return True
+
+    def _report(self):
+        while True:
+            time.sleep(REPORT_INTERVAL)
+            files, size, failures, busy, lags = self.stats.take()
+            backlog = len(self.queue)
+            if not files and not failures and not backlog:
+                continue
+            rate = size / REPORT_INTERVAL / 1024.0
+            p50 = lags[len(lags) // 2] if lags else 0.0
+            p95 = lags[int(len(lags) * 0.95)] if lags else 0.0
+            print(f"?? Replicated {files} files ({size / 1024.0:.0f} KiB, {rate:.1f} KiB/s, "
+                  f"{busy:.1f}s in rsync), lag p50 {p50:.2f}s p95 {p95:.2f}s, "
+                  f"{failures} failed batches, {backlog} queued")
+
+
+# Collects new images and queues each one once it is complete. Atomic renames
+# (how the server writes blobs) and close-write events are final; files seen
+# only through a created/modified event must keep the same size for
+# STABLE_SECONDS first.
 class ImageHandler(FileSystemEventHandler):
-    def on_created(self, event):
-        if event.is_directory or not event.src_path.lower().endswith(('.jpg', '.png', '.jpeg')):
+    def __init__(self, queue):
+        self.queue = queue
+        self.lock = threading.Lock()
+        self.settling = {}  # path -> (size, time the size was last seen changing, first seen)
+
+    @staticmethod
+    def _is_image(path):
+        return path.lower().endswith(IMAGE_EXTENSIONS)
+
+    def _ready(self, path, seen=None):
+        with self.lock:
+            entry = self.settling.pop(path, None)
+        self.queue.add(path, seen or (entry[2] if entry else time.time()))
+
+    def _watch(self, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
             return
-        
-        time.sleep(0.5)  # Wait to ensure the image is fully saved
+        now = time.time()
+        with self.lock:
+            entry = self.settling.get(path)
+            if entry is None or entry[0] != size:
+                self.settling[path] = (size, now, entry[2] if entry else now)
+
+    def on_created(self, event):
+        if not event.is_directory and self._is_image(event.src_path):
+            self._watch(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory and self._is_image(event.src_path):
+            self._watch(event.src_path)
+
+    def on_closed(self, event):
+        if not event.is_directory and self._is_image(event.src_path):
+            self._ready(event.src_path)
 
-        filename = os.path.basename(event.src_path)
-        destination = f"{DEST_USER}@{DEST_IP}:{DEST_DIR}/{filename}"
+    def on_moved(self, event):
+        if not event.is_directory and self._is_image(event.dest_path):
+            self._ready(event.dest_path)
+
+    # Queue files whose size has not changed for STABLE_SECONDS
+    def settle(self):
+        now = time.time()
+        with self.lock:
+            stable = [path for path, (size, changed, _) in self.settling.items()
+                      if now - changed >= STABLE_SECONDS]
+        for path in stable:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                with self.lock:
+                    self.settling.pop(path, None)
+                continue
+            with self.lock:
+                entry = self.settling.get(path)
+            if entry is not None and entry[0] == size:
+                self._ready(path)
+            else:
+                self._watch(path)
 
-        result = subprocess.run(["scp", event.src_path, destination])
-        
-        if result.returncode == 0:
-            print(f"? Transferred: {filename}")
-        else:
-            print(f"? Failed to transfer: {filename}")
 
 if __name__ == "__main__":
+    os.makedirs(OUTBOX_DIR, exist_ok=True)
+    queue = ReplicationQueue(QUEUE_PATH)
+    # Pick up anything spooled while this script was not running
+    for name in os.listdir(OUTBOX_DIR):
+        path = os.path.join(OUTBOX_DIR, name)
+        if ImageHandler._is_image(path):
+            queue.add(path, os.path.getmtime(path))
+    if len(queue):
+        print(f"?? Resuming {len(queue)} queued images")
+    replicator = Replicator(queue)
+    replicator.start()
+
+    handler = ImageHandler(queue)
     observer = Observer()
-    observer.schedule(ImageHandler(), path=SOURCE_DIR, recursive=False)
+    observer.schedule(handler, path=OUTBOX_DIR)
     observer.start()
     print("?? Watching for new images...")
 
     try:
         while True:
-            time.sleep(1)
+            time.sleep(STABLE_SECONDS / 2)
+            handler.settle()
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Inputs and outputs of the BPM/SpO2 anomaly models.
+#
+# Both models take two features: the newest reading and the mean of the
+# readings before it in a short window. Anything that scores vitals against
+# these models (the server, offline tools) builds them here, so a model sees
+# the same features everywhere.
+
+MIN_HISTORY = 5     # readings needed before a model is run
+WINDOW = 10         # readings the average is taken over, including the newest
+THRESHOLD = 0.5     # anomaly score above which an alert is raised
+
+# Vitals anomaly models: alert source -> (model, device_data series)
+VITALS_MODELS = {
+    "bpm": ("bpm_model", "heart_rate"),
+    "spo2": ("spo2_model", "spo2")
+}
+
+
+# Model input for the newest reading. `history` is the device's series and
+# already ends with `value`; None until there are MIN_HISTORY readings.
+def features(history, value):
+    if len(history) < MIN_HISTORY:
+        return None
+    previous = history[-WINDOW:][:-1]
+    average = sum(previous) / len(previous) if previous else value
+    return [float(value), float(average)]
+
+
+# Anomaly score from a classify() result, or None if the model reported none.
+# It is either a top-level anomaly score or an "anomaly" class.
+def anomaly_score(res):
+    result = res["result"]
+    if "anomaly" in result:
+        return result["anomaly"]
+    classification = result.get("classification") or {}
+    if "anomaly" in classification:
+        return classification["anomaly"]
+    return None
+
+
+def is_anomaly(score):
+    return score is not None and score > THRESHOLD
+
+
+# The alert raised for an anomalous reading
+def alert(device_id, source, value, score, timestamp):
+    return {
+        "device_id": device_id,
+        "alert_type": "anomaly",
+        "source": source,
+        "value": float(value),
+        "anomaly_score": float(score),
+        "timestamp": timestamp
+    }
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+# Single event loop runtime for the health monitoring server.
+#
+# Draft3.py runs a paho network thread, a task processor thread, cleanup and
+# rollup threads and a thread per HTTP request. This runs the same pipeline
+# (Draft3's handlers, state and config) as coroutines on one asyncio loop:
+#   - the paho client is driven by the loop through its socket callbacks
+#   - vitals go through an asyncio queue to a processor coroutine, which
+#     records them and builds model features on the loop and awaits only the
+#     classify() calls. Those run on one executor thread per model; a runner
+#     is a single subprocess, so its calls are serialized anyway.
+#   - Firebase writes are batched through firebase_outbox.Outbox
+#   - the Flask routes are served by an HTTP/1.1 front end with keep-alive;
+#     views run on the loop, except those that block on Firebase reads or
+#     profiling, which run on a small thread pool
+#   - cleanup is a timer on the loop. Rollup flushes are timers too, but
+#     run on the outbox's writer thread, since merging with stored rollups
+#     reads Firebase.
+#
+#   python async_server.py [--backend memory] [--cluster] [--node-id ID]
+import io
+import sys
+import time
+import signal
+import asyncio
+import threading
+from http import HTTPStatus
+from urllib.parse import unquote_to_bytes
+from concurrent.futures import ThreadPoolExecutor
+
+import Draft3 as server
+import metrics
+import structured_log
+from firebase_outbox import Outbox
+
+# Views that block, run off the loop
+BLOCKING_PATHS = ("/admin/profile",)
+BLOCKING_SUFFIXES = ("/rollups",)
+
+MAX_HEADERS = 100
+MAX_RECONNECT_DELAY = 30.0
+
+log = structured_log.get_logger("async_server")
+
+
+# Stands in for Draft3.processing_queue, so tasks queued from a Flask view or
+# another thread land on the runtime's asyncio queue
+class TaskQueue:
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def put(self, task):
+        self.runtime.call(self.runtime.enqueue, task)
+
+    def qsize(self):
+        return self.runtime.queue.qsize()
+
+
+def blocking_view(path):
+    return path.startswith(BLOCKING_PATHS) or path.endswith(BLOCKING_SUFFIXES)
+
+
+def wsgi_environ(method, target, version, headers, body, peer, port):
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': str(port),
+        'SERVER_PROTOCOL': version,
+        'REMOTE_ADDR': peer[0] if peer else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in headers:
+        key = name.upper().replace('-', '_')
+        if key == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif key != 'CONTENT_LENGTH':
+            environ['HTTP_' + key] = value
+    return environ
+
+
+# Run a WSGI app to completion; returns (status, headers, body)
+def call_wsgi(app, environ):
+    response = {}
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = headers
+        return chunks.append
+
+    result = app(environ, start_response)
+    try:
+        chunks.extend(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], b''.join(chunks)
+
+
+class AsyncRuntime:
+    def __init__(self, options):
+        self.options = options
+        self.loop = None
+        self.loop_thread = None
+        self.queue = None
+        self.stopping = None
+        self.client = None
+        self.http = None
+        self.executors = {}       # model name -> single-thread executor
+        self.blocking = ThreadPoolExecutor(2, thread_name_prefix="blocking-view")
+        self.background = set()   # audio tasks running on an executor
+        self.connections = 0
+        self.outbox = Outbox(
+            lambda updates: server.db.reference('/').update(updates),
+            flush_interval=options["outbox_flush_interval"],
+            batch_size=options["outbox_batch_size"],
+            max_pending=options["outbox_max_pending"],
+            log=log
+        )
+        metrics.registry.gauge("http_connections", "Open HTTP connections").set_function(lambda: self.connections)
+
+    # Run `function` on the loop thread, from any thread
+    def call(self, function, *args):
+        if threading.get_ident() == self.loop_thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def enqueue(self, task):
+        try:
+            self.queue.put_nowait(task)
+        except asyncio.QueueFull:
+            server.metric_dropped.labels("queue_full").inc()
+
+    def executor(self, model_name):
+        executor = self.executors.get(model_name)
+        if executor is None:
+            executor = self.executors[model_name] = ThreadPoolExecutor(1, thread_name_prefix=f"infer-{model_name}")
+        return executor
+
+    # MQTT
+
+    def ingest(self, topic, payload):
+        if server.capture is not None:
+            server.capture.record_mqtt(topic, payload)
+        task = server.handle_message(topic, payload)
+        if task is not None:
+            self.enqueue(task)
+
+    def connect_mqtt(self):
+        client = server.create_mqtt_client()
+        client.on_message = lambda c, userdata, msg: self.call(self.ingest, msg.topic, msg.payload)
+        client.on_socket_open = lambda c, userdata, sock: self.call(self.loop.add_reader, sock, c.loop_read)
+        client.on_socket_close = lambda c, userdata, sock: self.call(self.loop.remove_reader, sock)
+        client.on_socket_register_write = lambda c, userdata, sock: self.call(self.loop.add_writer, sock, c.loop_write)
+        client.on_socket_unregister_write = lambda c, userdata, sock: self.call(self.loop.remove_writer, sock)
+        server.client = client
+        try:
+            client.connect(server.config["mqtt_broker"], server.config["mqtt_port"], 60)
+            log.info("mqtt_connecting", broker=server.config["mqtt_broker"], port=server.config["mqtt_port"])
+        except Exception as e:
+            log.error("mqtt_connect_failed", error=str(e))
+        if not hasattr(client, "loop_misc"):
+            # The loopback client has no socket and delivers from its own thread
+            client.loop_start()
+        return client
+
+    # Keepalive pings and reconnects, which paho's own loop would do
+    async def mqtt_housekeeping(self):
+        delay = 1.0
+        while True:
+            await asyncio.sleep(delay)
+            if self.client.loop_misc() != server.mqtt.MQTT_ERR_NO_CONN:
+                delay = 1.0
+                continue
+            try:
+                self.client.reconnect()
+                log.info("mqtt_reconnected")
+                delay = 1.0
+            except Exception as e:
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                log.warning("mqtt_reconnect_failed", error=str(e), retry_in=delay)
+
+    # Processing
+
+    async def process_tasks(self):
+        log.info("task_processor_started", runtime="asyncio")
+        while True:
+            tasks = [await self.queue.get()]
+            while len(tasks) < server.config["vitals_batch_size"] and not self.queue.empty():
+                tasks.append(self.queue.get_nowait())
+            now = time.perf_counter()
+            vitals = []
+            for task in tasks:
+                if 'enqueued_at' in task:
+                    server.metric_queue_wait.labels(task['type']).observe(now - task['enqueued_at'])
+                if task['type'] == 'vitals':
+                    vitals.append(task)
+                elif task['type'] == 'audio':
+                    self.process_audio(task)
+            try:
+                if vitals:
+                    await self.process_vitals(vitals)
+            except Exception as e:
+                server.metric_errors.labels("task_processor").inc()
+                log.exception("task_failed", error=str(e))
+            for _ in tasks:
+                self.queue.task_done()
+
+    # Audio conversion and keyword inference both run on the keyword model's
+    # executor
+    def process_audio(self, task):
+        future = self.loop.run_in_executor(self.executor("keyword_model"), server.process_audio_task, task)
+        self.background.add(future)
+        future.add_done_callback(self.background.discard)
+
+    # Record the batch and build features on the loop, then run every model
+    # call concurrently and raise alerts in sample order
+    async def process_vitals(self, tasks):
+        jobs = []
+        for device_id, heart_rate, spo2, timestamp, features in server.record_vitals(tasks):
+            for source, value in (("bpm", heart_rate), ("spo2", spo2)):
+                if features[source] is not None:
+                    jobs.append((device_id, source, value, timestamp, features[source]))
+
+        results = await asyncio.gather(
+            *(self.classify(server.VITALS_MODELS[source][0], features) for _, source, _, _, features in jobs),
+            return_exceptions=True
+        )
+        for (device_id, source, value, timestamp, _), res in zip(jobs, results):
+            if isinstance(res, server.InferenceUnavailable):
+                continue
+            try:
+                if isinstance(res, Exception):
+                    raise res
+                alert_data = server.anomaly_alert(device_id, source, value, timestamp, res)
+                if alert_data:
+                    server.send_alert(device_id, alert_data)
+            except Exception as e:
+                server.metric_errors.labels(f"{source}_detection").inc()
+                log.exception(f"{source}_detection_failed", device_id=device_id, error=str(e))
+
+    # In-process detectors and cached results are served on the loop; .eim
+    # models run on their executor
+    async def classify(self, model_name, features):
+        if getattr(server.models[model_name], "in_process", False):
+            return server.classify_cached(model_name, features)
+        res = server.inference_cache.get(model_name, features)
+        if res is not None:
+            return res
+        # The deadline includes the wait for the executor
+        deadline = time.monotonic() + server.inference_guard.timeout(model_name)
+        return await self.loop.run_in_executor(
+            self.executor(model_name), server.classify_model, model_name, features, deadline)
+
+    # Run `function` every `interval` seconds, on `executor` if it blocks
+    async def every(self, interval, function, name, executor=None):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if executor is None:
+                    function()
+                else:
+                    await self.loop.run_in_executor(executor, function)
+            except Exception as e:
+                server.metric_errors.labels(name).inc()
+                log.error(f"{name}_failed", error=str(e))
+
+    # HTTP
+
+    async def handle_http(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        self.connections += 1
+        try:
+            while await self.handle_request(reader, writer, peer):
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    # Serve one request; returns True to keep the connection open
+    async def handle_request(self, reader, writer, peer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self.options["http_keepalive_seconds"])
+        except asyncio.TimeoutError:
+            return False
+        if not request_line:
+            return False
+        if not request_line.strip():
+            return True
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            self.write_response(writer, HTTPStatus.BAD_REQUEST, keep_alive=False)
+            return False
+
+        headers = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers.append((name.strip(), value.strip()))
+            if len(headers) > MAX_HEADERS:
+                self.write_response(writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, keep_alive=False)
+                return False
+        fields = {name.lower(): value for name, value in headers}
+        connection = fields.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+
+        if 'chunked' in fields.get('transfer-encoding', '').lower():
+            self.write_response(writer, HTTPStatus.LENGTH_REQUIRED, keep_alive=False)
+            return False
+        length = int(fields.get('content-length', 0))
+        if length > self.options["http_max_body_bytes"]:
+            self.write_response(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, keep_alive=False)
+            return False
+        if length and fields.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        body = await reader.readexactly(length) if length else b''
+
+        environ = wsgi_environ(method, target, version, headers, body, peer, server.config['http_server_port'])
+        if blocking_view(environ['PATH_INFO']):
+            status, response_headers, response_body = await self.loop.run_in_executor(
+                self.blocking, call_wsgi, server.app, environ)
+        else:
+            status, response_headers, response_body = call_wsgi(server.app, environ)
+        if method == 'HEAD':
+            response_body = b''
+        self.write_response(writer, status, response_headers, response_body, keep_alive)
+        await writer.drain()
+        return keep_alive
+
+    def write_response(self, writer, status, headers=(), body=b'', keep_alive=True):
+        if isinstance(status, HTTPStatus):
+            status = f"{status.value} {status.phrase}"
+        lines = [f"HTTP/1.1 {status}"]
+        for name, value in headers:
+            if name.lower() not in ('connection', 'content-length', 'transfer-encoding'):
+                lines.append(f"{name}: {value}")
+        lines.append(f"Content-Length: {len(body)}")
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+    # Lifecycle
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.queue = asyncio.Queue(maxsize=self.options["max_queue"])
+        self.stopping = asyncio.Event()
+        server.outbox = self.outbox
+        server.processing_queue = TaskQueue(self)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        self.client = self.connect_mqtt()
+        if server.cluster is not None:
+            server.cluster.start()
+        self.http = await asyncio.start_server(self.handle_http, '0.0.0.0', server.config['http_server_port'])
+        log.info("http_starting", port=server.config['http_server_port'], runtime="asyncio")
+
+        workers = [
+            asyncio.create_task(self.outbox.run()),
+            asyncio.create_task(self.process_tasks()),
+            asyncio.create_task(self.every(server.config["rollups"]["flush_interval"], server.flush_rollups, "rollups",
+                                           self.outbox.executor)),
+            asyncio.create_task(self.every(900, server.remove_inactive_devices, "cleanup"))
+        ]
+        if hasattr(self.client, "loop_misc"):
+            workers.append(asyncio.create_task(self.mqtt_housekeeping()))
+
+        await self.stopping.wait()
+        await self.shutdown(workers)
+
+    def stop(self):
+        self.call(self.stopping.set)
+
+    def disconnect(self):
+        if hasattr(self.client, "loop_misc"):
+            self.client.disconnect()
+        else:
+            self.client.loop_stop()
+
+    # Stop taking new work, finish what is queued, hand off or flush the
+    # devices' state and write out the outbox. A cluster node stays a member
+    # until its devices' state is saved for the nodes taking them over.
+    async def shutdown(self, workers, timeout=10.0):
+        log.info("shutdown", reason="signal", runtime="asyncio")
+        self.http.close()
+        if server.cluster is not None:
+            server.stop_intake()
+        else:
+            self.disconnect()
+
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+            if self.background:
+                await asyncio.wait_for(asyncio.gather(*self.background, return_exceptions=True), timeout)
+        except asyncio.TimeoutError:
+            log.warning("shutdown_tasks_abandoned", queued=self.queue.qsize(), audio=len(self.background))
+
+        if server.cluster is not None:
+            await self.loop.run_in_executor(self.outbox.executor, server.hand_off_devices, list(server.device_data))
+        await self.loop.run_in_executor(self.outbox.executor, server.flush_rollups)
+        left = await self.outbox.drain(timeout)
+        if left:
+            log.warning("shutdown_writes_abandoned", writes=left)
+        if server.cluster is not None:
+            server.cluster.leave()
+            self.disconnect()
+
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        server.model_registry.stop()
+        server.unload_models()
+        for executor in list(self.executors.values()) + [self.blocking, self.outbox.executor]:
+            executor.shutdown(wait=False)
+        server.image_pipeline.shutdown(wait=False)
+        if server.capture is not None:
+            server.capture.close()
+        structured_log.flush()
+
+
+def main():
+    args = server.build_arg_parser("Health Monitoring Server (asyncio runtime)").parse_args()
+
+    log.info("server_starting", runtime="asyncio")
+    server.setup(args)
+
+    runtime = AsyncRuntime(server.config["async_runtime"])
+    asyncio.run(runtime.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+# Pluggable backends for Draft3.py.
+#
+# The server talks to three external services through module globals:
+#   db            - firebase_admin.db (reference(path) -> push/set/update/get)
+#   mqtt          - paho.mqtt.client (Client() -> connect/subscribe/publish/loop)
+#   ImpulseRunner - edge_impulse_linux.runner.ImpulseRunner (init/classify/stop)
+# The classes here implement the same interfaces in memory, so the server can
+# be run and load-tested on any Linux box without Firebase, a broker or .eim
+# models. configure_backends() in Draft3.py swaps them in.
+import time
+import copy
+import random
+import threading
+import queue
+
+
+# Firebase-style push ids: 8 characters of millisecond timestamp followed by
+# 12 random characters, incremented within the same millisecond so ids sort in
+# creation order
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+
+class PushIdGenerator:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_ms = 0
+        self.last_random = [0] * 12
+
+    def generate(self):
+        with self.lock:
+            now = int(time.time() * 1000)
+            if now == self.last_ms:
+                for i in range(11, -1, -1):
+                    if self.last_random[i] != 63:
+                        self.last_random[i] += 1
+                        break
+                    self.last_random[i] = 0
+            else:
+                self.last_ms = now
+                self.last_random = [random.randrange(64) for _ in range(12)]
+
+            time_chars = []
+            for _ in range(8):
+                time_chars.append(PUSH_CHARS[now % 64])
+                now //= 64
+            return ''.join(reversed(time_chars)) + ''.join(PUSH_CHARS[i] for i in self.last_random)
+
+
+push_ids = PushIdGenerator()
+
+
+def split_path(path):
+    return [part for part in path.strip('/').split('/') if part]
+
+
+# Reference into a MemoryDatabase, mirroring firebase_admin.db.Reference
+class MemoryReference:
+    def __init__(self, database, path):
+        self.database = database
+        self.path = '/'.join(split_path(path))
+
+    @property
+    def key(self):
+        parts = split_path(self.path)
+        return parts[-1] if parts else None
+
+    def child(self, path):
+        return MemoryReference(self.database, f"{self.path}/{path}")
+
+    def push(self, value=None):
+        ref = self.child(push_ids.generate())
+        if value is not None:
+            ref.set(value)
+        return ref
+
+    def set(self, value):
+        self.database._write(self.path, value, merge=False)
+
+    def update(self, value):
+        self.database._write(self.path, value, merge=True)
+
+    def get(self, shallow=False):
+        value = self.database._read(self.path)
+        if shallow and isinstance(value, dict):
+            return {key: True for key in value}
+        return value
+
+    def delete(self):
+        self.database._write(self.path, None, merge=False)
+
+    def order_by_key(self):
+        return MemoryQuery(self)
+
+
+# Key-ordered query, mirroring firebase_admin.db.Query for order_by_key()
+class MemoryQuery:
+    def __init__(self, reference):
+        self.reference = reference
+        self.start = None
+        self.end = None
+        self.first = None
+        self.last = None
+
+    def start_at(self, key):
+        self.start = key
+        return self
+
+    def end_at(self, key):
+        self.end = key
+        return self
+
+    def limit_to_first(self, count):
+        self.first = count
+        return self
+
+    def limit_to_last(self, count):
+        self.last = count
+        return self
+
+    def get(self):
+        value = self.reference.get()
+        if not isinstance(value, dict):
+            return {}
+        keys = sorted(key for key in value
+                      if (self.start is None or key >= self.start) and (self.end is None or key <= self.end))
+        if self.first is not None:
+            keys = keys[:self.first]
+        if self.last is not None:
+            keys = keys[-self.last:] if self.last > 0 else []
+        return {key: value[key] for key in keys}
+
+
+# Dict-backed stand-in for firebase_admin.db with optional latency injection.
+# Each read or write sleeps for `latency` seconds plus up to `jitter` seconds,
+# to model the round trip to the Realtime Database.
+class MemoryDatabase:
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.root = {}
+        self.reads = 0
+        self.writes = 0
+
+    def reference(self, path='/'):
+        return MemoryReference(self, path)
+
+    def _delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.random() * self.jitter)
+
+    def _write(self, path, value, merge):
+        self._delay()
+        parts = split_path(path)
+        with self.lock:
+            self.writes += 1
+            if merge:
+                # update() accepts multi-location keys such as "a/b"
+                for key, child_value in value.items():
+                    self._set(parts + split_path(key), copy.deepcopy(child_value))
+            else:
+                self._set(parts, copy.deepcopy(value))
+
+    def _set(self, parts, value):
+        if not parts:
+            self.root = value if isinstance(value, dict) else {}
+            return
+        node = self.root
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                child = node[part] = {}
+            node = child
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+
+    def _read(self, path):
+        self._delay()
+        with self.lock:
+            self.reads += 1
+            node = self.root
+            for part in split_path(path):
+                if not isinstance(node, dict) or part not in node:
+                    return None
+                node = node[part]
+            return copy.deepcopy(node)
+
+
+# Message delivered by the loopback broker, with the attributes paho's
+# MQTTMessage exposes to on_message
+class LoopbackMessage:
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+def topic_matches(subscription, topic):
+    sub_parts = subscription.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(sub_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part != '+' and part != topic_parts[i]:
+            return False
+    return len(sub_parts) == len(topic_parts)
+
+
+# In-process MQTT broker. Publishing puts the message on the inbox of every
+# client with a matching subscription; each client's network loop drains its
+# own inbox, like paho's loop thread does. Retained messages, wills and
+# shared subscriptions ($share/<group>/<filter>, one member per message,
+# round-robin) behave as on an MQTT 5 broker.
+class LoopbackBroker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.shared = {}     # (group, filter) -> [clients]
+        self.next_member = {}
+        self.retained = {}
+        self.published = 0
+
+    def subscribe(self, client, topic):
+        with self.lock:
+            if topic.startswith('$share/'):
+                _, group, topic_filter = topic.split('/', 2)
+                self.shared.setdefault((group, topic_filter), []).append(client)
+                return
+            self.subscriptions.append((topic, client))
+            retained = [m for t, m in self.retained.items() if topic_matches(topic, t)]
+        for message in retained:
+            client.inbox.put(message)
+
+    def unsubscribe(self, client, topic):
+        with self.lock:
+            if topic.startswith('$share/'):
+                _, group, topic_filter = topic.split('/', 2)
+                members = self.shared.get((group, topic_filter), [])
+                if client in members:
+                    members.remove(client)
+                return
+            self.subscriptions = [(t, c) for t, c in self.subscriptions if (t, c) != (topic, client)]
+
+    def unsubscribe_all(self, client):
+        with self.lock:
+            self.subscriptions = [(t, c) for t, c in self.subscriptions if c is not client]
+            for members in self.shared.values():
+                if client in members:
+                    members.remove(client)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        message = LoopbackMessage(topic, payload or b'', qos, retain)
+        with self.lock:
+            self.published += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = message
+                else:
+                    self.retained.pop(topic, None)
+            targets = {id(c): c for t, c in self.subscriptions if topic_matches(t, topic)}
+            for key, members in self.shared.items():
+                if members and topic_matches(key[1], topic):
+                    i = self.next_member.get(key, 0) % len(members)
+                    self.next_member[key] = i + 1
+                    targets.setdefault(id(members[i]), members[i])
+        for client in targets.values():
+            client.inbox.put(message)
+
+
+# Client for a LoopbackBroker with the subset of paho.mqtt.client.Client used
+# by the server
+class LoopbackClient:
+    def __init__(self, broker, *args, **kwargs):
+        self.broker = broker
+        self.inbox = queue.Queue()
+        self.on_connect = None
+        self.on_message = None
+        self.connected = False
+        self.will = None
+        self._loop_thread = None
+        self._stop = threading.Event()
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self.will = (topic, payload, qos, retain)
+
+    def connect(self, host='localhost', port=1883, keepalive=60):
+        self.connected = True
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+        return 0
+
+    def disconnect(self):
+        self.connected = False
+        self.broker.unsubscribe_all(self)
+        self._stop.set()
+
+    # Drop the connection without a DISCONNECT, so the broker sends the will
+    def drop(self):
+        self.disconnect()
+        if self.will is not None:
+            self.broker.publish(*self.will)
+
+    def subscribe(self, topic, qos=0):
+        self.broker.subscribe(self, topic)
+        return (0, 0)
+
+    def unsubscribe(self, topic):
+        self.broker.unsubscribe(self, topic)
+        return (0, 0)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.broker.publish(topic, payload, qos, retain)
+
+    def loop_forever(self):
+        while not self._stop.is_set():
+            try:
+                message = self.inbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if self.on_message:
+                self.on_message(self, None, message)
+
+    def loop_start(self):
+        self._loop_thread = threading.Thread(target=self.loop_forever)
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+
+    def loop_stop(self):
+        self._stop.set()
+
+
+# Object that can replace the paho.mqtt.client module: mqtt.Client() returns
+# a client attached to `broker`
+class LoopbackMqtt:
+    def __init__(self, broker):
+        self.broker = broker
+
+    def Client(self, *args, **kwargs):
+        return LoopbackClient(self.broker, *args, **kwargs)
+
+
+# Stand-in for ImpulseRunner. Each classify() call costs `cost` seconds,
+# either sleeping (an IPC wait, which releases the GIL) or spinning (CPU-bound
+# work). `script` is a callable features -> result dict, or a list of result
+# dicts returned in turn; by default keyword models report "help" and vitals
+# models score the deviation from the recent average.
+class ScriptedRunner:
+    # Scripted runners don't need a .eim file on disk
+    needs_model_file = False
+
+    def __init__(self, model_path='', script=None, cost=0.0, busy=False):
+        self.model_path = model_path
+        self.script = script
+        self.cost = cost
+        self.busy = busy
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def init(self):
+        return {
+            "project": {"name": f"scripted {self.model_path}", "owner": "backends"},
+            "model_parameters": {"model_type": "scripted"}
+        }
+
+    def classify(self, features):
+        start = time.perf_counter()
+        if self.cost:
+            if self.busy:
+                while time.perf_counter() - start < self.cost:
+                    pass
+            else:
+                time.sleep(self.cost)
+
+        with self.lock:
+            call = self.calls
+            self.calls += 1
+
+        if callable(self.script):
+            result = self.script(features)
+        elif self.script:
+            result = self.script[call % len(self.script)]
+        elif 'keyword' in self.model_path:
+            result = {"classification": {"help": 0.9, "noise": 0.1}}
+        else:
+            deviation = abs(float(features[0]) - float(features[1]))
+            result = {"anomaly": min(1.0, deviation / 40.0)}
+
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        return {"result": result, "timing": {"dsp": 0, "classification": elapsed_ms, "anomaly": 0}}
+
+    def stop(self):
+        pass
+
+
+# Factory with ImpulseRunner's constructor signature, for configure_backends()
+def scripted_runner(cost=0.0, busy=False, script=None):
+    def factory(model_path):
+        return ScriptedRunner(model_path, script=script, cost=cost, busy=busy)
+    factory.needs_model_file = False
+    return factory
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# Benchmark for the rpi_1 ingest-to-alert pipeline in Draft3.py.
+#
+# Drives the MQTT on_message path, process_vitals_task (through the task
+# processor thread), process_audio_task and the /upload endpoint (including
+# the background thumbnail/web variant work) with
+# synthetic device fleets, using the in-memory backends from backends.py in
+# place of Firebase, the MQTT broker and ImpulseRunner, and reports messages/sec, ingest-to-alert latency
+# percentiles and RSS.
+#
+# Usage:
+#   python benchmark.py [--fleets 1,10,100,1000] [--messages-per-device 50]
+#                       [--output results.json] [--compare previous.json]
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import cv2
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+from backends import LoopbackMessage
+
+SCENARIOS = ("vitals", "mqtt_alerts", "audio", "upload")
+# Scenarios in which every message should end in an alert (the scripted
+# keyword model always hears "help"); zero alerts means the pipeline failed
+# somewhere, not that it was fast
+ALERT_SCENARIOS = ("audio",)
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000.0, [50, 95, 99])
+    return {"p50": round(float(p50), 3), "p95": round(float(p95), 3), "p99": round(float(p99), 3)}
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+class Benchmark:
+    def __init__(self, server, args):
+        self.server = server
+        self.args = args
+        self.ingest_times = {}
+        self.alert_latencies = []
+        self.alert_count = 0
+        self.lock = threading.Lock()
+
+        # Fork the image workers before the benchmark starts its own threads
+        server.image_pipeline.start()
+
+        # Route everything external to the in-memory backends
+        server.config["memory_backend"].update({
+            "db_latency_ms": args.db_latency_ms,
+            "runner_cost_ms": args.classify_cost_ms
+        })
+        server.configure_backends("memory")
+        server.load_models()
+        server.client = server.connect_mqtt()
+
+        # Record the time from ingest to every alert that reaches send_alert
+        original_send_alert = server.send_alert
+
+        def timed_send_alert(device_id, alert_data):
+            key = (device_id, alert_data.get("timestamp"))
+            result = original_send_alert(device_id, alert_data)
+            now = time.perf_counter()
+            with self.lock:
+                self.alert_count += 1
+                start = self.ingest_times.get(key)
+                if start is not None:
+                    self.alert_latencies.append(now - start)
+            return result
+
+        server.send_alert = timed_send_alert
+
+        processor = threading.Thread(target=server.task_processor)
+        processor.daemon = True
+        processor.start()
+
+        flusher = threading.Thread(target=server.rollup_flusher)
+        flusher.daemon = True
+        flusher.start()
+
+        self.http = server.app.test_client()
+        self.variants_done = 0
+
+    def reset(self):
+        for device_id in list(self.server.device_data):
+            self.server.threshold_engine.forget(device_id)
+            self.server.rollups.forget(device_id)
+            if self.server.persistence is not None:
+                self.server.persistence.forget(device_id)
+        self.server.device_data.clear()
+        self.server.inference_cache.invalidate()
+        self.ingest_times.clear()
+        self.alert_latencies = []
+        self.alert_count = 0
+
+    # Paced or as-fast-as-possible message source
+    def pace(self, index, start):
+        if self.args.rate:
+            delay = start + index / self.args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def run_vitals(self, devices):
+        rng = random.Random(1)
+        heart_rates = {device_id: 75 for device_id in devices}
+        on_message = self.server.client.on_message
+        total = len(devices) * self.args.messages_per_device
+        base_ts = int(time.time() * 1000)
+
+        start = time.perf_counter()
+        for i in range(total):
+            device_id = devices[i % len(devices)]
+            # Bounded random walk with occasional spikes that trip thresholds
+            hr = heart_rates[device_id] + rng.randint(-2, 2)
+            heart_rates[device_id] = hr = min(max(hr, 55), 110)
+            if rng.random() < self.args.spike_rate:
+                hr = rng.choice([35, 150])
+            payload = {
+                "device_id": device_id,
+                "heart_rate": hr,
+                "spo2": rng.choice([96, 97, 98, 98, 99]),
+                "timestamp": base_ts + i
+            }
+            self.pace(i, start)
+            self.ingest_times[(device_id, payload["timestamp"])] = time.perf_counter()
+            on_message(self.server.client, None,
+                       LoopbackMessage(f"health/vitals/{device_id}", json.dumps(payload).encode()))
+        self.server.processing_queue.join()
+        return total, time.perf_counter() - start, None
+
+    def run_mqtt_alerts(self, devices):
+        on_message = self.server.client.on_message
+        total = len(devices) * self.args.messages_per_device
+        latencies = []
+
+        start = time.perf_counter()
+        for i in range(total):
+            device_id = devices[i % len(devices)]
+            payload = json.dumps({
+                "device_id": device_id,
+                "alert_type": "sos",
+                "timestamp": int(time.time() * 1000)
+            }).encode()
+            self.pace(i, start)
+            t0 = time.perf_counter()
+            on_message(self.server.client, None, LoopbackMessage(f"health/alerts/{device_id}", payload))
+            latencies.append(time.perf_counter() - t0)
+        return total, time.perf_counter() - start, latencies
+
+    def run_audio(self, devices):
+        rng = np.random.default_rng(1)
+        audio = (rng.standard_normal(16000) * 3000).astype(np.int16)
+        total = len(devices) * max(1, self.args.messages_per_device // 10)
+        base_ts = int(time.time() * 1000)
+
+        start = time.perf_counter()
+        for i in range(total):
+            device_id = devices[i % len(devices)]
+            timestamp = base_ts + i
+            self.pace(i, start)
+            self.ingest_times[(device_id, timestamp)] = time.perf_counter()
+            self.server.processing_queue.put({
+                'type': 'audio',
+                'device_id': device_id,
+                'filepath': os.path.join(self.server.config["audio_save_path"], f"{device_id}_{i}.wav"),
+                'audio_data': audio,
+                'timestamp': timestamp
+            })
+        self.server.processing_queue.join()
+        return total, time.perf_counter() - start, None
+
+    def run_upload(self, devices):
+        width, height = (int(n) for n in self.args.image_size.split('x'))
+        pixels = np.random.default_rng(1).integers(0, 256, (height, width, 3), dtype=np.uint8)
+        image = cv2.imencode('.jpg', cv2.GaussianBlur(pixels, (9, 9), 0))[1].tobytes()
+        total = len(devices) * max(1, self.args.messages_per_device // 10)
+        latencies = []
+
+        start = time.perf_counter()
+        for i in range(total):
+            device_id = devices[i % len(devices)]
+            self.pace(i, start)
+            t0 = time.perf_counter()
+            # Trailing bytes after the JPEG end marker make every frame distinct
+            # content, so none is deduplicated away
+            response = self.http.post('/upload', data=image + (self.variants_done + i).to_bytes(4, 'big'), headers={
+                'Content-Type': 'image/jpeg',
+                'Device-ID': device_id
+            })
+            latencies.append(time.perf_counter() - t0)
+            if response.status_code != 200:
+                raise RuntimeError(f"/upload returned {response.status_code}")
+        # Include the background variant work in the measured time
+        while self.server.metric_image_variants.labels().count < self.variants_done + total:
+            time.sleep(0.005)
+        self.variants_done += total
+        return total, time.perf_counter() - start, latencies
+
+    def run(self, scenario, fleet_size):
+        self.reset()
+        devices = [f"bench_{i:04d}" for i in range(fleet_size)]
+        # Register devices the way the MQTT path does for direct queue tasks
+        for device_id in devices:
+            self.server.device_data[device_id] = {
+                "heart_rate": [], "spo2": [], "alerts": [], "images": [],
+                "last_update": time.time()
+            }
+
+        messages, seconds, latencies = getattr(self, f"run_{scenario}")(devices)
+        if latencies is None:
+            latencies = self.alert_latencies
+
+        return {
+            "scenario": scenario,
+            "devices": fleet_size,
+            "messages": messages,
+            "seconds": round(seconds, 4),
+            "messages_per_sec": round(messages / seconds, 1) if seconds else None,
+            "latency_ms": percentiles(latencies),
+            "latency_samples": len(latencies),
+            "alerts": self.alert_count,
+            "rss_mb": round(rss_mb(), 1),
+            "inference_cache": self.server.inference_cache.stats()
+        }
+
+
+def compare(results, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    baseline = {(r["scenario"], r["devices"]): r for r in previous["results"]}
+    print(f"\nComparison against {previous_path} (commit {previous.get('commit')}):")
+    for result in results:
+        old = baseline.get((result["scenario"], result["devices"]))
+        if not old or not old["messages_per_sec"] or not result["messages_per_sec"]:
+            continue
+        ratio = result["messages_per_sec"] / old["messages_per_sec"]
+        p99_old = old["latency_ms"]["p99"]
+        p99_new = result["latency_ms"]["p99"]
+        print(f"  {result['scenario']:12s} {result['devices']:5d} devices: "
+              f"{ratio:6.2f}x throughput, p99 {p99_old} -> {p99_new} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rpi_1 ingest-to-alert pipeline")
+    parser.add_argument("--fleets", default="1,10,100,1000",
+                        help="comma-separated fleet sizes")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="comma-separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--messages-per-device", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=0,
+                        help="messages/sec to offer (0 = as fast as possible)")
+    parser.add_argument("--classify-cost-ms", type=float, default=2.0,
+                        help="simulated cost of one .eim classify call")
+    parser.add_argument("--db-latency-ms", type=float, default=0.0,
+                        help="simulated latency of each database call")
+    parser.add_argument("--spike-rate", type=float, default=0.02,
+                        help="fraction of vitals samples that breach thresholds")
+    parser.add_argument("--image-size", default="640x480", help="WIDTHxHEIGHT of uploaded JPEGs")
+    parser.add_argument("--output", default=None, help="write results JSON here")
+    parser.add_argument("--compare", default=None, help="previous results JSON to compare against")
+    parser.add_argument("--verbose", action="store_true", help="keep the server's log output")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    previous = os.path.abspath(args.compare) if args.compare else None
+
+    # Draft3 creates its data directories relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="rpi1_bench_")
+    os.chdir(workdir)
+    import Draft3 as server
+    import structured_log
+
+    if not args.verbose:
+        structured_log.setup_logging(
+            rate_limits=server.config["logging"]["rate_limits"],
+            stream=open(os.devnull, 'w')
+        )
+
+    fleets = [int(n) for n in args.fleets.split(",")]
+    scenarios = [name for name in args.scenarios.split(",") if name]
+    bench = Benchmark(server, args)
+
+    results = []
+    failed = []
+    for scenario in scenarios:
+        for fleet_size in fleets:
+            result = bench.run(scenario, fleet_size)
+            results.append(result)
+            print(f"{scenario:12s} {fleet_size:5d} devices: {result['messages_per_sec']:>10} msg/s  "
+                  f"p50 {result['latency_ms']['p50']} p95 {result['latency_ms']['p95']} "
+                  f"p99 {result['latency_ms']['p99']} ms  rss {result['rss_mb']} MB")
+            if scenario in ALERT_SCENARIOS and result["messages"] and not result["alerts"]:
+                failed.append(f"{scenario} with {fleet_size} devices")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": vars(args),
+        "results": results
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output}")
+    if previous:
+        compare(results, previous)
+    if failed:
+        sys.exit("No alerts raised for " + ", ".join(failed))
+
+
+if __name__ == "__main__":
+    main()
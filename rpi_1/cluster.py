@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Clustered mode for running several edge nodes against one broker.
+#
+# Every node subscribes to the device topics through an MQTT shared
+# subscription ($share/<group>/...), so the broker hands each message to just
+# one node. Ownership of a device is decided by rendezvous hashing of its ID
+# over the live members, so it is stable and only the devices of a joining or
+# leaving node move. A node that receives a message for a device it does not
+# own forwards it to the owner's inbox topic.
+#
+# Membership is a retained heartbeat per node on cluster/<group>/members/<id>,
+# cleared by the node's will if it drops off; a member that stops
+# heartbeating for expiry_factor intervals is removed. on_change(old, new)
+# runs whenever the member set changes, so the server can hand device state
+# to the new owners.
+#
+# A joining node takes its share of the device topics only join_seconds
+# after subscribing to the membership topics, once the retained heartbeats
+# have told it who the members are. After every membership change each node
+# sends every other member a handoff on its inbox: the state of the devices
+# that member now owns, possibly none. on_handoff(node, devices) runs when
+# one arrives, so the new owner can hold a device's messages until the
+# previous owner's handoff for the current member set (epoch) is in.
+import json
+import time
+import socket
+import hashlib
+import threading
+
+MAX_HOPS = 3
+
+
+class Cluster:
+    def __init__(self, group, node_id=None, heartbeat_seconds=5.0, expiry_factor=3, join_seconds=None,
+                 on_change=None, on_handoff=None, log=None):
+        self.group = group
+        self.node_id = node_id or socket.gethostname()
+        self.heartbeat_seconds = heartbeat_seconds
+        self.expiry_seconds = heartbeat_seconds * expiry_factor
+        self.join_seconds = heartbeat_seconds if join_seconds is None else join_seconds
+        self.on_change = on_change
+        self.on_handoff = on_handoff
+        self.log = log
+        self.prefix = f"cluster/{group}"
+        self.member_topic = f"{self.prefix}/members/{self.node_id}"
+        self.inbox_topic = f"{self.prefix}/nodes/{self.node_id}"
+        self.lock = threading.Lock()
+        self.members = {self.node_id: time.monotonic()}
+        self.owners = {}  # device_id -> owner, cleared on membership change
+        self.previous_members = set()  # the member set before the last change
+        self.handoffs = {}  # epoch -> nodes whose handoff for it has arrived
+        self.topics = ()
+        self.joined = False
+        self.left = False
+        self.client = None
+        self.running = False
+
+    # Call before connecting, so the broker clears this node's membership if
+    # the connection drops
+    def attach(self, client):
+        self.client = client
+        client.will_set(self.member_topic, payload=None, retain=True)
+
+    # The cluster's own topics at once, and shared subscriptions for the
+    # device topics once this node has joined
+    def subscribe(self, client, topics):
+        self.topics = topics
+        client.subscribe(f"{self.prefix}/members/+")
+        client.subscribe(self.inbox_topic)
+        if self.joined:
+            self._subscribe_devices(client)
+            return
+        timer = threading.Timer(self.join_seconds, self._join, (client,))
+        timer.daemon = True
+        timer.start()
+
+    def _subscribe_devices(self, client):
+        for topic in self.topics:
+            client.subscribe(f"$share/{self.group}/{topic}")
+
+    # The members known now owned the devices before this node joined
+    def _join(self, client):
+        if self.left:
+            return
+        with self.lock:
+            self.previous_members = set(self.members) - {self.node_id}
+            self.joined = True
+            members = sorted(self.members)
+        if self.log:
+            self.log.info("cluster_joined", node_id=self.node_id, members=members)
+        self._subscribe_devices(client)
+
+    # Stop receiving the device topics; the other nodes' shares take them
+    def unsubscribe(self, client, topics):
+        for topic in topics:
+            client.unsubscribe(f"$share/{self.group}/{topic}")
+
+    def start(self):
+        self.running = True
+        thread = threading.Thread(target=self._heartbeat, name="cluster-heartbeat")
+        thread.daemon = True
+        thread.start()
+
+    # Leave the cluster so the other nodes take over at once
+    def leave(self):
+        self.running = False
+        self.left = True
+        if self.client is not None:
+            self.client.publish(self.member_topic, payload=None, retain=True)
+
+    def _heartbeat(self):
+        while self.running:
+            self.client.publish(self.member_topic, json.dumps({"node_id": self.node_id, "ts": time.time()}), retain=True)
+            self._expire()
+            time.sleep(self.heartbeat_seconds)
+
+    def _expire(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [m for m, seen in self.members.items()
+                       if m != self.node_id and now - seen > self.expiry_seconds]
+        for member in expired:
+            self._set_member(member, present=False)
+
+    def _set_member(self, member, present):
+        with self.lock:
+            old = set(self.members)
+            if present:
+                self.members[member] = time.monotonic()
+            else:
+                self.members.pop(member, None)
+            new = set(self.members)
+            if old == new:
+                return
+            self.owners = {}
+            if self.joined:
+                self.previous_members = old
+            epoch = self._epoch()
+            self.handoffs = {e: nodes for e, nodes in self.handoffs.items() if e == epoch}
+        if self.log:
+            self.log.info("cluster_membership_changed", node_id=self.node_id, members=sorted(new))
+        if self.on_change:
+            self.on_change(old, new)
+
+    def is_cluster_topic(self, topic):
+        return topic.startswith(self.prefix + "/")
+
+    # Handle a message on a cluster topic. Returns (topic, payload, hops) for
+    # a forwarded device message this node should process, else None.
+    def handle(self, topic, payload):
+        if topic == self.inbox_topic:
+            message = json.loads(payload)
+            if "handoff" in message:
+                handoff = message["handoff"]
+                with self.lock:
+                    self.handoffs.setdefault(handoff["epoch"], set()).add(handoff["from"])
+                if self.on_handoff:
+                    self.on_handoff(handoff["from"], handoff["devices"])
+                return None
+            return message["topic"], message["payload"], message.get("hops", 0)
+        member = topic.rsplit('/', 1)[-1]
+        if member == self.node_id:
+            return None
+        present = bool(payload)
+        if present:
+            # A retained heartbeat left behind by a node that died without
+            # its will being sent is ignored once it is older than the expiry
+            heartbeat = json.loads(payload)
+            present = time.time() - heartbeat.get("ts", 0) <= self.expiry_seconds
+        self._set_member(member, present)
+        return None
+
+    def owner(self, device_id):
+        owner = self.owners.get(device_id)
+        if owner is None:
+            with self.lock:
+                owner = _rendezvous(self.members, device_id)
+                self.owners[device_id] = owner
+        return owner
+
+    def owns(self, device_id):
+        return self.owner(device_id) == self.node_id
+
+    # The device's owner before the last membership change, or None if this
+    # node was the first member
+    def previous_owner(self, device_id):
+        with self.lock:
+            members = self.previous_members if self.joined else set(self.members) - {self.node_id}
+            return _rendezvous(members, device_id) if members else None
+
+    def is_member(self, node):
+        with self.lock:
+            return node in self.members
+
+    # Whether `node`'s handoff for the current member set has arrived
+    def handed_off(self, node):
+        with self.lock:
+            return node in self.handoffs.get(self._epoch(), ())
+
+    # Identifies the member set; call with the lock held
+    def _epoch(self):
+        return hashlib.sha1(",".join(sorted(self.members)).encode()).hexdigest()[:16]
+
+    # Send `node` the state of the devices it takes over from this node,
+    # {device_id: state}; an empty handoff tells it there are none
+    def send_handoff(self, node, devices):
+        with self.lock:
+            epoch = self._epoch()
+        message = {"handoff": {"from": self.node_id, "epoch": epoch, "devices": devices}}
+        self.client.publish(f"{self.prefix}/nodes/{node}", json.dumps(message))
+
+    # Send a device message to the node that owns the device. Returns False
+    # when it has bounced between nodes too often (membership is in flux),
+    # in which case the caller processes it locally.
+    def forward(self, device_id, topic, payload, hops=0):
+        if hops >= MAX_HOPS:
+            return False
+        owner = self.owner(device_id)
+        message = {"topic": topic, "payload": payload, "hops": hops + 1}
+        self.client.publish(f"{self.prefix}/nodes/{owner}", json.dumps(message))
+        return True
+
+
+def _rendezvous(members, device_id):
+    return max(members, key=lambda m: hashlib.sha1(f"{m}/{device_id}".encode()).digest())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import math
+import threading
+import time
+
+
+# In-process anomaly detector for the 2-feature vitals models
+# ([current value, average of recent values]). It exposes the same
+# init()/classify()/stop() interface as edge_impulse_linux's ImpulseRunner, so
+# it can stand in for a .eim model when the SDK or the model file is missing.
+#
+# The residual (current - recent average) is tracked with an exponentially
+# weighted mean and variance. The anomaly score is the residual's z-score
+# scaled so that z == z_threshold maps to 0.5, the same cut-off the server
+# applies to .eim anomaly scores. Anomalous residuals are not folded into the
+# running statistics, so a long episode does not teach the detector that it
+# is normal.
+class EwmaDetector:
+    # Cheap enough that caching or offloading its results is pointless
+    in_process = True
+
+    def __init__(self, alpha=0.05, z_threshold=3.0, warmup=20, min_std=1.0):
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.warmup = warmup
+        self.min_std = min_std
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+
+    def init(self):
+        return {
+            "project": {
+                "name": "EWMA z-score fallback",
+                "owner": "builtin",
+                "description": "In-process fallback for missing .eim models"
+            },
+            "model_parameters": {
+                "model_type": "ewma",
+                "input_features_count": 2
+            }
+        }
+
+    def classify(self, features):
+        start = time.perf_counter()
+        residual = float(features[0]) - float(features[1])
+
+        with self.lock:
+            std = max(math.sqrt(self.var), self.min_std)
+            z = abs(residual - self.mean) / std
+            if self.count < self.warmup:
+                score = 0.0
+            else:
+                score = min(1.0, z / (2.0 * self.z_threshold))
+
+            if self.count < self.warmup or z <= self.z_threshold:
+                self.count += 1
+                delta = residual - self.mean
+                self.mean += self.alpha * delta
+                self.var = (1.0 - self.alpha) * (self.var + self.alpha * delta * delta)
+
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        return {
+            "result": {"anomaly": score},
+            "timing": {"dsp": 0, "classification": elapsed_ms, "anomaly": 0}
+        }
+
+    def stop(self):
+        pass
+
+
+# Fallback detectors selectable by name, e.g. "builtin:ewma" in
+# config["model_paths"]
+DETECTORS = {
+    "ewma": EwmaDetector,
+}
+
+
+def create_detector(kind, **options):
+    if kind not in DETECTORS:
+        raise ValueError(f"Unknown fallback detector: {kind}")
+    return DETECTORS[kind](**options)
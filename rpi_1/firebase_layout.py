@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# Partitioned Firebase layout and per-minute/per-hour vitals rollups.
+#
+# Records are written under time buckets instead of one unbounded list per
+# device, so a reader fetches a bounded slice:
+#   vitals/<device_id>/<yyyymmddhh>/<push id>
+#   alerts/<device_id>/<yyyymmdd>/<push id>
+#   images/<device_id>/<yyyymmdd>/<push id>
+# Rollups hold min/mean/max per metric, keyed by bucket so they can be read
+# with orderByKey().startAt().endAt():
+#   rollups/<device_id>/minute/<yyyymmddhhmm>
+#   rollups/<device_id>/hour/<yyyymmddhh>
+# and latest/<device_id> holds the newest vitals and image for dashboards.
+# Bucket keys are UTC.
+import time
+import threading
+from datetime import datetime, timezone
+
+RESOLUTIONS = {
+    "minute": ("%Y%m%d%H%M", 60),
+    "hour": ("%Y%m%d%H", 3600),
+    "day": ("%Y%m%d", 86400)
+}
+
+# Bucket size of the raw records of each kind
+PARTITIONS = {
+    "vitals": "hour",
+    "alerts": "day",
+    "images": "day"
+}
+
+ROLLUP_METRICS = ("heart_rate", "spo2")
+
+# 2020-01-01 UTC. Earlier "timestamps" are device uptime, not wall-clock time.
+MIN_EPOCH_MS = 1577836800000
+
+
+def bucket_start(timestamp_ms, resolution):
+    seconds = RESOLUTIONS[resolution][1]
+    return int(timestamp_ms // 1000 // seconds * seconds)
+
+
+def bucket_key(timestamp_ms, resolution):
+    fmt = RESOLUTIONS[resolution][0]
+    return datetime.fromtimestamp(timestamp_ms / 1000.0, timezone.utc).strftime(fmt)
+
+
+# First and last bucket keys covering [start_ms, end_ms], for key-range queries
+def bucket_range(start_ms, end_ms, resolution):
+    return bucket_key(start_ms, resolution), bucket_key(end_ms, resolution)
+
+
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+
+# Creation time (ms) embedded in the first 8 characters of a push id
+def push_id_time(push_id):
+    value = 0
+    for char in push_id[:8]:
+        value = value * 64 + PUSH_CHARS.index(char)
+    return value
+
+
+def record_path(kind, device_id, timestamp_ms):
+    return f"{kind}/{device_id}/{bucket_key(timestamp_ms, PARTITIONS[kind])}"
+
+
+def rollup_path(device_id, resolution, key=None):
+    path = f"rollups/{device_id}/{resolution}"
+    return f"{path}/{key}" if key else path
+
+
+def latest_path(device_id, field=None):
+    return f"latest/{device_id}/{field}" if field else f"latest/{device_id}"
+
+
+class _Stats:
+    __slots__ = ('count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None or value < self.min else self.min
+        self.max = value if self.max is None or value > self.max else self.max
+
+    def merge(self, stored):
+        if not stored or not stored.get("count"):
+            return
+        self.count += stored["count"]
+        self.total += stored["sum"]
+        self.min = stored["min"] if self.min is None else min(self.min, stored["min"])
+        self.max = stored["max"] if self.max is None else max(self.max, stored["max"])
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.total, 3),
+            "min": self.min,
+            "max": self.max,
+            "mean": round(self.total / self.count, 3)
+        }
+
+
+class _Bucket:
+    __slots__ = ('start_ms', 'end_ms', 'stats', 'dirty')
+
+    def __init__(self, start_ms, end_ms):
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.stats = {}
+        self.dirty = False
+
+    def to_dict(self):
+        rollup = {"start": self.start_ms}
+        for metric, stats in self.stats.items():
+            rollup[metric] = stats.to_dict()
+        return rollup
+
+
+def compute_rollups(readings, resolutions=("minute", "hour")):
+    buckets = {}
+    for reading in readings:
+        timestamp = reading["timestamp"]
+        for resolution in resolutions:
+            key = bucket_key(timestamp, resolution)
+            bucket = buckets.get((resolution, key))
+            if bucket is None:
+                start = bucket_start(timestamp, resolution) * 1000
+                bucket = buckets[(resolution, key)] = _Bucket(start, start + RESOLUTIONS[resolution][1] * 1000)
+            for metric in ROLLUP_METRICS:
+                value = reading.get(metric)
+                if value is not None:
+                    bucket.stats.setdefault(metric, _Stats()).add(value)
+    return {(resolution, key): bucket.to_dict() for (resolution, key), bucket in buckets.items()}
+
+
+# Maintains rollups for the open buckets of each device as vitals arrive.
+# flush() returns a multi-path update for the buckets that changed since the
+# last flush; a bucket stays in memory until `grace` seconds after it ends,
+# so readings arriving slightly late still count. A reading for a bucket
+# already dropped is counted in `late` and left out of the rollup.
+#
+# `loader(path)` reads an existing rollup. It is used for a bucket that was
+# open when the server started, or when the device was adopted from another
+# node, so the stored partial rollup is merged rather than overwritten. The
+# reads are made by flush(), outside the lock, so add() never waits on the
+# database; a bucket isn't written until its stored rollup is merged.
+class RollupAggregator:
+    def __init__(self, resolutions=("minute", "hour"), grace=120.0, loader=None):
+        self.resolutions = resolutions
+        self.grace = grace
+        self.loader = loader
+        self.started_ms = int(time.time() * 1000)
+        self.adopted = {}   # device_id -> time it was adopted (ms)
+        self.lock = threading.Lock()
+        self.buckets = {}   # (device_id, resolution, key) -> _Bucket
+        self.unmerged = {}  # bucket id -> _Bucket whose stored rollup isn't merged yet
+        self.flush_lock = threading.Lock()
+        self.latest = {}    # device_id -> newest reading, until flushed
+        self.late = 0
+
+    def add(self, device_id, timestamp_ms, values):
+        now_ms = time.time() * 1000
+        with self.lock:
+            for resolution in self.resolutions:
+                seconds = RESOLUTIONS[resolution][1]
+                start_ms = bucket_start(timestamp_ms, resolution) * 1000
+                end_ms = start_ms + seconds * 1000
+                key = bucket_key(timestamp_ms, resolution)
+                bucket = self.buckets.get((device_id, resolution, key))
+                if bucket is None:
+                    if end_ms + self.grace * 1000 < now_ms:
+                        self.late += 1
+                        continue
+                    bucket = self.buckets[(device_id, resolution, key)] = _Bucket(start_ms, end_ms)
+                    if self.loader is not None and start_ms < self.adopted.get(device_id, self.started_ms):
+                        self.unmerged[(device_id, resolution, key)] = bucket
+                for metric, value in values.items():
+                    if value is not None:
+                        stats = bucket.stats.get(metric)
+                        if stats is None:
+                            stats = bucket.stats[metric] = _Stats()
+                        stats.add(value)
+                bucket.dirty = True
+            latest = self.latest.get(device_id)
+            if latest is None or timestamp_ms >= latest["timestamp"]:
+                reading = {"timestamp": timestamp_ms}
+                reading.update((k, v) for k, v in values.items() if v is not None)
+                self.latest[device_id] = reading
+
+    def _merge_stored(self):
+        with self.lock:
+            pending = list(self.unmerged.items())
+        for (device_id, resolution, key), bucket in pending:
+            try:
+                stored = self.loader(rollup_path(device_id, resolution, key)) or {}
+            except Exception:
+                stored = {}
+            with self.lock:
+                for metric in ROLLUP_METRICS:
+                    if metric in stored:
+                        stats = bucket.stats.get(metric)
+                        if stats is None:
+                            stats = bucket.stats[metric] = _Stats()
+                        stats.merge(stored[metric])
+                if self.unmerged.get((device_id, resolution, key)) is bucket:
+                    del self.unmerged[(device_id, resolution, key)]
+
+    # Multi-path update {path: value} for changed rollups and latest values;
+    # closed buckets past their grace period are dropped after this flush
+    def flush(self):
+        with self.flush_lock:
+            self._merge_stored()
+            return self._take_updates()
+
+    def _take_updates(self):
+        now_ms = time.time() * 1000
+        updates = {}
+        with self.lock:
+            for bucket_id, bucket in list(self.buckets.items()):
+                if bucket_id in self.unmerged:
+                    continue
+                device_id, resolution, key = bucket_id
+                if bucket.dirty:
+                    updates[rollup_path(device_id, resolution, key)] = bucket.to_dict()
+                    bucket.dirty = False
+                if bucket.end_ms + self.grace * 1000 < now_ms:
+                    del self.buckets[bucket_id]
+            for device_id, reading in self.latest.items():
+                updates[latest_path(device_id, "vitals")] = reading
+            self.latest = {}
+        return updates
+
+    # The device's earlier samples were aggregated by another node; merge
+    # with the stored rollups for buckets that are already open
+    def adopt(self, device_id):
+        with self.lock:
+            self.adopted[device_id] = int(time.time() * 1000)
+
+    def forget(self, device_id):
+        with self.lock:
+            for bucket_id in [b for b in self.buckets if b[0] == device_id]:
+                del self.buckets[bucket_id]
+                self.unmerged.pop(bucket_id, None)
+            self.latest.pop(device_id, None)
+            self.adopted.pop(device_id, None)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# Batched Firebase writes for the asyncio runtime (async_server.py).
+#
+# Instead of one blocking round trip per push, writes wait here and are sent
+# as one multi-path update from the root every flush_interval, or as soon as
+# batch_size writes are waiting. Push ids are generated locally, so a caller
+# gets the new record's key at once, as it would from db.push(). A failed
+# update is retried with back-off and the writes made meanwhile applied on
+# top; past max_pending waiting writes the oldest are dropped.
+#
+# A multi-path update can't hold both a path and one of its ancestors, so a
+# write below a waiting path is folded into that path's value, and a write
+# above waiting paths replaces them.
+#
+# push() and update() may be called from any thread; run() is a coroutine.
+# firebase_admin has no asynchronous API, so the update itself is made on a
+# single writer thread.
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from backends import push_ids, split_path
+
+MAX_RETRY_DELAY = 30.0
+
+metric_writes = metrics.registry.counter(
+    "outbox_writes_total", "Firebase writes queued in the outbox, by node", ("node",))
+metric_flush = metrics.registry.histogram(
+    "outbox_flush_seconds", "Duration of the outbox's multi-path updates")
+metric_failures = metrics.registry.counter(
+    "outbox_flush_failures_total", "Outbox multi-path updates that failed and will be retried")
+metric_dropped = metrics.registry.counter(
+    "outbox_dropped_total", "Writes dropped because the outbox was full")
+
+
+# What push() returns in place of a db.Reference: the new record's path and key
+class OutboxRef:
+    __slots__ = ('path', 'key')
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+
+
+# Copy of `target` with `value` set at the nested location `parts`
+def _assign(target, parts, value):
+    target = dict(target) if isinstance(target, dict) else {}
+    if len(parts) == 1:
+        target[parts[0]] = value
+    else:
+        target[parts[0]] = _assign(target.get(parts[0]), parts[1:], value)
+    return target
+
+
+class Outbox:
+    # `write(updates)` makes one blocking multi-path update from the root
+    def __init__(self, write, flush_interval=0.2, batch_size=500, max_pending=100000, log=None):
+        self.write = write
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.log = log
+        self.lock = threading.Lock()
+        self.pending = {}     # path -> value, oldest first
+        self.ancestors = {}   # path -> number of pending paths below it
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="outbox")
+        self.loop = None
+        self.loop_thread = None
+        self.wakeup = None
+        metrics.registry.gauge(
+            "outbox_pending", "Writes waiting in the outbox").set_function(lambda: len(self.pending))
+
+    def push(self, path, value, node):
+        key = push_ids.generate()
+        path = f"{'/'.join(split_path(path))}/{key}"
+        self._put([(path, value)], node)
+        return OutboxRef(path, key)
+
+    # Set each of `values` (relative paths) below `path`, like Reference.update()
+    def update(self, path, values, node):
+        base = split_path(path)
+        self._put([('/'.join(base + split_path(key)), value) for key, value in values.items()], node)
+
+    def size(self):
+        return len(self.pending)
+
+    def _put(self, writes, node):
+        with self.lock:
+            for path, value in writes:
+                self._set(path, value)
+            while len(self.pending) > self.max_pending:
+                self._remove(next(iter(self.pending)))
+                metric_dropped.inc()
+            full = len(self.pending) >= self.batch_size
+        metric_writes.labels(node).inc(len(writes))
+        if full:
+            self._wake()
+
+    def _set(self, path, value):
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            ancestor = '/'.join(parts[:i])
+            if ancestor in self.pending:
+                self.pending[ancestor] = _assign(self.pending[ancestor], parts[i:], value)
+                return
+        if path in self.ancestors:
+            for descendant in [p for p in self.pending if p.startswith(path + '/')]:
+                self._remove(descendant)
+        if path not in self.pending:
+            for i in range(1, len(parts)):
+                ancestor = '/'.join(parts[:i])
+                self.ancestors[ancestor] = self.ancestors.get(ancestor, 0) + 1
+        self.pending[path] = value
+
+    def _remove(self, path):
+        del self.pending[path]
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            ancestor = '/'.join(parts[:i])
+            count = self.ancestors[ancestor] - 1
+            if count:
+                self.ancestors[ancestor] = count
+            else:
+                del self.ancestors[ancestor]
+
+    def _take(self, limit):
+        with self.lock:
+            if len(self.pending) <= limit:
+                batch = self.pending
+                self.pending = {}
+                self.ancestors = {}
+                return batch
+            batch = {}
+            for path in list(self.pending)[:limit]:
+                batch[path] = self.pending[path]
+                self._remove(path)
+            return batch
+
+    # Put a failed batch back in front of the writes made since it was taken
+    def _restore(self, batch):
+        with self.lock:
+            newer = self.pending
+            self.pending = {}
+            self.ancestors = {}
+            for path, value in batch.items():
+                self._set(path, value)
+            for path, value in newer.items():
+                self._set(path, value)
+
+    def _wake(self):
+        if self.loop is None:
+            return
+        if threading.get_ident() == self.loop_thread:
+            self.wakeup.set()
+        else:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    # Send everything waiting, batch_size writes per update. Returns False if
+    # an update failed; its writes are kept for the next attempt.
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = self._take(self.batch_size)
+            if not batch:
+                return True
+            start = time.perf_counter()
+            try:
+                await loop.run_in_executor(self.executor, self.write, batch)
+            except Exception as e:
+                metric_failures.inc()
+                if self.log:
+                    self.log.error("outbox_flush_failed", writes=len(batch), error=str(e))
+                self._restore(batch)
+                return False
+            metric_flush.observe(time.perf_counter() - start)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.wakeup = asyncio.Event()
+        delay = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if await self.flush():
+                delay = self.flush_interval
+            else:
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    # Flush until empty or `timeout` seconds pass; returns the writes left
+    async def drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            if not await self.flush():
+                await asyncio.sleep(min(1.0, max(0.0, deadline - time.monotonic())))
+        return len(self.pending)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Background image processing for uploads from the ESP32 cameras.
+#
+# Each upload is decoded once in a worker process, and two variants are
+# written next to each other in the variant directory:
+#   <name>_thumb.jpg  longest side <= thumb_size, for dashboard lists
+#   <name>_web.jpg    longest side <= web_max_side, re-encoded at `quality`
+# The worker also computes a 64-bit difference hash (dHash) of the frame, used
+# to spot near-duplicate images. The request thread only hands over the file
+# path; decoding and encoding run in a process pool so the work spreads
+# across all cores.
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+
+def _init_worker():
+    # One OpenCV thread per worker process; the pool provides the parallelism
+    cv2.setNumThreads(1)
+
+
+def _resize_to(image, max_side):
+    height, width = image.shape[:2]
+    scale = max_side / float(max(height, width))
+    if scale >= 1.0:
+        return image
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def _write_jpeg(path, image, quality):
+    tmp_path = path[:-len(".jpg")] + ".tmp.jpg"
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    if not cv2.imwrite(tmp_path, image, params):
+        raise IOError(f"Failed to encode {path}")
+    os.replace(tmp_path, path)
+
+
+# 64-bit dHash: compare neighbouring pixels of a 9x8 grayscale thumbnail
+def difference_hash(image):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return f"{value:016x}"
+
+
+# Worker function: decode `src_path` and write its variants into `out_dir`
+def make_variants(src_path, out_dir, thumb_size, web_max_side, quality):
+    start = time.perf_counter()
+    image = cv2.imread(src_path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not decode image {src_path}")
+    height, width = image.shape[:2]
+
+    name = os.path.splitext(os.path.basename(src_path))[0]
+    web_path = os.path.join(out_dir, f"{name}_web.jpg")
+    thumb_path = os.path.join(out_dir, f"{name}_thumb.jpg")
+
+    os.makedirs(out_dir, exist_ok=True)
+    web = _resize_to(image, web_max_side)
+    _write_jpeg(web_path, web, quality)
+    # The thumbnail is cut from the already downscaled web variant
+    _write_jpeg(thumb_path, _resize_to(web, thumb_size), quality)
+
+    return {
+        "width": width,
+        "height": height,
+        "web_path": web_path,
+        "web_bytes": os.path.getsize(web_path),
+        "thumbnail_path": thumb_path,
+        "thumbnail_bytes": os.path.getsize(thumb_path),
+        "dhash": difference_hash(web),
+        "processing_ms": round((time.perf_counter() - start) * 1000.0, 2)
+    }
+
+
+class ImagePipeline:
+    def __init__(self, out_dir, workers=None, thumb_size=160, web_max_side=800, quality=80):
+        self.out_dir = out_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.thumb_size = thumb_size
+        self.web_max_side = web_max_side
+        self.quality = quality
+        self.pool = None
+
+    @property
+    def started(self):
+        return self.pool is not None
+
+    # Fork the worker processes. Call this before the server starts its
+    # threads, so no lock is held by another thread at fork time.
+    def start(self):
+        if self.pool is not None:
+            return
+        os.makedirs(self.out_dir, exist_ok=True)
+        context = multiprocessing.get_context("fork")
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=context, initializer=_init_worker)
+        # The first submit launches every worker; wait for it so the forks
+        # happen now rather than on the first upload
+        self.pool.submit(os.getpid).result()
+
+    # Queue an image; callback(result, error) runs when its variants are
+    # ready. Variants go to `out_dir`, or the pipeline's directory by default.
+    def submit(self, src_path, callback, out_dir=None):
+        future = self.pool.submit(
+            make_variants, src_path, out_dir or self.out_dir,
+            self.thumb_size, self.web_max_side, self.quality
+        )
+
+        def done(f):
+            try:
+                result = f.result()
+            except Exception as e:
+                callback(None, e)
+                return
+            callback(result, None)
+
+        future.add_done_callback(done)
+        return future
+
+    def shutdown(self, wait=True):
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait)
+            self.pool = None
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# Forwards accepted uploads to the rpi_2 receiver as they arrive.
+#
+# A few worker threads each keep one keep-alive HTTP connection to the peer
+# and stream the upload's bytes straight from memory with chunked transfer
+# encoding, so an image reaches rpi_2 in milliseconds instead of waiting for
+# ImagesTrans to notice the file and copy it.
+#
+# If the peer is unreachable or the relay's queue is full, the upload is
+# written to a journal and sent again over HTTP once the peer is back, so
+# rpi_2 still indexes it under its device and capture time. After a
+# connection failure the peer is treated as down for `retry_interval`
+# seconds, so uploads are deferred immediately rather than each waiting for
+# a timeout. With the relay disabled, images are linked into the outbox
+# directory instead, which ImagesTrans replicates in batches.
+import os
+import json
+import time
+import queue
+import shutil
+import threading
+import http.client
+from urllib.parse import urlsplit
+
+import metrics
+
+metric_relay = metrics.registry.counter(
+    "image_relay_total", "Uploads forwarded to the peer, deferred or spooled for replication", ("result",))
+metric_relay_seconds = metrics.registry.histogram(
+    "image_relay_seconds", "Time to stream an upload to the peer")
+
+
+# A response that sending the same upload again won't change
+def rejected(status):
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+class ImageRelay:
+    def __init__(self, url, outbox_dir, enabled=True, workers=2, queue_size=64,
+                 timeout=5.0, retry_interval=10.0, chunk_size=64 * 1024, journal_path=None, log=None):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.https = parts.scheme == "https"
+        self.path = parts.path or "/"
+        self.outbox_dir = outbox_dir
+        self.enabled = enabled
+        self.workers = workers
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.chunk_size = chunk_size
+        self.log = log
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.down_until = 0.0
+        self.threads = []
+        self.journal_path = journal_path or os.path.join(outbox_dir, os.pardir, "relay_journal.jsonl")
+        self.journal = None
+        self.lock = threading.Lock()
+        self.deferred = {}  # key -> (device_id, entry), oldest first
+        self.done_records = 0
+        os.makedirs(outbox_dir, exist_ok=True)
+
+    def start(self):
+        if not self.enabled or self.threads:
+            return
+        self._load_journal()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"image-relay-{i}")
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self._retry, name="image-relay-retry")
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    # Hand over a stored upload (its image_store entry and bytes); never blocks
+    def submit(self, device_id, entry, data):
+        if not self.threads:
+            self.spool(entry)
+            return
+        if time.monotonic() < self.down_until:
+            self.defer(device_id, entry)
+            return
+        try:
+            self.queue.put_nowait((device_id, entry, data))
+        except queue.Full:
+            self.defer(device_id, entry)
+
+    # Journal an upload the peer didn't get, for the retry thread to send
+    def defer(self, device_id, entry):
+        key = f"{entry['timestamp']}/{entry['hash']}/{device_id}"
+        record = {"op": "add", "key": key, "device_id": device_id, "entry": entry}
+        with self.lock:
+            if key in self.deferred:
+                return
+            self.deferred[key] = (device_id, entry)
+            self._append([record])
+        metric_relay.labels("deferred").inc()
+
+    def pending(self):
+        with self.lock:
+            return len(self.deferred)
+
+    def _complete(self, key):
+        with self.lock:
+            if self.deferred.pop(key, None) is None:
+                return
+            self._append([{"op": "done", "key": key}])
+            self.done_records += 1
+            if self.done_records > 1000 and self.done_records > 4 * len(self.deferred):
+                self.journal.close()
+                self._rewrite_journal()
+
+    # Replay the journal, dropping uploads whose blob is gone, and compact it
+    def _load_journal(self):
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line after a crash
+                    if record["op"] == "add":
+                        self.deferred[record["key"]] = (record["device_id"], record["entry"])
+                    else:
+                        self.deferred.pop(record["key"], None)
+        self.deferred = {key: (device_id, entry) for key, (device_id, entry) in self.deferred.items()
+                         if os.path.exists(entry["path"])}
+        self._rewrite_journal()
+        if self.deferred and self.log:
+            self.log.info("image_relay_resuming", deferred=len(self.deferred))
+
+    def _rewrite_journal(self):
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            for key, (device_id, entry) in self.deferred.items():
+                f.write(json.dumps({"op": "add", "key": key, "device_id": device_id, "entry": entry}) + '\n')
+        os.replace(tmp_path, self.journal_path)
+        self.journal = open(self.journal_path, 'a')
+        self.done_records = 0
+
+    def _append(self, records):
+        self.journal.write(''.join(json.dumps(r) + '\n' for r in records))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    # Link the stored blob into the outbox for ImagesTrans to replicate
+    def spool(self, entry):
+        target = os.path.join(self.outbox_dir, entry["filename"])
+        try:
+            try:
+                os.link(entry["path"], target)
+            except FileExistsError:
+                pass
+            except OSError:
+                # No hard links on this filesystem; fall back to a copy
+                shutil.copyfile(entry["path"], target + ".tmp")
+                os.replace(target + ".tmp", target)
+        except OSError as e:
+            metric_relay.labels("failed").inc()
+            if self.log:
+                self.log.error("image_spool_failed", path=entry["path"], error=str(e))
+            return
+        metric_relay.labels("spooled").inc()
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def _chunks(self, data):
+        view = memoryview(data)
+        for offset in range(0, len(view), self.chunk_size):
+            yield view[offset:offset + self.chunk_size]
+
+    def _send(self, connection, device_id, entry, data):
+        headers = {
+            "Content-Type": "image/jpeg",
+            "Transfer-Encoding": "chunked",
+            "Device-ID": device_id,
+            "X-Content-SHA256": entry["hash"],
+            "X-Timestamp": str(entry["timestamp"])
+        }
+        connection.request("POST", self.path, body=self._chunks(data), headers=headers, encode_chunked=True)
+        response = connection.getresponse()
+        response.read()  # Drain so the connection can be reused
+        return response.status
+
+    # An upload that fails for any reason other than the network (a device ID
+    # that is not a valid header value, say) would fail the same way again, so
+    # it is dropped and counted rather than deferred
+    def _failed(self, device_id):
+        metric_relay.labels("failed").inc()
+        if self.log:
+            self.log.exception("image_relay_failed", device_id=device_id)
+
+    def _run(self):
+        connection = None
+        while True:
+            device_id, entry, data = self.queue.get()
+            try:
+                start = time.perf_counter()
+                status = None
+                # A kept-alive connection may have been closed by the peer since
+                # the last upload, so a failure on a reused one is retried once
+                for attempt in range(2):
+                    reused = connection is not None
+                    if connection is None:
+                        connection = self._connect()
+                    try:
+                        status = self._send(connection, device_id, entry, data)
+                        break
+                    except (OSError, http.client.HTTPException) as e:
+                        connection.close()
+                        connection = None
+                        if not reused:
+                            self.down_until = time.monotonic() + self.retry_interval
+                            if self.log:
+                                self.log.warning("image_relay_peer_down", error=str(e), retry_in=self.retry_interval)
+                            break
+                    except Exception:
+                        connection.close()
+                        connection = None
+                        raise
+
+                if status is not None and 200 <= status < 300:
+                    metric_relay_seconds.observe(time.perf_counter() - start)
+                    metric_relay.labels("sent").inc()
+                elif rejected(status):
+                    metric_relay.labels("rejected").inc()
+                    if self.log:
+                        self.log.warning("image_relay_rejected", device_id=device_id, status=status)
+                else:
+                    self.defer(device_id, entry)
+            except Exception:
+                self._failed(device_id)
+            finally:
+                self.queue.task_done()
+
+    # Every retry_interval, while the peer is up, send the deferred uploads
+    # oldest first, reading them back from the image store. One the peer
+    # refuses for good is dropped; a connection failure ends the round.
+    def _retry(self):
+        connection = None
+        while True:
+            time.sleep(self.retry_interval)
+            try:
+                connection = self._retry_round(connection)
+            except Exception:
+                # The journal could not be written, say; try again next round
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                if self.log:
+                    self.log.exception("image_relay_retry_failed")
+
+    # One pass over the deferred uploads; returns the connection to reuse
+    def _retry_round(self, connection):
+        with self.lock:
+            deferred = list(self.deferred.items())
+        for key, (device_id, entry) in deferred:
+            if time.monotonic() < self.down_until:
+                break
+            try:
+                with open(entry["path"], 'rb') as f:
+                    data = f.read()
+            except OSError:
+                self._complete(key)  # The blob is gone; nothing left to send
+                continue
+            try:
+                if connection is None:
+                    connection = self._connect()
+                status = self._send(connection, device_id, entry, data)
+            except (OSError, http.client.HTTPException) as e:
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                self.down_until = time.monotonic() + self.retry_interval
+                if self.log:
+                    self.log.warning("image_relay_peer_down", error=str(e), retry_in=self.retry_interval)
+                break
+            except Exception:
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                self._failed(device_id)
+                self._complete(key)
+                continue
+            if 200 <= status < 300:
+                metric_relay.labels("sent").inc()
+                self._complete(key)
+            elif rejected(status):
+                metric_relay.labels("rejected").inc()
+                if self.log:
+                    self.log.warning("image_relay_rejected", device_id=device_id, status=status)
+                self._complete(key)
+        return connection
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# Content-addressed image storage.
+#
+# Images are stored once per distinct content, named by their SHA-256 and
+# sharded two directory levels deep so no directory grows without bound:
+#   <root>/blobs/ab/cd/abcd....jpg
+# Uploading the same bytes again (a static camera, a retried request) only
+# adds an index entry. Each device has an append-only JSON-lines index,
+#   <root>/index/<URL-quoted device_id>.jsonl
+# mapping upload time to blob, which is loaded into memory on first use so
+# listing a device's images never scans the blob directories.
+#
+# Optionally, perceptual hashes (dHash, computed by the image pipeline) are
+# compared with the device's recent uploads to flag near-duplicate frames.
+import os
+import json
+import time
+import bisect
+import hashlib
+import threading
+from collections import deque
+from urllib.parse import quote
+
+
+# File name for a device id: every character that isn't safe in a name is
+# %-escaped, so distinct ids ("a/b", "a_b") never share an index
+def _safe_name(device_id):
+    return quote(device_id, safe='-_.') or '%'
+
+
+class ImageStore:
+    def __init__(self, root, variant_root, near_duplicate_distance=None, near_duplicate_window=10):
+        self.root = root
+        self.variant_root = variant_root
+        self.near_duplicate_distance = near_duplicate_distance
+        self.near_duplicate_window = near_duplicate_window
+        self.lock = threading.Lock()
+        # device_id -> (timestamps, entries), both sorted by timestamp
+        self.devices = {}
+        self.recent_phashes = {}
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(root, "index"), exist_ok=True)
+
+    @staticmethod
+    def _shard(digest):
+        return os.path.join(digest[:2], digest[2:4])
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, "blobs", self._shard(digest), f"{digest}.jpg")
+
+    def variant_dir(self, digest):
+        return os.path.join(self.variant_root, self._shard(digest))
+
+    def _index_path(self, device_id):
+        return os.path.join(self.root, "index", f"{_safe_name(device_id)}.jsonl")
+
+    def _load_device(self, device_id):
+        device = self.devices.get(device_id)
+        if device is not None:
+            return device
+        timestamps, entries = [], []
+        by_hash = {}
+        path = self._index_path(device_id)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line after a crash
+                    if record.get("type") == "annotation":
+                        entry = by_hash.get(record["hash"])
+                        if entry is not None:
+                            entry.update(record["fields"])
+                        continue
+                    i = bisect.bisect_right(timestamps, record["timestamp"])
+                    timestamps.insert(i, record["timestamp"])
+                    entries.insert(i, record)
+                    by_hash[record["hash"]] = record
+        device = self.devices[device_id] = (timestamps, entries)
+        return device
+
+    def _append_index(self, device_id, record):
+        with open(self._index_path(device_id), 'a') as f:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    # Store an image, returning its index entry; "duplicate" is True when the
+    # same content was already stored
+    def put(self, device_id, data, timestamp=None):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        duplicate = os.path.exists(path)
+        if not duplicate:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        entry = {
+            "timestamp": timestamp if timestamp is not None else int(time.time() * 1000),
+            "hash": digest,
+            "filename": os.path.basename(path),
+            "path": path,
+            "size": len(data),
+            "duplicate": duplicate
+        }
+        with self.lock:
+            timestamps, entries = self._load_device(device_id)
+            i = bisect.bisect_right(timestamps, entry["timestamp"])
+            timestamps.insert(i, entry["timestamp"])
+            entries.insert(i, entry)
+            self._append_index(device_id, entry)
+        return entry
+
+    # Attach extra fields (variant paths, perceptual hash, ...) to the most
+    # recent entry for `digest`
+    def annotate(self, device_id, digest, fields):
+        with self.lock:
+            _, entries = self._load_device(device_id)
+            for entry in reversed(entries):
+                if entry["hash"] == digest:
+                    entry.update(fields)
+                    break
+            self._append_index(device_id, {"type": "annotation", "hash": digest, "fields": fields})
+
+    # Compare a perceptual hash with the device's recent uploads. Returns the
+    # content hash of a near-duplicate, or None.
+    def find_near_duplicate(self, device_id, digest, phash):
+        if self.near_duplicate_distance is None:
+            return None
+        value = int(phash, 16)
+        with self.lock:
+            recent = self.recent_phashes.get(device_id)
+            if recent is None:
+                recent = self.recent_phashes[device_id] = deque(maxlen=self.near_duplicate_window)
+            match = None
+            for other_digest, other_value in recent:
+                if other_digest != digest and bin(value ^ other_value).count('1') <= self.near_duplicate_distance:
+                    match = other_digest
+                    break
+            recent.append((digest, value))
+            return match
+
+    # Index entries for a device, optionally bounded by time (ms) and count
+    def list(self, device_id, start=None, end=None, limit=None):
+        if limit is not None and limit < 0:
+            raise ValueError(f"limit must not be negative: {limit}")
+        with self.lock:
+            timestamps, entries = self._load_device(device_id)
+            lo = bisect.bisect_left(timestamps, start) if start is not None else 0
+            hi = bisect.bisect_right(timestamps, end) if end is not None else len(entries)
+            selected = entries[lo:hi]
+        if limit is not None:
+            selected = selected[len(selected) - limit:] if limit < len(selected) else selected
+        return [dict(entry) for entry in selected]
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import threading
+from collections import OrderedDict
+
+
+# Bounded LRU cache of model results keyed on the model name plus the
+# quantized feature vector. Vitals are low-resolution integers, so the same
+# feature vectors come up again and again; a hit skips the round trip to the
+# .eim subprocess entirely.
+#
+# Each model has a generation number that is bumped when the model is
+# (re)loaded, so results from an old model are never served for a new one.
+class InferenceCache:
+    def __init__(self, max_size=4096, quantum=0.1):
+        self.max_size = max_size
+        self.quantum = quantum
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generations = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        # Moving average of the real classify() time per model, used to
+        # estimate how much IPC time each hit saved
+        self.avg_classify_seconds = {}
+
+    def _key(self, model_name, features):
+        quantized = tuple(int(round(float(f) / self.quantum)) for f in features)
+        return (model_name, self.generations.get(model_name, 0), quantized)
+
+    def get(self, model_name, features):
+        key = self._key(model_name, features)
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += self.avg_classify_seconds.get(model_name, 0.0)
+            return result
+
+    def put(self, model_name, features, result, elapsed_seconds):
+        key = self._key(model_name, features)
+        with self.lock:
+            avg = self.avg_classify_seconds.get(model_name)
+            self.avg_classify_seconds[model_name] = (
+                elapsed_seconds if avg is None else avg + 0.1 * (elapsed_seconds - avg)
+            )
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    # Drop cached results for one model (or all models) after a reload
+    def invalidate(self, model_name=None):
+        with self.lock:
+            names = [model_name] if model_name else list(self.generations) + [
+                key[0] for key in self.entries
+            ]
+            for name in set(names):
+                self.generations[name] = self.generations.get(name, 0) + 1
+                self.avg_classify_seconds.pop(name, None)
+            self.entries = OrderedDict(
+                (key, value) for key, value in self.entries.items()
+                if key[0] not in names
+            )
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_ipc_seconds": round(self.saved_seconds, 6)
+            }
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# Deadlines and circuit breakers for .eim inference.
+#
+# A runner's classify() is a blocking round trip to its subprocess, and a
+# hung subprocess would block the caller for good. Here each call runs on
+# the model's own thread while the caller waits until the call's deadline.
+# A call still queued at its deadline is cancelled; one already running is
+# abandoned, and reported as a timeout.
+#
+# Timeouts and errors count against the model's circuit breaker. After
+# failure_threshold of them in a row the breaker opens: calls fail at once
+# (the server then relies on its threshold rules), and the runner is
+# restarted through the model registry. After reset_seconds one probe call
+# is let through; if it succeeds the breaker closes, otherwise it opens
+# again. While closed, a stuck runner costs each caller at most its timeout,
+# and at most failure_threshold calls before the breaker opens.
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import metrics
+
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+STATE_NAMES = {CLOSED: "closed", HALF_OPEN: "half_open", OPEN: "open"}
+
+metric_timeouts = metrics.registry.counter(
+    "inference_timeouts_total", "Inference calls that missed their deadline, by model", ("model",))
+metric_failures = metrics.registry.counter(
+    "inference_failures_total", "Inference calls that raised an error, by model", ("model",))
+metric_rejected = metrics.registry.counter(
+    "inference_rejected_total", "Inference calls refused while the model's circuit breaker was open", ("model",))
+metric_trips = metrics.registry.counter(
+    "circuit_breaker_trips_total", "Times a model's circuit breaker opened", ("model",))
+metric_state = metrics.registry.gauge(
+    "circuit_breaker_state", "Model circuit breaker state (0 closed, 1 half-open, 2 open)", ("model",))
+
+
+# Raised instead of a result when a model can't be used for this call
+class InferenceUnavailable(Exception):
+    pass
+
+
+class InferenceTimeout(InferenceUnavailable):
+    pass
+
+
+class CircuitOpen(InferenceUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=3, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    # Whether a call may go ahead; in half-open state only one probe at a time
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_seconds:
+                    return False
+                self.state = HALF_OPEN
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+
+    # The call never reached the model; neither success nor failure
+    def cancel(self):
+        with self.lock:
+            self.probing = False
+
+    # Returns True if this failure opened the breaker
+    def failure(self):
+        with self.lock:
+            self.probing = False
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+class InferenceGuard:
+    # `registry` is the server's ModelRegistry; calls get their runner from
+    # it and a tripped model is restarted through it
+    def __init__(self, registry, options, log=None):
+        self.registry = registry
+        self.timeouts = options["timeout_ms"]
+        self.failure_threshold = options["failure_threshold"]
+        self.reset_seconds = options["reset_seconds"]
+        self.log = log
+        self.lock = threading.Lock()
+        self.executors = {}
+        self.breakers = {}
+        self.restarting = set()
+
+    def breaker(self, model_name):
+        breaker = self.breakers.get(model_name)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.get(model_name)
+                if breaker is None:
+                    breaker = self.breakers[model_name] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+                    metric_state.labels(model_name).set_function(lambda: breaker.state)
+        return breaker
+
+    def timeout(self, model_name):
+        return self.timeouts.get(model_name, self.timeouts["default"]) / 1000.0
+
+    def executor(self, model_name):
+        with self.lock:
+            executor = self.executors.get(model_name)
+            if executor is None:
+                executor = self.executors[model_name] = ThreadPoolExecutor(
+                    1, thread_name_prefix=f"classify-{model_name}")
+            return executor
+
+    def _run(self, model_name, features):
+        with self.registry.use(model_name) as model:
+            if model is None:
+                raise InferenceUnavailable(f"{model_name} is not loaded")
+            return model.classify(features)
+
+    # classify() on the model's current runner, by `deadline` (a
+    # time.monotonic() value; by default the model's timeout from now).
+    # Raises InferenceUnavailable if the breaker is open or the deadline
+    # passes, and re-raises the runner's own errors.
+    def classify(self, model_name, features, deadline=None):
+        breaker = self.breaker(model_name)
+        if not breaker.allow():
+            metric_rejected.labels(model_name).inc()
+            raise CircuitOpen(f"{model_name} circuit breaker is open")
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout(model_name)
+        elif deadline <= time.monotonic():
+            # Spent waiting to be called; not the model's fault
+            breaker.cancel()
+            metric_timeouts.labels(model_name).inc()
+            raise InferenceTimeout(f"{model_name} call's deadline passed before it started")
+        future = self.executor(model_name).submit(self._run, model_name, features)
+        try:
+            res = future.result(max(0.0, deadline - time.monotonic()))
+        except (FutureTimeout, CancelledError):
+            future.cancel()
+            metric_timeouts.labels(model_name).inc()
+            self._failed(model_name, breaker, "timeout")
+            raise InferenceTimeout(f"{model_name} missed its deadline")
+        except InferenceUnavailable:
+            breaker.cancel()
+            raise
+        except Exception as e:
+            metric_failures.labels(model_name).inc()
+            self._failed(model_name, breaker, str(e))
+            raise
+        breaker.success()
+        return res
+
+    def _failed(self, model_name, breaker, reason):
+        if not breaker.failure():
+            return
+        metric_trips.labels(model_name).inc()
+        if self.log:
+            self.log.error("circuit_breaker_open", model=model_name, reason=reason,
+                           retry_seconds=self.reset_seconds)
+        self.restart(model_name)
+
+    # Start a new runner for the model. Calls stuck on the old runner keep
+    # its thread until the registry stops it, so later calls get a new thread.
+    def restart(self, model_name):
+        with self.lock:
+            if model_name in self.restarting:
+                return
+            self.restarting.add(model_name)
+            executor = self.executors.pop(model_name, None)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        def run():
+            try:
+                self.registry.restart(model_name)
+            finally:
+                with self.lock:
+                    self.restarting.discard(model_name)
+
+        threading.Thread(target=run, name=f"restart-{model_name}", daemon=True).start()
+
+    def status(self):
+        return {
+            model_name: {"state": STATE_NAMES[breaker.state], "failures": breaker.failures}
+            for model_name, breaker in list(self.breakers.items())
+        }
+
+    def shutdown(self):
+        with self.lock:
+            executors = list(self.executors.values())
+            self.executors = {}
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Move existing Firebase data from the flat per-device lists
+#   devices/<device_id>/{vitals,alerts,images}/<push id>
+# to the partitioned layout in firebase_layout.py, and rebuild the vitals
+# rollups for every hour that received migrated data.
+#
+# Records keep their push ids. A record without a timestamp, or with the
+# firmware's millis() uptime in place of one, is dated by its push id's
+# creation time, as the server dates such messages by their receive time;
+# the uptime is kept as "device_ms". Rollups are recomputed from the whole
+# partitioned hour (including anything the server wrote there meanwhile), so
+# the migration can be interrupted and run again. Old lists are only removed
+# with --delete-old.
+#
+#   python migrate_firebase_layout.py --dry-run
+#   python migrate_firebase_layout.py --devices wearable_001 --delete-old
+import time
+import argparse
+
+import firebase_admin
+from firebase_admin import credentials
+from firebase_admin import db
+
+import firebase_layout
+
+CREDENTIALS = "smart-healthcare-3a0d6-firebase-adminsdk-fbsvc-e3b80a3443.json"
+DATABASE_URL = "https://smart-healthcare-3a0d6-default-rtdb.firebaseio.com/"
+KINDS = ("vitals", "alerts", "images")
+
+
+# Read a large list in key order, `page_size` records at a time
+def read_pages(path, page_size):
+    cursor = None
+    while True:
+        query = db.reference(path).order_by_key()
+        if cursor is not None:
+            query = query.start_at(cursor)
+        page = query.limit_to_first(page_size + (cursor is not None)).get() or {}
+        items = [(key, value) for key, value in page.items() if key != cursor]
+        if not items:
+            return
+        yield items
+        cursor = items[-1][0]
+
+
+def write_batch(updates, dry_run):
+    if updates and not dry_run:
+        db.reference('/').update(updates)
+
+
+def migrate_device(device_id, args, stats):
+    hours = set()
+    for kind in KINDS:
+        source = f"devices/{device_id}/{kind}"
+        for page in read_pages(source, args.batch_size):
+            updates = {}
+            for push_id, record in page:
+                if not isinstance(record, dict):
+                    stats["skipped"] += 1
+                    continue
+                timestamp = record.get("timestamp")
+                if not isinstance(timestamp, (int, float)) or timestamp < firebase_layout.MIN_EPOCH_MS:
+                    try:
+                        created = firebase_layout.push_id_time(push_id)
+                    except ValueError:
+                        # Not a push id; nothing to date the record by
+                        stats["skipped"] += 1
+                        continue
+                    record = dict(record, timestamp=created)
+                    if isinstance(timestamp, (int, float)):
+                        record["device_ms"] = timestamp
+                        stats["redated"] += 1
+                    timestamp = created
+                updates[f"{firebase_layout.record_path(kind, device_id, timestamp)}/{push_id}"] = record
+                if kind == "vitals":
+                    hours.add(firebase_layout.bucket_key(timestamp, "hour"))
+            write_batch(updates, args.dry_run)
+            stats[kind] += len(updates)
+        if args.delete_old and not args.dry_run:
+            db.reference(source).delete()
+
+    # Recompute rollups from each affected partition
+    stats["hours"] += len(hours)
+    if args.dry_run:
+        return
+    for hour in sorted(hours):
+        readings = (db.reference(f"vitals/{device_id}/{hour}").get() or {}).values()
+        updates = {
+            firebase_layout.rollup_path(device_id, resolution, key): rollup
+            for (resolution, key), rollup in firebase_layout.compute_rollups(readings).items()
+        }
+        write_batch(updates, args.dry_run)
+        stats["rollups"] += len(updates)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate Firebase data to the partitioned layout")
+    parser.add_argument("--credentials", default=CREDENTIALS)
+    parser.add_argument("--db-url", default=DATABASE_URL)
+    parser.add_argument("--devices", help="comma-separated device ids (default: all under devices/)")
+    parser.add_argument("--batch-size", type=int, default=500, help="records per read and write")
+    parser.add_argument("--delete-old", action="store_true", help="remove the old lists once copied")
+    parser.add_argument("--dry-run", action="store_true", help="read and count, but write nothing")
+    args = parser.parse_args()
+
+    firebase_admin.initialize_app(credentials.Certificate(args.credentials), {'databaseURL': args.db_url})
+
+    if args.devices:
+        device_ids = args.devices.split(',')
+    else:
+        device_ids = sorted((db.reference('devices').get(shallow=True) or {}).keys())
+
+    start = time.time()
+    for device_id in device_ids:
+        stats = {"vitals": 0, "alerts": 0, "images": 0, "skipped": 0, "redated": 0, "hours": 0, "rollups": 0}
+        migrate_device(device_id, args, stats)
+        print(f"{device_id}: {stats['vitals']} vitals, {stats['alerts']} alerts, {stats['images']} images "
+              f"({stats['skipped']} skipped, {stats['redated']} redated from uptime), "
+              f"{stats['rollups']} rollups over {stats['hours']} hours")
+    print(f"Migrated {len(device_ids)} devices in {time.time() - start:.1f}s" + (" (dry run)" if args.dry_run else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# Model runners that can be replaced while the server is running.
+#
+# A watcher thread polls config["model_paths"] and the .eim files it names.
+# When a path changes, or a file is replaced (a new inode, size or mtime),
+# the new runner is started next to the one serving traffic and given a
+# warm-up inference. Only if that succeeds is it switched in, under a lock,
+# for every later call; calls already running on the old runner finish
+# there, and the old runner is stopped once the last of them is done. A
+# model that fails to load or warm up leaves the old runner serving, and is
+# retried once its file changes again.
+#
+# Replace a .eim by renaming a new file over it (mv); a running model can't
+# be overwritten in place. A file is only loaded once it has been unchanged
+# for one poll, so a copy still in progress isn't picked up.
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+metric_swaps = metrics.registry.counter(
+    "model_swaps_total", "Model runners replaced while serving, by model", ("model",))
+metric_swap_failures = metrics.registry.counter(
+    "model_swap_failures_total", "New model runners that failed to load or warm up, by model", ("model",))
+metric_drain = metrics.registry.histogram(
+    "model_drain_seconds", "Time for the calls on a replaced runner to finish")
+
+
+class _Slot:
+    __slots__ = ('runner', 'signature', 'inflight', 'retired', 'drained', 'loaded_at')
+
+    def __init__(self, runner, signature):
+        self.runner = runner
+        self.signature = signature
+        self.inflight = 0
+        self.retired = False
+        self.drained = threading.Event()
+        self.loaded_at = time.time()
+
+
+# What identifies the model a path refers to; a change means a reload
+def signature(path):
+    if path.startswith("builtin:"):
+        return (path,)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (path, None)
+    return (path, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class ModelRegistry:
+    # `models` is the name -> runner dict the server reads; `paths()`
+    # returns config["model_paths"]; `load(name)` starts a runner for the
+    # model's current path, or returns None. `on_swap(name)` runs after a
+    # model is replaced.
+    def __init__(self, models, paths, load, options, on_swap=None, log=None):
+        self.models = models
+        self.paths = paths
+        self.load = load
+        self.watch_interval = options["watch_interval"]
+        self.drain_timeout = options["drain_timeout"]
+        self.warmup_timeout = options["warmup_timeout"]
+        self.warmup_features = options["warmup_features"]
+        self.on_swap = on_swap
+        self.log = log
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.pending = {}   # name -> signature seen on the last poll, not yet loaded
+        self.failed = {}    # name -> signature that failed to load or warm up
+        self.stopping = threading.Event()
+        self.thread = None
+
+    # The model's current runner, counted as in use until the block exits
+    @contextmanager
+    def use(self, name):
+        with self.lock:
+            slot = self.slots.get(name)
+            if slot is not None:
+                slot.inflight += 1
+        try:
+            yield slot.runner if slot is not None else None
+        finally:
+            if slot is not None:
+                with self.lock:
+                    slot.inflight -= 1
+                    if slot.retired and not slot.inflight:
+                        slot.drained.set()
+
+    # Switch `name` to `runner` (None removes it) and return the old slot
+    def swap(self, name, runner, sig=None):
+        with self.lock:
+            old = self.slots.pop(name, None)
+            if runner is not None:
+                self.slots[name] = _Slot(runner, sig or signature(self.paths()[name]))
+                self.models[name] = runner
+            else:
+                self.models.pop(name, None)
+            if old is not None:
+                old.retired = True
+                if not old.inflight:
+                    old.drained.set()
+        if self.on_swap:
+            self.on_swap(name)
+        return old
+
+    # Stop a replaced runner once the calls on it have finished
+    def retire(self, name, slot):
+        if slot is None or slot.runner is None:
+            return
+        start = time.perf_counter()
+        if not slot.drained.wait(self.drain_timeout) and self.log:
+            self.log.warning("model_drain_timeout", model=name, inflight=slot.inflight)
+        metric_drain.observe(time.perf_counter() - start)
+        try:
+            slot.runner.stop()
+        except Exception as e:
+            if self.log:
+                self.log.error("model_unload_failed", model=name, error=str(e))
+
+    # Replace a model, without a warm-up, e.g. at start-up
+    def install(self, name, runner):
+        self.retire(name, self.swap(name, runner))
+
+    def unload(self):
+        for name in list(self.slots):
+            self.retire(name, self.swap(name, None))
+            if self.log:
+                self.log.info("model_unloaded", model=name)
+
+    def warm_up(self, name, runner):
+        # In-process detectors have no subprocess to warm up, and a sample
+        # would skew their running statistics
+        if getattr(runner, "in_process", False):
+            return True
+        features = self.warmup_features.get(name, [0.0, 0.0])
+        if isinstance(features, int):
+            features = [0.0] * features
+        outcome = {}
+
+        def run():
+            try:
+                outcome["result"] = runner.classify(features)
+            except Exception as e:
+                outcome["error"] = str(e)
+
+        # A runner that hangs here is stopped by reload(), which ends the call
+        thread = threading.Thread(target=run, name=f"warmup-{name}", daemon=True)
+        thread.start()
+        thread.join(self.warmup_timeout)
+        if thread.is_alive():
+            outcome["error"] = f"no result within {self.warmup_timeout} s"
+        if "error" in outcome:
+            if self.log:
+                self.log.error("model_warmup_failed", model=name, error=outcome["error"])
+            return False
+        res = outcome.get("result")
+        return isinstance(res, dict) and "result" in res
+
+    # Start the new runner for a model, warm it up and switch to it
+    def reload(self, name, sig):
+        start = time.perf_counter()
+        runner = self.load(name)
+        if runner is None or not self.warm_up(name, runner):
+            self.failed[name] = sig
+            metric_swap_failures.labels(name).inc()
+            if self.log:
+                self.log.error("model_swap_failed", model=name, path=sig[0])
+            if runner is not None:
+                try:
+                    runner.stop()
+                except Exception:
+                    pass
+            return False
+        ready = time.perf_counter() - start
+        old = self.swap(name, runner, sig)
+        metric_swaps.labels(name).inc()
+        if self.log:
+            self.log.info("model_swapped", model=name, path=sig[0], ready_seconds=round(ready, 3))
+        self.retire(name, old)
+        return True
+
+    # Replace a model's runner with a new one for the same path, e.g. after
+    # the old one stopped responding
+    def restart(self, name):
+        path = self.paths().get(name)
+        if path is None:
+            return False
+        if self.log:
+            self.log.warning("model_restarting", model=name)
+        return self.reload(name, signature(path))
+
+    # Reload models whose path or file changed; unload those removed
+    def check(self):
+        paths = self.paths()
+        for name, path in list(paths.items()):
+            sig = signature(path)
+            slot = self.slots.get(name)
+            if (slot is not None and slot.signature == sig) or self.failed.get(name) == sig:
+                self.pending.pop(name, None)
+                continue
+            if self.pending.get(name) != sig:
+                self.pending[name] = sig
+                continue
+            del self.pending[name]
+            self.reload(name, sig)
+        for name in [name for name in self.slots if name not in paths]:
+            self.retire(name, self.swap(name, None))
+            if self.log:
+                self.log.info("model_removed", model=name)
+
+    def status(self):
+        with self.lock:
+            return {
+                name: {
+                    "path": slot.signature[0],
+                    "loaded_at": slot.loaded_at,
+                    "inflight": slot.inflight,
+                    "runner": type(slot.runner).__name__
+                }
+                for name, slot in self.slots.items()
+            }
+
+    def _watch(self):
+        while not self.stopping.wait(self.watch_interval):
+            try:
+                self.check()
+            except Exception as e:
+                if self.log:
+                    self.log.exception("model_watch_failed", error=str(e))
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._watch, name="model-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
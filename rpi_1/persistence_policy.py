@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Report-by-exception persistence of raw vitals.
+#
+# Every sample still feeds the rollups; this decides which raw samples are
+# also written to Firebase:
+#   - the first sample seen for a device
+#   - a sample where any metric moved more than its deadband from the last
+#     written value
+#   - a heartbeat sample when nothing was written for heartbeat_seconds
+#   - every sample within pre_roll_seconds before to post_roll_seconds after
+#     an alert; suppressed samples are kept in a short ring buffer so the
+#     pre-roll can be written once the alert fires
+# Everything else is suppressed, and counted once it leaves the pre-roll
+# buffer without having been written.
+#
+# Timestamps are the server's normalised ones (Draft3.normalize_timestamp),
+# so samples and alerts of a device are on one clock whatever the device
+# sent.
+import threading
+from collections import deque
+
+import metrics
+
+metric_written = metrics.registry.counter(
+    "vitals_writes_total", "Raw vitals samples written to Firebase, by reason", ("reason",))
+metric_suppressed = metrics.registry.counter(
+    "vitals_writes_suppressed_total", "Raw vitals samples never written because they stayed within the deadband")
+
+
+class _DeviceState:
+    __slots__ = ('last_values', 'last_write', 'buffer', 'alert_windows')
+
+    def __init__(self, buffer_size):
+        self.last_values = None
+        self.last_write = None
+        self.buffer = deque(maxlen=buffer_size)   # (timestamp, vital_data) not yet written
+        self.alert_windows = deque(maxlen=8)       # (start, end) in ms
+
+
+class PersistencePolicy:
+    def __init__(self, deadband, heartbeat_seconds=60, pre_roll_seconds=30,
+                 post_roll_seconds=60, buffer_size=256):
+        self.deadband = deadband
+        self.heartbeat_ms = heartbeat_seconds * 1000
+        self.pre_roll_ms = pre_roll_seconds * 1000
+        self.post_roll_ms = post_roll_seconds * 1000
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def _state(self, device_id):
+        state = self.devices.get(device_id)
+        if state is None:
+            state = self.devices[device_id] = _DeviceState(self.buffer_size)
+        return state
+
+    def _reason(self, state, timestamp, vital_data):
+        if state.last_values is None:
+            return "first"
+        for start, end in state.alert_windows:
+            if start <= timestamp <= end:
+                return "alert"
+        for metric, band in self.deadband.items():
+            value = vital_data.get(metric)
+            last = state.last_values.get(metric)
+            if value is not None and (last is None or abs(value - last) > band):
+                return "deadband"
+        # A clock that stepped back by a heartbeat restarts the interval
+        if abs(timestamp - state.last_write) >= self.heartbeat_ms:
+            return "heartbeat"
+        return None
+
+    # True if the sample should be written now; otherwise it is buffered for
+    # a possible alert pre-roll
+    def should_write(self, device_id, timestamp, vital_data):
+        with self.lock:
+            state = self._state(device_id)
+            reason = self._reason(state, timestamp, vital_data)
+            if reason is None:
+                expired = 1 if len(state.buffer) == state.buffer.maxlen else 0
+                state.buffer.append((timestamp, vital_data))
+                while state.buffer and state.buffer[0][0] < timestamp - self.pre_roll_ms:
+                    state.buffer.popleft()
+                    expired += 1
+                if expired:
+                    metric_suppressed.inc(expired)
+                return False
+            state.last_values = vital_data
+            if reason == "heartbeat":
+                state.last_write = timestamp
+            else:
+                state.last_write = max(timestamp, state.last_write or timestamp)
+        metric_written.labels(reason).inc()
+        return True
+
+    # Open an alert window and return the buffered samples in its pre-roll,
+    # which the caller should write now
+    def on_alert(self, device_id, timestamp):
+        with self.lock:
+            state = self._state(device_id)
+            state.alert_windows.append((timestamp - self.pre_roll_ms, timestamp + self.post_roll_ms))
+            pre_roll = [(ts, data) for ts, data in state.buffer if ts >= timestamp - self.pre_roll_ms]
+            expired = len(state.buffer) - len(pre_roll)
+            state.buffer.clear()
+        if expired:
+            metric_suppressed.inc(expired)
+        if pre_roll:
+            metric_written.labels("pre_roll").inc(len(pre_roll))
+        return pre_roll
+
+    def forget(self, device_id):
+        with self.lock:
+            state = self.devices.pop(device_id, None)
+        if state is not None and state.buffer:
+            metric_suppressed.inc(len(state.buffer))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Runtime-toggled profiling for the server.
+#
+# SamplingProfiler walks every thread's stack with sys._current_frames() at a
+# fixed interval and counts the stacks it sees, so it costs nothing while off
+# and only a few percent of one core while on. Results are written in the
+# collapsed-stack format ("frame;frame;frame count") that flamegraph.pl and
+# speedscope read directly.
+#
+# HotPathTimers are named timers around individual calls (classify, Firebase
+# writes) that can be switched on and off without a restart.
+import sys
+import time
+import threading
+from collections import Counter
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = False
+
+    # Sample all threads for `seconds` and return the collapsed stacks.
+    # Only one profile runs at a time; returns None if one is already running.
+    def profile(self, seconds, interval=0.005):
+        with self.lock:
+            if self.running:
+                return None
+            self.running = True
+        try:
+            return self._sample(seconds, interval)
+        finally:
+            with self.lock:
+                self.running = False
+
+    def _sample(self, seconds, interval):
+        me = threading.get_ident()
+        names = {}
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        samples = 0
+
+        while time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                stacks[';'.join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(interval)
+
+        lines = [f"{stack} {count}" for stack, count in stacks.most_common()]
+        return '\n'.join(lines) + '\n', samples
+
+
+class HotPathTimers:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def enable(self):
+        with self.lock:
+            self.stats = {}
+            self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    # Time a block under `name` when timers are on; a shared no-op otherwise
+    def time(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _HotPathTimer(self, name)
+
+    def record(self, name, elapsed):
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+            stat["count"] += 1
+            stat["total_seconds"] += elapsed
+            if elapsed > stat["max_seconds"]:
+                stat["max_seconds"] = elapsed
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "timers": {
+                    name: dict(stat, mean_seconds=stat["total_seconds"] / stat["count"])
+                    for name, stat in self.stats.items()
+                }
+            }
+
+
+class _HotPathTimer:
+    __slots__ = ('timers', 'name', 'start')
+
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timers.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+# Process-wide instances used by the server
+profiler = SamplingProfiler()
+timers = HotPathTimers()
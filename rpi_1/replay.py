@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# Replay a traffic capture (Draft3.py --capture PATH) through the rpi_1
+# pipeline, to reproduce a load spike or compare two versions of the server.
+#
+# The server runs as in benchmark.py, on the in-memory backends. MQTT records
+# go through the client's on_message handler and uploads are POSTed to the
+# Flask app with the body the server saved when they were captured. Records
+# are sent on the captured timeline, sped up --speed times (0: as fast as
+# possible); silences longer than --max-gap seconds are shortened to it.
+#
+# Messages that had no "timestamp" get their arrival time as one, so the
+# alerts a replay raises can be matched against those of another run; the
+# timestamps the server gives alerts during the replay (keyword alerts from
+# audio uploads) are left out of the match. The report has the throughput,
+# how far behind the timeline sending fell, and every alert raised;
+# --compare diffs the alerts against an earlier report.
+#
+# Usage:
+#   python replay.py CAPTURE [--speed 1] [--max-gap 5] [--data-dir DIR]
+#                    [--output run.json] [--compare previous.json]
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+from collections import Counter
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+from backends import LoopbackMessage
+from benchmark import percentiles, rss_mb, git_commit
+from traffic_capture import read_capture, MQTT
+
+MAX_DIFF_LINES = 20
+
+
+# Captured records as (offset in seconds on the replay timeline, kind, name,
+# data), with timestamps filled in
+def load_capture(path, speed, max_gap):
+    records = []
+    offset = 0.0
+    previous = None
+    for record in read_capture(path):
+        if previous is not None:
+            gap = record.time - previous
+            offset += min(gap, max_gap) if max_gap else gap
+        previous = record.time
+        data = record.data
+        if record.kind == MQTT:
+            data = with_timestamp(data, record.time)
+        records.append((offset / speed if speed else 0.0, record.kind, record.name, data))
+    return records
+
+
+def with_timestamp(payload, arrival):
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        return payload
+    if not isinstance(message, dict) or "timestamp" in message:
+        return payload
+    message["timestamp"] = int(arrival * 1000)
+    return json.dumps(message).encode()
+
+
+# What identifies an alert across runs. Timestamps from after `started_ms`
+# were made up by this run, not captured.
+def alert_key(device_id, alert_data, started_ms):
+    timestamp = alert_data.get("timestamp")
+    return [
+        str(device_id),
+        alert_data.get("alert_type"),
+        alert_data.get("source") or alert_data.get("keyword"),
+        timestamp if timestamp is None or timestamp < started_ms else None
+    ]
+
+
+class Replay:
+    def __init__(self, server, args):
+        self.server = server
+        self.args = args
+        self.alerts = []
+        self.started_ms = None
+        self.lock = threading.Lock()
+
+        # Fork the image workers before the replay starts its own threads
+        server.image_pipeline.start()
+
+        server.config["memory_backend"].update({
+            "db_latency_ms": args.db_latency_ms,
+            "runner_cost_ms": args.classify_cost_ms
+        })
+        server.configure_backends("memory")
+        server.load_models()
+        server.client = server.connect_mqtt()
+
+        original_send_alert = server.send_alert
+
+        def recording_send_alert(device_id, alert_data):
+            result = original_send_alert(device_id, alert_data)
+            with self.lock:
+                self.alerts.append(alert_key(device_id, alert_data, self.started_ms))
+            return result
+
+        server.send_alert = recording_send_alert
+
+        for target in (server.task_processor, server.rollup_flusher):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+        self.http = server.app.test_client()
+
+    # Saved upload body, or None if the file is gone
+    def upload_body(self, upload):
+        path = upload["body_path"]
+        if not os.path.isabs(path):
+            path = os.path.join(self.args.data_dir, path)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def run(self, records):
+        on_message = self.server.client.on_message
+        counts = Counter()
+        lateness = []
+
+        self.started_ms = time.time() * 1000
+        start = time.perf_counter()
+        for offset, kind, name, data in records:
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lateness.append(-delay)
+            if kind == MQTT:
+                on_message(self.server.client, None, LoopbackMessage(name, data))
+                counts["mqtt"] += 1
+                continue
+            body = self.upload_body(data)
+            if body is None:
+                counts["missing_bodies"] += 1
+                continue
+            response = self.http.post(name, data=body, headers=data["headers"])
+            counts["http"] += 1
+            if response.status_code != 200:
+                counts["http_errors"] += 1
+        self.server.processing_queue.join()
+        seconds = time.perf_counter() - start
+
+        sent = counts["mqtt"] + counts["http"]
+        return {
+            "records": len(records),
+            "mqtt": counts["mqtt"],
+            "http": counts["http"],
+            "http_errors": counts["http_errors"],
+            "missing_bodies": counts["missing_bodies"],
+            "seconds": round(seconds, 4),
+            "records_per_sec": round(sent / seconds, 1) if seconds else None,
+            "behind_schedule_ms": percentiles(lateness),
+            "alerts": len(self.alerts),
+            "alert_set": sorted(self.alerts, key=json.dumps),
+            "rss_mb": round(rss_mb(), 1)
+        }
+
+
+def compare(result, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"\nComparison against {previous_path} (commit {previous.get('commit')}):")
+    if previous.get("records_per_sec") and result["records_per_sec"]:
+        ratio = result["records_per_sec"] / previous["records_per_sec"]
+        print(f"  throughput {ratio:.2f}x ({previous['records_per_sec']} -> {result['records_per_sec']} records/s)")
+    old = Counter(json.dumps(alert) for alert in previous["alert_set"])
+    new = Counter(json.dumps(alert) for alert in result["alert_set"])
+    missing = old - new
+    added = new - old
+    print(f"  alerts {previous['alerts']} -> {result['alerts']}: "
+          f"{sum(missing.values())} no longer raised, {sum(added.values())} new")
+    for label, diff in (("-", missing), ("+", added)):
+        for alert in sorted(diff.elements())[:MAX_DIFF_LINES]:
+            print(f"    {label} {alert}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a traffic capture through the rpi_1 pipeline")
+    parser.add_argument("capture", help="file written by Draft3.py --capture")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay N times faster than captured (0 = as fast as possible)")
+    parser.add_argument("--max-gap", type=float, default=0,
+                        help="shorten silences longer than this many seconds (0 = keep them)")
+    parser.add_argument("--data-dir", default=None,
+                        help="directory the server ran in, for relative upload paths "
+                             "(default: the capture's directory)")
+    parser.add_argument("--classify-cost-ms", type=float, default=2.0,
+                        help="simulated cost of one .eim classify call")
+    parser.add_argument("--db-latency-ms", type=float, default=0.0,
+                        help="simulated latency of each database call")
+    parser.add_argument("--output", default=None, help="write the report JSON here")
+    parser.add_argument("--compare", default=None, help="earlier report JSON to compare against")
+    parser.add_argument("--verbose", action="store_true", help="keep the server's log output")
+    args = parser.parse_args()
+
+    capture = os.path.abspath(args.capture)
+    args.data_dir = os.path.abspath(args.data_dir or os.path.dirname(capture))
+    output = os.path.abspath(args.output) if args.output else None
+    previous = os.path.abspath(args.compare) if args.compare else None
+    records = load_capture(capture, args.speed, args.max_gap)
+
+    # Draft3 creates its data directories relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="rpi1_replay_")
+    os.chdir(workdir)
+    import Draft3 as server
+    import structured_log
+
+    if not args.verbose:
+        structured_log.setup_logging(
+            rate_limits=server.config["logging"]["rate_limits"],
+            stream=open(os.devnull, 'w')
+        )
+
+    result = Replay(server, args).run(records)
+    print(f"{result['records']} records ({result['mqtt']} mqtt, {result['http']} http, "
+          f"{result['missing_bodies']} missing bodies) in {result['seconds']} s: "
+          f"{result['records_per_sec']} records/s, {result['alerts']} alerts, "
+          f"behind schedule p99 {result['behind_schedule_ms']['p99']} ms")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "capture": capture,
+        "args": vars(args),
+        **result
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {output}")
+    if previous:
+        compare(report, previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+# Re-score historical vitals with (new) BPM/SpO2 anomaly models, to see how
+# they would have behaved on past data before they are deployed.
+#
+# Readings come from a Firebase JSON export of the database root (--export)
+# or straight from the database (--firebase), in the partitioned layout of
+# firebase_layout.py. Each device's readings are replayed in time order
+# through the same features (anomaly_model.py) and alert threshold as the
+# server, on a pool of worker processes that each run their own model
+# runners; a device is scored on one worker, so its history is built as the
+# server built it. Repeated feature vectors are served from a per-worker
+# InferenceCache, as on the server.
+#
+# The persistence policy stores only some readings, so the models see a
+# thinned history and their features differ from the server's. The new
+# models are therefore compared with a control run of the deployed models on
+# the same readings: every device's alert timeline marks each alert "both"
+# (raised by the new and control models), "new" (only by the new ones) or
+# "gone" (only by the control). The anomaly alerts the server recorded in
+# the range are shown alongside ("recorded" if neither model raises them),
+# and how many of them the control raises shows how much the thinning
+# matters.
+#
+# An export is read whole; for long ranges read from the database, which is
+# fetched one device and one hour at a time. Records from before the server
+# dated messages itself carry the device's uptime as a timestamp; they are
+# dated by their push ids.
+#
+# Usage:
+#   python rescore.py --export backup.json --bpm-model models/bpm_v2.eim
+#   python rescore.py --firebase --start 2026-10-18 --end 2026-10-19 \
+#       --bpm-model models/bpm_v2.eim --spo2-model builtin:ewma [--workers 4]
+#       [--control-bpm-model models/bpm_model.eim] [--control-spo2-model ...]
+#       [--devices wearable_001,wearable_002] [--output report.json]
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import multiprocessing
+from multiprocessing.util import Finalize
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+import anomaly_model
+import firebase_layout
+from benchmark import git_commit
+from fallback_detector import create_detector
+from inference_cache import InferenceCache
+
+try:
+    from edge_impulse_linux.runner import ImpulseRunner
+except ImportError:
+    ImpulseRunner = None
+
+MAX_DIFF_LINES = 20
+ROLES = ("new", "control")
+
+# The models the server runs (Draft3.py config["model_paths"]), relative to
+# its working directory; the default control
+DEPLOYED_MODELS = {
+    "bpm": "models/bpm_model.eim",
+    "spo2": "models/spo2_model.eim"
+}
+
+# Per worker process: (role, source) -> runner, and the cache of results
+_runners = {}
+_cache = None
+
+
+def _load_runner(path):
+    if path.startswith("builtin:"):
+        runner = create_detector(path[len("builtin:"):])
+    else:
+        if ImpulseRunner is None:
+            raise RuntimeError("edge_impulse_linux is not installed (pip install edge_impulse_linux)")
+        runner = ImpulseRunner(os.path.abspath(path))
+    runner.init()
+    return runner
+
+
+def _stop_runners():
+    for runner in _runners.values():
+        try:
+            runner.stop()
+        except Exception:
+            pass
+    _runners.clear()
+
+
+# `model_paths` is role -> source -> path
+def _init_worker(model_paths, cache_size, quantum):
+    global _cache
+    for role, paths in model_paths.items():
+        for source, path in paths.items():
+            _runners[(role, source)] = _load_runner(path)
+    _cache = InferenceCache(cache_size, quantum)
+    # Pool workers leave through os._exit, which skips atexit
+    Finalize(None, _stop_runners, exitpriority=10)
+
+
+def _classify(role, source, features, stats):
+    runner = _runners[(role, source)]
+    model_name = f"{role}:{anomaly_model.VITALS_MODELS[source][0]}"
+    # In-process detectors are stateful; every reading goes through them
+    if getattr(runner, "in_process", False):
+        return runner.classify(features)
+    res = _cache.get(model_name, features)
+    if res is not None:
+        stats["cache_hits"] += 1
+        return res
+    start = time.perf_counter()
+    res = runner.classify(features)
+    _cache.put(model_name, features, res, time.perf_counter() - start)
+    stats["classify_calls"] += 1
+    return res
+
+
+# Alerts each role's models raise for one device's readings, (timestamp,
+# heart_rate, spo2, device_ms) in time order, as the server would raise
+# them. `lead_in` readings, from just before the range, only fill the
+# history. Both roles see the same features.
+def score_device(device_id, readings, lead_in=()):
+    stats = Counter()
+    alerts = {role: [] for role in ROLES}
+    sources = sorted({source for _, source in _runners})
+    history = {source: [] for source in sources}
+    for index, (timestamp, heart_rate, spo2, device_ms) in enumerate(list(lead_in) + list(readings)):
+        values = {"bpm": heart_rate, "spo2": spo2}
+        for source, series in history.items():
+            value = values[source]
+            if value <= 0:
+                continue
+            series.append(value)
+            del series[:-anomaly_model.WINDOW]
+            if index < len(lead_in):
+                continue
+            features = anomaly_model.features(series, value)
+            if features is None:
+                continue
+            for role in ROLES:
+                try:
+                    res = _classify(role, source, features, stats)
+                except Exception as e:
+                    stats["errors"] += 1
+                    stats.setdefault("first_error", f"{role} {source}: {e}")
+                    continue
+                score = anomaly_model.anomaly_score(res)
+                if anomaly_model.is_anomaly(score):
+                    alert = anomaly_model.alert(device_id, source, value, score, timestamp)
+                    if device_ms is not None:
+                        alert["device_ms"] = device_ms
+                    alerts[role].append(alert)
+    stats["readings"] = len(readings)
+    return device_id, alerts, dict(stats)
+
+
+# The last WINDOW stored readings before `start`, as a lead-in, and those in
+# [start, end); each (timestamp, heart_rate, spo2, device_ms), in time order
+def vitals_readings(records, start_ms, end_ms):
+    readings = []
+    for record in records:
+        if not isinstance(record, dict) or not isinstance(record.get("timestamp"), (int, float)):
+            continue
+        if record["timestamp"] < end_ms:
+            readings.append((record["timestamp"], record.get("heart_rate", 0), record.get("spo2", 0),
+                             record.get("device_ms")))
+    readings.sort(key=lambda reading: reading[0])
+    first = next((i for i, reading in enumerate(readings) if reading[0] >= start_ms), len(readings))
+    return readings[max(0, first - anomaly_model.WINDOW):first], readings[first:]
+
+
+def anomaly_alerts(records, sources, start_ms, end_ms):
+    return [
+        record for record in records
+        if isinstance(record, dict) and record.get("alert_type") == "anomaly"
+        and record.get("source") in sources
+        and start_ms <= record.get("timestamp", -1) < end_ms
+    ]
+
+
+# A record stored with the device's uptime (millis()) as its timestamp,
+# before the server dated messages itself (or migrated before the migration
+# redated such records), is dated by its push id: the time the server wrote
+# it. The uptime is kept as device_ms.
+def redate(push_id, record):
+    timestamp = record.get("timestamp") if isinstance(record, dict) else None
+    if isinstance(timestamp, (int, float)) and timestamp < firebase_layout.MIN_EPOCH_MS:
+        try:
+            return dict(record, timestamp=firebase_layout.push_id_time(push_id), device_ms=timestamp)
+        except ValueError:
+            pass
+    return record
+
+
+# Records of a device's partitions ({bucket key: {push id: record}})
+def _bucket_records(buckets):
+    for bucket in (buckets or {}).values():
+        if isinstance(bucket, dict):
+            for push_id, record in bucket.items():
+                yield redate(push_id, record)
+
+
+# Keys of the partitions written with device uptime for a timestamp, which
+# sort before every real one
+def legacy_keys(keys, kind):
+    floor = firebase_layout.bucket_key(firebase_layout.MIN_EPOCH_MS, firebase_layout.PARTITIONS[kind])
+    return sorted(key for key in keys if key < floor)
+
+
+# (device_id, (lead-in, readings), recorded alerts) for each device of an
+# export
+def export_devices(path, device_ids, sources, start_ms, end_ms):
+    with open(path) as f:
+        root = json.load(f)
+    if not isinstance(root, dict) or "vitals" not in root:
+        raise ValueError(f"{path} is not an export of the database root (no vitals node)")
+    vitals = root["vitals"] or {}
+    alerts = root.get("alerts") or {}
+    for device_id in device_ids or sorted(vitals):
+        yield (
+            device_id,
+            vitals_readings(_bucket_records(vitals.get(device_id)), start_ms, end_ms),
+            anomaly_alerts(_bucket_records(alerts.get(device_id)), sources, start_ms, end_ms)
+        )
+
+
+# Keys of the `resolution` buckets covering [start_ms, end_ms)
+def bucket_keys(start_ms, end_ms, resolution):
+    seconds = firebase_layout.RESOLUTIONS[resolution][1]
+    bucket = firebase_layout.bucket_start(start_ms, resolution)
+    while bucket * 1000 < end_ms:
+        yield firebase_layout.bucket_key(bucket * 1000, resolution)
+        bucket += seconds
+
+
+# As export_devices(), read from the database one partition at a time. The
+# lead-in comes from the partition before the range. Partitions written
+# with device uptime can't be narrowed to the range, and are read whole.
+def firebase_devices(args, device_ids, sources, start_ms, end_ms):
+    import firebase_admin
+    from firebase_admin import credentials, db
+
+    def read(kind, device_id, range_start_ms):
+        keys = list(bucket_keys(range_start_ms, end_ms, firebase_layout.PARTITIONS[kind]))
+        stored = db.reference(f"{kind}/{device_id}").get(shallow=True) or {}
+        buckets = {}
+        for key in legacy_keys(stored, kind) + keys:
+            buckets[key] = db.reference(f"{kind}/{device_id}/{key}").get()
+        return _bucket_records(buckets)
+
+    firebase_admin.initialize_app(credentials.Certificate(args.credentials), {'databaseURL': args.db_url})
+    if not device_ids:
+        device_ids = sorted((db.reference('vitals').get(shallow=True) or {}).keys())
+    lead_in_ms = firebase_layout.RESOLUTIONS[firebase_layout.PARTITIONS["vitals"]][1] * 1000
+    for device_id in device_ids:
+        yield (
+            device_id,
+            vitals_readings(read("vitals", device_id, start_ms - lead_in_ms), start_ms, end_ms),
+            anomaly_alerts(read("alerts", device_id, start_ms), sources, start_ms, end_ms)
+        )
+
+
+# What identifies an alert across runs: the reading it was raised for. For
+# records dated by their push id that is the device's uptime, as the
+# vitals record and its alert were written at slightly different times.
+def alert_key(alert):
+    if alert.get("device_ms") is not None:
+        return (alert["source"], "device_ms", alert["device_ms"])
+    return (alert["source"], alert["timestamp"])
+
+
+# One device's alert timeline: the new models' alerts against the control's
+# (status "both", "new" or "gone"), with the recorded alerts alongside. An
+# alert only the recorded data has is "recorded".
+def timeline(alerts, recorded):
+    entries = {}
+
+    def entry(alert):
+        key = alert_key(alert)
+        if key not in entries:
+            entries[key] = {
+                "timestamp": alert["timestamp"],
+                "source": alert["source"],
+                "value": alert.get("value"),
+                "score": None,
+                "control_score": None,
+                "recorded_score": None
+            }
+        return entries[key]
+
+    for alert in alerts["new"]:
+        entry(alert)["score"] = alert["anomaly_score"]
+    for alert in alerts["control"]:
+        entry(alert)["control_score"] = alert["anomaly_score"]
+    for alert in recorded:
+        entry(alert)["recorded_score"] = alert.get("anomaly_score")
+    for item in entries.values():
+        if item["score"] is not None:
+            item["status"] = "both" if item["control_score"] is not None else "new"
+        else:
+            item["status"] = "gone" if item["control_score"] is not None else "recorded"
+    return sorted(entries.values(), key=lambda item: (item["timestamp"], item["source"]))
+
+
+def rescore(devices, model_paths, args):
+    timelines = {}
+    totals = Counter()
+    by_source = {source: Counter() for source in model_paths["new"]}
+    recorded_by_device = {}
+    first_error = None
+    context = multiprocessing.get_context("fork")
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.workers, mp_context=context, initializer=_init_worker,
+                             initargs=(model_paths, args.cache_size, args.quantum)) as pool:
+        pending = set()
+
+        def collect(done):
+            nonlocal first_error
+            for future in done:
+                device_id, alerts, stats = future.result()
+                first_error = first_error or stats.pop("first_error", None)
+                totals.update(stats)
+                totals["devices"] += 1
+                entries = timeline(alerts, recorded_by_device.pop(device_id))
+                for entry in entries:
+                    counts = by_source[entry["source"]]
+                    counts[entry["status"]] += 1
+                    if entry["recorded_score"] is not None:
+                        counts["recorded_total"] += 1
+                        counts["recorded_by_control"] += entry["control_score"] is not None
+                if entries:
+                    timelines[device_id] = entries
+
+        # Keep a couple of devices per worker queued, so reading the next
+        # devices overlaps with scoring and only those are held in memory
+        for device_id, (lead_in, readings), recorded in devices:
+            recorded_by_device[device_id] = recorded
+            pending.add(pool.submit(score_device, device_id, readings, lead_in))
+            if len(pending) >= 2 * args.workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(wait(pending).done)
+    seconds = time.perf_counter() - start
+
+    alerts = Counter()
+    for counts in by_source.values():
+        alerts.update(counts)
+    return {
+        "devices": totals["devices"],
+        "readings": totals["readings"],
+        "classify_calls": totals["classify_calls"],
+        "cache_hits": totals["cache_hits"],
+        "errors": totals["errors"],
+        "first_error": first_error,
+        "seconds": round(seconds, 2),
+        "readings_per_sec": round(totals["readings"] / seconds, 1) if seconds else None,
+        "alerts": {
+            "new_model": alerts["both"] + alerts["new"],
+            "control": alerts["both"] + alerts["gone"],
+            "both": alerts["both"],
+            "new": alerts["new"],
+            "gone": alerts["gone"],
+            "recorded": alerts["recorded_total"],
+            "recorded_by_control": alerts["recorded_by_control"]
+        },
+        "by_source": {
+            source: {status: counts[status] for status in ("both", "new", "gone", "recorded")}
+            for source, counts in by_source.items()
+        },
+        "timelines": timelines
+    }
+
+
+def print_diff(result):
+    alerts = result["alerts"]
+    print(f"  alerts {alerts['control']} control -> {alerts['new_model']} new model: "
+          f"{alerts['both']} in both, {alerts['gone']} no longer raised, {alerts['new']} new")
+    # How far the stored (thinned) vitals are from what the server saw
+    print(f"  control raises {alerts['recorded_by_control']} of the {alerts['recorded']} recorded alerts")
+    changed = sorted(
+        ((sum(entry["status"] in ("new", "gone") for entry in entries), device_id)
+         for device_id, entries in result["timelines"].items()),
+        reverse=True
+    )
+    for count, device_id in changed[:MAX_DIFF_LINES]:
+        if not count:
+            break
+        entries = result["timelines"][device_id]
+        new = sum(entry["status"] == "new" for entry in entries)
+        print(f"    {device_id}: +{new} -{count - new}")
+
+
+# UTC milliseconds of an ISO date or time; naive values are taken as UTC
+def parse_time(value):
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score historical vitals with BPM/SpO2 anomaly models")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--export", help="Firebase JSON export of the database root")
+    source.add_argument("--firebase", action="store_true", help="read from the database")
+    parser.add_argument("--credentials", default="smart-healthcare-3a0d6-firebase-adminsdk-fbsvc-e3b80a3443.json")
+    parser.add_argument("--db-url", default="https://smart-healthcare-3a0d6-default-rtdb.firebaseio.com/")
+    parser.add_argument("--bpm-model", help=".eim model (or builtin:<detector>) for heart rate")
+    parser.add_argument("--spo2-model", help=".eim model (or builtin:<detector>) for SpO2")
+    parser.add_argument("--control-bpm-model", default=DEPLOYED_MODELS["bpm"],
+                        help="model the new heart rate model is compared with (default: the deployed one)")
+    parser.add_argument("--control-spo2-model", default=DEPLOYED_MODELS["spo2"],
+                        help="model the new SpO2 model is compared with (default: the deployed one)")
+    parser.add_argument("--start", help="first reading time, ISO UTC (required with --firebase)")
+    parser.add_argument("--end", help="end of the range, ISO UTC (default: a day after --start)")
+    parser.add_argument("--devices", help="comma-separated device ids (default: all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="scoring processes")
+    parser.add_argument("--cache-size", type=int, default=65536, help="cached results per worker")
+    parser.add_argument("--quantum", type=float, default=0.1, help="feature quantization of the cache")
+    parser.add_argument("--output", default=None, help="write the report JSON here")
+    args = parser.parse_args()
+
+    model_paths = {}
+    if args.bpm_model:
+        model_paths["bpm"] = args.bpm_model
+    if args.spo2_model:
+        model_paths["spo2"] = args.spo2_model
+    if not model_paths:
+        parser.error("give --bpm-model, --spo2-model or both")
+    controls = {"bpm": args.control_bpm_model, "spo2": args.control_spo2_model}
+    model_paths = {"new": model_paths, "control": {source: controls[source] for source in model_paths}}
+    if args.firebase and not args.start:
+        parser.error("--firebase needs --start")
+    start_ms = parse_time(args.start) if args.start else 0
+    if args.end:
+        end_ms = parse_time(args.end)
+    else:
+        end_ms = start_ms + 86400 * 1000 if args.start else sys.maxsize
+    device_ids = args.devices.split(',') if args.devices else None
+
+    if args.export:
+        devices = export_devices(args.export, device_ids, set(model_paths["new"]), start_ms, end_ms)
+    else:
+        devices = firebase_devices(args, device_ids, set(model_paths["new"]), start_ms, end_ms)
+    result = rescore(devices, model_paths, args)
+
+    print(f"{result['devices']} devices, {result['readings']} readings in {result['seconds']} s: "
+          f"{result['readings_per_sec']} readings/s, {result['classify_calls']} classify calls, "
+          f"{result['cache_hits']} cache hits, {result['errors']} errors")
+    print_diff(result)
+
+    if args.output:
+        report = {
+            "commit": git_commit(),
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "models": model_paths,
+            "source": args.export or args.db_url,
+            "start": start_ms,
+            "end": end_ms if end_ms != sys.maxsize else None,
+            **result
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,202 @@
 # save as run_model.py
+#
+# Usage:
+#   python run_model.py <model_path> [features_file]
+#   python run_model.py <model_path> <rows.csv|rows.npy> --benchmark
+#       [--instances 2] [--concurrency 4] [--warmup 10] [--iterations 1000]
+#       [--output results.json] [--compare previous.json]
+#
+# Benchmark mode classifies the rows of a CSV file (one feature row per line)
+# or a 2-D NPY array, cycling through them, on several runner instances at
+# once. After a warm-up it times every call and reports throughput and
+# latency percentiles: end to end, and the DSP, classification and anomaly
+# times the model reports, with the rest being IPC overhead.
 import os
 import sys
+import json
+import queue
 import signal
 import time
+import argparse
+import platform
+import threading
+import numpy as np
 from edge_impulse_linux.runner import ImpulseRunner
 
-runner = None
+runners = []
+
+PERCENTILES = (50, 90, 95, 99)
+TIMING_KEYS = ("dsp", "classification", "anomaly")
 
 def signal_handler(sig, frame):
     print('Interrupted')
-    if (runner):
+    for runner in runners:
         runner.stop()
     sys.exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
 
+# One comma-separated feature row, in decimal or hex
+def parse_features(line):
+    features = line.strip().split(",")
+    if '0x' in features[0]:
+        return [float(int(f, 16)) for f in features]
+    return [float(f) for f in features]
+
+# Feature rows from a .npy array or a CSV file; a CSV header line is skipped
+def load_rows(path):
+    if path.endswith('.npy'):
+        rows = np.load(path)
+        if rows.ndim == 1:
+            rows = rows.reshape(1, -1)
+        return [row.tolist() for row in rows.reshape(len(rows), -1)]
+    rows = []
+    with open(path, 'r') as f:
+        for number, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                rows.append(parse_features(line))
+            except ValueError:
+                if number > 0:
+                    raise
+    return rows
+
+def start_runner(model_path):
+    runner = ImpulseRunner(model_path)
+    runners.append(runner)
+    return runner, runner.init()
+
+def summarize(values):
+    if not values:
+        return None
+    points = np.percentile(np.array(values), PERCENTILES)
+    summary = {f"p{p}": round(float(v), 3) for p, v in zip(PERCENTILES, points)}
+    summary["mean"] = round(float(np.mean(values)), 3)
+    summary["max"] = round(float(np.max(values)), 3)
+    return summary
+
+def benchmark(model_path, rows_file, instances, concurrency, warmup, iterations):
+    rows = load_rows(rows_file)
+    if not rows:
+        raise ValueError(f"No feature rows in {rows_file}")
+    iterations = iterations or len(rows)
+
+    print(f'MODEL: {model_path}')
+    print(f'Starting {instances} runner instance(s)')
+    model_info = None
+    pool = queue.Queue()
+    for _ in range(instances):
+        runner, model_info = start_runner(model_path)
+        pool.put(runner)
+    print('Loaded runner for "' + model_info['project']['owner'] + ' / ' + model_info['project']['name'] + '"')
+
+    # Warm-up: every instance classifies `warmup` rows, untimed
+    for runner in runners:
+        for i in range(warmup):
+            runner.classify(rows[i % len(rows)])
+
+    latencies = []
+    timings = {key: [] for key in TIMING_KEYS}
+    overhead = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(iterations))
+
+    # Each thread takes the next row index and a free runner, until done
+    def worker():
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            runner = pool.get()
+            try:
+                start = time.perf_counter()
+                res = runner.classify(rows[index % len(rows)])
+                elapsed_ms = (time.perf_counter() - start) * 1000.0
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            finally:
+                pool.put(runner)
+            timing = res.get("timing", {})
+            with lock:
+                latencies.append(elapsed_ms)
+                for key in TIMING_KEYS:
+                    timings[key].append(timing.get(key, 0))
+                overhead.append(elapsed_ms - sum(timing.get(key, 0) for key in TIMING_KEYS))
+
+    print(f'Timing {iterations} inferences on {len(rows)} rows, concurrency {concurrency}')
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    return {
+        "model": os.path.abspath(model_path),
+        "project": model_info['project'],
+        "model_type": model_info.get('model_parameters', {}).get('model_type'),
+        "rows_file": os.path.abspath(rows_file),
+        "rows": len(rows),
+        "features": len(rows[0]),
+        "instances": instances,
+        "concurrency": concurrency,
+        "warmup": warmup,
+        "iterations": iterations,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "seconds": round(seconds, 4),
+        "inferences_per_sec": round(len(latencies) / seconds, 1) if seconds else None,
+        "latency_ms": summarize(latencies),
+        "dsp_ms": summarize(timings["dsp"]),
+        "classification_ms": summarize(timings["classification"]),
+        "anomaly_ms": summarize(timings["anomaly"]),
+        "overhead_ms": summarize(overhead),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "timestamp": int(time.time())
+    }
+
+def print_report(report):
+    print(f"{report['iterations']} inferences in {report['seconds']} s: "
+          f"{report['inferences_per_sec']} inferences/s, {report['errors']} errors")
+    for key in ("latency_ms", "dsp_ms", "classification_ms", "anomaly_ms", "overhead_ms"):
+        summary = report[key]
+        if summary:
+            print(f"  {key:18s} " + "  ".join(f"{name} {value}" for name, value in summary.items()))
+
+def compare(report, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"\nComparison against {previous_path} ({previous['project']['name']}, {previous['machine']}):")
+    if previous.get("inferences_per_sec") and report["inferences_per_sec"]:
+        ratio = report["inferences_per_sec"] / previous["inferences_per_sec"]
+        print(f"  throughput {ratio:.2f}x ({previous['inferences_per_sec']} -> {report['inferences_per_sec']} inferences/s)")
+    for key in ("latency_ms", "dsp_ms", "classification_ms"):
+        if previous.get(key) and report[key]:
+            print(f"  {key:18s} p50 {previous[key]['p50']} -> {report[key]['p50']}, "
+                  f"p99 {previous[key]['p99']} -> {report[key]['p99']}")
+
 def main(model_path, features_file=None):
-    global runner
-    
     # If features file is provided, use it
     if features_file:
         with open(features_file, 'r') as f:
-            features = f.read().strip().split(",")
-            if '0x' in features[0]:
-                features = [float(int(f, 16)) for f in features]
-            else:
-                features = [float(f) for f in features]
-    
+            features = parse_features(f.read())
+
     print('MODEL: ' + model_path)
-    
-    runner = ImpulseRunner(model_path)
+
+    runner = None
     try:
-        model_info = runner.init()
+        runner, model_info = start_runner(model_path)
         print('Loaded runner for "' + model_info['project']['owner'] + ' / ' + model_info['project']['name'] + '"')
-        
+
         if features_file:
             # Classify with provided features
             res = runner.classify(features)
@@ -47,17 +210,42 @@ def main(model_path, features_file=None):
             print(f"Project: {model_info['project']['name']}")
             print(f"Description: {model_info['project'].get('description', 'No description')}")
             print(f"Model type: {model_info.get('model_parameters', {}).get('model_type', 'Unknown')}")
-            
+
     finally:
         if (runner):
             runner.stop()
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: python run_model.py <model_path> [features_file]")
-        sys.exit(1)
-    
-    model_path = sys.argv[1]
-    features_file = sys.argv[2] if len(sys.argv) > 2 else None
-    
-    main(model_path, features_file)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run an Edge Impulse .eim model")
+    parser.add_argument("model_path")
+    parser.add_argument("features_file", nargs="?", default=None,
+                        help="one feature row, or with --benchmark a CSV/NPY file of rows")
+    parser.add_argument("--benchmark", action="store_true", help="time many inferences over the rows")
+    parser.add_argument("--instances", type=int, default=1, help="runner instances (subprocesses)")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="calls in flight at once (default: one per instance)")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed inferences per instance")
+    parser.add_argument("--iterations", type=int, default=0, help="timed inferences (default: one per row)")
+    parser.add_argument("--output", default=None, help="write the results JSON here")
+    parser.add_argument("--compare", default=None, help="earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        main(args.model_path, args.features_file)
+        sys.exit(0)
+    if not args.features_file:
+        parser.error("--benchmark needs a CSV or NPY file of feature rows")
+
+    try:
+        report = benchmark(args.model_path, args.features_file, args.instances,
+                           args.concurrency or args.instances, args.warmup, args.iterations)
+    finally:
+        for runner in runners:
+            runner.stop()
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        compare(report, args.compare)
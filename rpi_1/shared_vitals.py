@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# Per-device vitals in shared memory, for the multi-process mode of Draft3.py.
+#
+# The block is divided into slots, and each worker process owns a range of
+# them. A slot holds a device's id, ring buffers of its heart rate and SpO2
+# readings, its last update time and a JSON blob of its recent alerts and
+# images. In a worker, the device_data entry's "heart_rate" and "spo2" are
+# SharedSeries over the ring buffers, used like the lists they replace; the
+# parent's HTTP views read the same memory through DeviceView, without a
+# round trip to the worker.
+#
+# A writer increments the slot's sequence number before and after each change
+# (it is odd while a change is in progress). A reader copies the slot and
+# retries unless the number was even and unchanged around the copy, so it
+# never sees a half-written slot. Within a worker, changes are serialized by a
+# lock, as its cleanup thread releases slots while the main loop writes.
+import json
+import time
+import threading
+from collections.abc import Mapping
+from multiprocessing import shared_memory
+
+import numpy as np
+
+SERIES = ("heart_rate", "spo2")
+ID_BYTES = 64
+READ_ATTEMPTS = 100
+
+
+def slot_dtype(history, meta_bytes):
+    return np.dtype([
+        ('seq', '<u8'),
+        ('device_id', f'S{ID_BYTES}'),
+        ('last_update', '<f8'),
+        ('start', '<i4', (len(SERIES),)),
+        ('length', '<i4', (len(SERIES),)),
+        ('meta_length', '<i4'),
+        ('values', '<f8', (len(SERIES), history)),
+        ('meta', 'u1', (meta_bytes,))
+    ], align=True)
+
+
+def _ring(values, start, length):
+    capacity = len(values)
+    if start + length <= capacity:
+        return values[start:start + length].tolist()
+    return values[start:].tolist() + values[:start + length - capacity].tolist()
+
+
+# One series of one slot, with the parts of the list interface device_data
+# uses: len(), append(), pop(0), indexing, slicing and iteration. Once full,
+# append() drops the oldest reading.
+class SharedSeries:
+    __slots__ = ('store', 'slot', 'index', 'values')
+
+    def __init__(self, store, slot, index):
+        self.store = store
+        self.slot = slot
+        self.index = index
+        self.values = store.slots['values'][slot, index]
+
+    def __len__(self):
+        return int(self.store.length[self.slot, self.index])
+
+    def append(self, value):
+        store, slot, index = self.store, self.slot, self.index
+        length = int(store.length[slot, index])
+        start = int(store.start[slot, index])
+        capacity = len(self.values)
+        store.begin(slot)
+        if length < capacity:
+            self.values[(start + length) % capacity] = value
+            store.length[slot, index] = length + 1
+        else:
+            self.values[start] = value
+            store.start[slot, index] = (start + 1) % capacity
+        store.end(slot)
+
+    # Only the oldest reading can be removed
+    def pop(self, index=0):
+        if index != 0:
+            raise IndexError("SharedSeries only supports pop(0)")
+        store, slot = self.store, self.slot
+        length = int(store.length[slot, self.index])
+        if not length:
+            raise IndexError("pop from empty series")
+        start = int(store.start[slot, self.index])
+        value = float(self.values[start])
+        store.begin(slot)
+        store.start[slot, self.index] = (start + 1) % len(self.values)
+        store.length[slot, self.index] = length - 1
+        store.end(slot)
+        return value
+
+    def tolist(self):
+        return _ring(self.values, int(self.store.start[self.slot, self.index]), len(self))
+
+    def __getitem__(self, item):
+        return self.tolist()[item]
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+
+class SharedVitals:
+    def __init__(self, partitions, slots_per_partition, history=128, meta_bytes=8192):
+        self.slots_per_partition = slots_per_partition
+        self.meta_bytes = meta_bytes
+        dtype = slot_dtype(history, meta_bytes)
+        count = partitions * slots_per_partition
+        self.shm = shared_memory.SharedMemory(create=True, size=dtype.itemsize * count)
+        self.slots = np.ndarray((count,), dtype, buffer=self.shm.buf)
+        self.slots[:] = np.zeros(1, dtype)
+        self.seq = self.slots['seq']
+        self.ids = self.slots['device_id']
+        self.start = self.slots['start']
+        self.length = self.slots['length']
+        self.lock = threading.Lock()
+        self.partition = None
+        self.index = {}   # device_id -> slot; a worker's own devices, or the parent's lookups
+
+    # Writer side, in a worker
+
+    def begin(self, slot):
+        self.lock.acquire()
+        self.seq[slot] += 1
+
+    def end(self, slot):
+        self.seq[slot] += 1
+        self.lock.release()
+
+    # Called in a worker: it allocates slots only from its partition
+    def own(self, partition):
+        self.partition = partition
+        self.index = {}
+
+    def _allocate(self, device_id):
+        first = self.partition * self.slots_per_partition
+        free = np.flatnonzero(self.ids[first:first + self.slots_per_partition] == b'')
+        if not free.size:
+            return None
+        slot = first + int(free[0])
+        self.begin(slot)
+        self.ids[slot] = str(device_id).encode()[:ID_BYTES]
+        self.start[slot] = 0
+        self.length[slot] = 0
+        self.slots['meta_length'][slot] = 0
+        self.end(slot)
+        self.index[device_id] = slot
+        return slot
+
+    # Move a new device_data entry's series into shared memory. Returns False,
+    # leaving the entry as it is, if the device can't be shared (partition
+    # full, or an id longer than ID_BYTES).
+    def attach(self, device_id, entry):
+        if len(str(device_id).encode()) > ID_BYTES:
+            return False
+        slot = self.index.get(device_id)
+        if slot is None:
+            slot = self._allocate(device_id)
+            if slot is None:
+                return False
+        for index, name in enumerate(SERIES):
+            series = SharedSeries(self, slot, index)
+            for value in entry[name][-len(series.values):]:
+                series.append(value)
+            entry[name] = series
+        self.publish(device_id, entry)
+        return True
+
+    def release(self, device_id):
+        slot = self.index.pop(device_id, None)
+        if slot is None:
+            return
+        self.begin(slot)
+        self.ids[slot] = b''
+        self.end(slot)
+
+    # Reset the partition of a worker that died, possibly in the middle of a
+    # change; called in the parent before the worker is replaced
+    def clear(self, partition):
+        first = partition * self.slots_per_partition
+        self.slots[first:first + self.slots_per_partition] = np.zeros(1, self.slots.dtype)
+
+    # Write the entry's last update time and recent alerts and images; the
+    # oldest are left out if they don't fit
+    def publish(self, device_id, entry):
+        slot = self.index.get(device_id)
+        if slot is None:
+            return
+        alerts, images = entry["alerts"], entry["images"]
+        while True:
+            meta = json.dumps({"alerts": alerts, "images": images}, default=str).encode()
+            if len(meta) <= self.meta_bytes or not (alerts or images):
+                break
+            if len(alerts) >= len(images):
+                alerts = alerts[1:]
+            else:
+                images = images[1:]
+        self.begin(slot)
+        self.slots['last_update'][slot] = entry["last_update"]
+        self.slots['meta'][slot, :len(meta)] = np.frombuffer(meta, np.uint8)
+        self.slots['meta_length'][slot] = len(meta)
+        self.end(slot)
+
+    # Reader side, in the parent
+
+    def slot_of(self, device_id):
+        key = str(device_id).encode()
+        slot = self.index.get(device_id)
+        if slot is not None and self.ids[slot] == key:
+            return slot
+        found = np.flatnonzero(self.ids == key) if key else ()
+        if not len(found):
+            self.index.pop(device_id, None)
+            return None
+        slot = self.index[device_id] = int(found[0])
+        return slot
+
+    # Consistent copy of a device's entry, or None if no worker has it
+    def read(self, device_id):
+        key = str(device_id).encode()
+        for _ in range(READ_ATTEMPTS):
+            slot = self.slot_of(device_id)
+            if slot is None:
+                return None
+            seq = int(self.seq[slot])
+            if seq & 1:
+                time.sleep(0)
+                continue
+            record = self.slots[slot:slot + 1].copy()[0]
+            if int(self.seq[slot]) == seq and record['device_id'] == key:
+                break
+        else:
+            return None
+        entry = {
+            name: _ring(record['values'][index], int(record['start'][index]), int(record['length'][index]))
+            for index, name in enumerate(SERIES)
+        }
+        meta_length = int(record['meta_length'])
+        meta = json.loads(record['meta'][:meta_length].tobytes()) if meta_length else {}
+        entry["alerts"] = meta.get("alerts", [])
+        entry["images"] = meta.get("images", [])
+        entry["last_update"] = float(record['last_update'])
+        return entry
+
+    def device_ids(self):
+        return [device_id.decode() for device_id in self.ids if device_id]
+
+    def close(self):
+        self.slots = self.seq = self.ids = self.start = self.length = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Read-only device_data for the parent process, backed by the workers' slots
+class DeviceView(Mapping):
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, device_id):
+        entry = self.store.read(device_id)
+        if entry is None:
+            raise KeyError(device_id)
+        return entry
+
+    def __contains__(self, device_id):
+        return self.store.slot_of(device_id) is not None
+
+    def __iter__(self):
+        return iter(self.store.device_ids())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.store.ids))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# Structured, buffered logging for the server.
+#
+# log.info("alert_sent", device_id=..., source=...) puts a small tuple on a
+# bounded queue and returns; a background writer thread formats the records
+# (logfmt or JSON lines) and writes them in batches with one write() per
+# batch, so a slow SD card or serial console never blocks the pipeline.
+#
+# Events can be rate limited per event name (a token bucket of N records per
+# second); the number suppressed is attached to the next record that gets
+# through. Every event, and every suppressed or dropped record, is counted in
+# the metrics registry.
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+import traceback
+from datetime import datetime
+
+import metrics
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+metric_events = metrics.registry.counter(
+    "log_events_total", "Log events emitted, by level and event", ("level", "event"))
+metric_suppressed = metrics.registry.counter(
+    "log_suppressed_total", "Log records suppressed by rate limiting", ("event",))
+metric_dropped = metrics.registry.counter(
+    "log_dropped_total", "Log records dropped because the log queue was full")
+
+
+class _RateLimit:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'suppressed')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.suppressed = 0
+
+
+# Background writer draining the log queue in batches
+class BatchWriter:
+    def __init__(self, stream=None, fmt="logfmt", batch_size=256, flush_interval=0.2, max_queue=10000):
+        self.stream = stream or sys.stdout
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, record):
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metric_dropped.inc()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="log-writer")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self.stream.write(''.join(self._format(record) for record in batch))
+            self.stream.flush()
+        except Exception:
+            pass
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def _format(self, record):
+        created, level, logger, event, fields = record
+        stamp = datetime.fromtimestamp(created).isoformat(timespec='milliseconds')
+        if self.fmt == "json":
+            entry = {"ts": stamp, "level": LEVEL_NAMES[level], "logger": logger, "event": event}
+            entry.update(fields)
+            return json.dumps(entry, default=str) + '\n'
+        parts = [stamp, LEVEL_NAMES[level], f"{logger}:{event}"]
+        for key, value in fields.items():
+            if key == "exc_info":
+                continue
+            if isinstance(value, str):
+                text = json.dumps(value) if (' ' in value or '=' in value or '"' in value) else value
+            else:
+                text = json.dumps(value, default=str, separators=(',', ':'))
+            parts.append(f"{key}={text}")
+        line = ' '.join(parts) + '\n'
+        if "exc_info" in fields:
+            line += fields["exc_info"]
+        return line
+
+    # Wait until every queued record has been written
+    def flush(self, timeout=2.0):
+        if self.thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+class StructuredLogger:
+    def __init__(self, name, manager):
+        self.name = name
+        self.manager = manager
+
+    def _log(self, level, event, fields):
+        manager = self.manager
+        if level < manager.level:
+            return
+        limit = manager.rate_limits.get(event)
+        if limit is not None:
+            now = time.monotonic()
+            limit.tokens = min(limit.burst, limit.tokens + (now - limit.updated) * limit.rate)
+            limit.updated = now
+            if limit.tokens < 1:
+                limit.suppressed += 1
+                metric_suppressed.labels(event).inc()
+                return
+            limit.tokens -= 1
+            if limit.suppressed:
+                fields["suppressed"] = limit.suppressed
+                limit.suppressed = 0
+        metric_events.labels(LEVEL_NAMES[level], event).inc()
+        manager.writer.put((time.time(), level, self.name, event, fields))
+
+    def debug(self, event, **fields):
+        self._log(DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(ERROR, event, fields)
+
+    # Log at ERROR level with the current exception's traceback
+    def exception(self, event, **fields):
+        fields["exc_info"] = traceback.format_exc()
+        self._log(ERROR, event, fields)
+
+
+class _Manager:
+    def __init__(self):
+        self.level = INFO
+        self.rate_limits = {}
+        self.writer = BatchWriter()
+        self.loggers = {}
+
+
+_manager = _Manager()
+
+
+def get_logger(name):
+    logger = _manager.loggers.get(name)
+    if logger is None:
+        logger = _manager.loggers[name] = StructuredLogger(name, _manager)
+    return logger
+
+
+# Configure level, output format, batching and per-event rate limits, where
+# rate_limits maps an event name to the records per second it may emit
+def setup_logging(level="INFO", fmt="logfmt", rate_limits=None, batch_size=256,
+                  flush_interval=0.2, stream=None):
+    flush()
+    _manager.level = LEVELS[level] if isinstance(level, str) else level
+    _manager.rate_limits = {
+        event: _RateLimit(rate, max(1.0, rate))
+        for event, rate in (rate_limits or {}).items()
+    }
+    _manager.writer = BatchWriter(stream, fmt, batch_size, flush_interval)
+
+
+def flush(timeout=2.0):
+    _manager.writer.flush(timeout)
+
+
+# The writer thread doesn't survive fork(), and its queue may have been
+# locked by it at the time, so a forked child starts a writer of its own
+def _after_fork_in_child():
+    writer = _manager.writer
+    _manager.writer = BatchWriter(writer.stream, writer.fmt, writer.batch_size,
+                                  writer.flush_interval, writer.queue.maxsize)
+
+
+atexit.register(flush)
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Two cluster nodes, each a separate instance of Draft3.py, on one loopback
+# broker and one in-memory database: a device's history has to survive a
+# node joining (handoff over MQTT) and a node leaving (handoff through the
+# database), with every sample processed once and in order.
+#
+# Usage:
+#   python -m pytest test_cluster.py
+import os
+import sys
+import json
+import time
+import threading
+import importlib.util
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+import backends
+
+DEVICES = [f"dev{i:02d}" for i in range(20)]
+
+
+def start_node(node_id, broker, database):
+    spec = importlib.util.spec_from_file_location(f"node_{node_id}", os.path.join(SCRIPT_DIR, "Draft3.py"))
+    node = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(node)
+    node.configure_backends("memory", broker, database)
+    node.config["cluster"].update({"heartbeat_seconds": 0.2, "handoff_timeout_seconds": 5})
+    node.configure_cluster(True, node_id)
+    node.load_models()
+    node.client = node.connect_mqtt()
+    node.client.loop_start()
+    node.cluster.start()
+    processor = threading.Thread(target=node.task_processor)
+    processor.daemon = True
+    processor.start()
+    return node
+
+
+def stop_node(node):
+    node.stop_intake()
+    node.hand_off_devices(list(node.device_data))
+    node.cluster.leave()
+    node.client.disconnect()
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+def publish_sample(publisher, heart_rate):
+    for device_id in DEVICES:
+        publisher.publish(f"health/vitals/{device_id}", json.dumps({
+            "device_id": device_id,
+            "heart_rate": heart_rate,
+            "spo2": 97,
+            "timestamp": int(time.time() * 1000)
+        }))
+
+
+def histories(nodes):
+    merged = {}
+    for node in nodes:
+        for device_id in list(node.device_data):
+            assert device_id not in merged, f"{device_id} is held by two nodes"
+            merged[device_id] = list(node.device_data[device_id]["heart_rate"])
+    return merged
+
+
+def test_handoff_on_join_and_leave(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    broker = backends.LoopbackBroker()
+    database = backends.MemoryDatabase()
+    publisher = backends.LoopbackClient(broker)
+    publisher.connect()
+
+    a = start_node("node-a", broker, database)
+    assert wait_for(lambda: a.cluster.joined)
+    publish_sample(publisher, 70)
+    publish_sample(publisher, 71)
+    assert wait_for(lambda: histories([a]) == {d: [70, 71] for d in DEVICES})
+
+    # Samples sent while node-b joins go to whichever node the broker picks
+    b = start_node("node-b", broker, database)
+    publish_sample(publisher, 72)
+    assert wait_for(lambda: b.cluster.joined and len(a.cluster.members) == 2)
+    publish_sample(publisher, 73)
+    assert wait_for(lambda: histories([a, b]) == {d: [70, 71, 72, 73] for d in DEVICES})
+    assert b.device_data, "node-b took over no devices"
+    for device_id in b.device_data:
+        assert b.cluster.owns(device_id) and not a.cluster.owns(device_id)
+    assert not database.reference(a.config["cluster"]["state_path"]).get()
+
+    stop_node(b)
+    assert wait_for(lambda: len(a.cluster.members) == 1)
+    publish_sample(publisher, 74)
+    assert wait_for(lambda: histories([a]) == {d: [70, 71, 72, 73, 74] for d in DEVICES})
+    assert not database.reference(a.config["cluster"]["state_path"]).get()
+    stop_node(a)
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__, "-q"]))
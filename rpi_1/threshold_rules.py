@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import threading
+import numpy as np
+
+# Metrics carried by a vitals sample, in column order of the state arrays
+METRICS = ("heart_rate", "spo2")
+
+# Rule kinds and comparison operators, encoded as small ints so a whole
+# batch can be evaluated with array operations
+KIND_LEVEL = 0       # compare the current value against the threshold
+KIND_RATE = 1        # compare the change per minute since the previous sample
+KIND_SUSTAINED = 2   # level condition that has to hold for duration_s
+KINDS = {"level": KIND_LEVEL, "rate": KIND_RATE, "sustained": KIND_SUSTAINED}
+
+OP_GT = 0
+OP_LT = 1
+OP_ABS_GT = 2
+OPS = {"gt": OP_GT, "lt": OP_LT, "abs_gt": OP_ABS_GT}
+
+
+# Built-in rules, equivalent to the original hard-coded checks on
+# config["anomaly_thresholds"]
+def default_rules(thresholds):
+    return [
+        {"name": "bpm_high", "metric": "heart_rate", "kind": "level", "op": "gt",
+         "threshold": thresholds["bpm_high"]},
+        {"name": "bpm_low", "metric": "heart_rate", "kind": "level", "op": "lt",
+         "threshold": thresholds["bpm_low"]},
+        {"name": "spo2_low", "metric": "spo2", "kind": "level", "op": "lt",
+         "threshold": thresholds["spo2_low"]},
+    ]
+
+
+# Compiles threshold rules into NumPy arrays and evaluates batches of vitals
+# samples from many devices in one pass.
+#
+# The optional rules file is JSON of the form:
+#   {
+#     "rules": [{"name": "bpm_rise", "metric": "heart_rate", "kind": "rate",
+#                "op": "gt", "threshold": 30},
+#               {"name": "spo2_low_5min", "metric": "spo2", "kind": "sustained",
+#                "op": "lt", "threshold": 92, "duration_s": 300}],
+#     "patients": {"patient_1": {"devices": ["wearable_001"],
+#                                "thresholds": {"bpm_high": 110}}},
+#     "devices": {"wearable_001": {"bpm_low": 45, "spo2_low_5min": null}}
+#   }
+# Rules from the file are added to (or replace, by name) the built-in ones.
+# Per-device overrides win over per-patient overrides, and a null threshold
+# disables the rule for that device. The file is re-read whenever its mtime
+# changes, so rules can be edited while the server is running.
+class ThresholdRuleEngine:
+    def __init__(self, thresholds, rules_path=None, reload_interval=5.0, log=None):
+        self.thresholds = thresholds
+        self.rules_path = rules_path
+        self.reload_interval = reload_interval
+        self.log = log
+        self.lock = threading.Lock()
+
+        self._rules_mtime = None
+        self._last_reload_check = 0.0
+
+        # Per-device state, one row per device
+        self.device_rows = {}
+        self.free_rows = []
+        self.capacity = 0
+        self.prev_value = np.empty((0, len(METRICS)))
+        self.prev_ts = np.empty((0, len(METRICS)))
+        self.since = np.empty((0, 0))
+        self.fired = np.empty((0, 0), dtype=bool)
+        self.device_thresholds = np.empty((0, 0))
+
+        self.rules = []
+        self.rule_names = []
+        try:
+            self._compile(self._read_rules_file())
+        except Exception as e:
+            # Start with the built-in rules; an edit to the file reloads it
+            if self.log:
+                self.log.error("threshold_rules_compile_failed", path=self.rules_path, error=str(e))
+            self._compile(None)
+        self._grow(64)
+
+    # Read the rules file, returning None if it is missing or invalid
+    def _read_rules_file(self):
+        if not self.rules_path or not os.path.exists(self.rules_path):
+            self._rules_mtime = None
+            return None
+        try:
+            self._rules_mtime = os.path.getmtime(self.rules_path)
+            with open(self.rules_path, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            if self.log:
+                self.log.error("threshold_rules_read_failed", path=self.rules_path, error=str(e))
+            return None
+
+    # Build the rule arrays and the override tables from a rules document
+    def _compile(self, spec):
+        spec = spec or {}
+
+        rules = {rule["name"]: rule for rule in default_rules(self.thresholds)}
+        for rule in spec.get("rules", []):
+            rules[rule["name"]] = rule
+        rules = list(rules.values())
+
+        for rule in rules:
+            if rule["metric"] not in METRICS:
+                raise ValueError(f"Unknown metric in rule {rule['name']}: {rule['metric']}")
+            if rule.get("kind", "level") not in KINDS:
+                raise ValueError(f"Unknown kind in rule {rule['name']}: {rule['kind']}")
+            if rule.get("op", "gt") not in OPS:
+                raise ValueError(f"Unknown op in rule {rule['name']}: {rule['op']}")
+
+        old_names = self.rule_names
+
+        self.rules = rules
+        self.rule_names = [rule["name"] for rule in rules]
+        self.rule_metric = np.array([METRICS.index(rule["metric"]) for rule in rules], dtype=np.intp)
+        self.rule_kind = np.array([KINDS[rule.get("kind", "level")] for rule in rules], dtype=np.int8)
+        self.rule_op = np.array([OPS[rule.get("op", "gt")] for rule in rules], dtype=np.int8)
+        self.rule_duration_ms = np.array([float(rule.get("duration_s", 0)) * 1000.0 for rule in rules])
+        self.rule_threshold = np.array([_threshold(rule.get("threshold")) for rule in rules])
+
+        # Resolve overrides: patient thresholds apply to each of its devices,
+        # then device thresholds are layered on top
+        overrides = {}
+        for patient in spec.get("patients", {}).values():
+            for device_id in patient.get("devices", []):
+                overrides.setdefault(device_id, {}).update(patient.get("thresholds", {}))
+        for device_id, device_thresholds in spec.get("devices", {}).items():
+            overrides.setdefault(device_id, {}).update(device_thresholds)
+        self.overrides = {
+            device_id: self._threshold_row(values)
+            for device_id, values in overrides.items()
+        }
+
+        # Carry over sustained-rule state for rules that survived the reload
+        if self.capacity:
+            since = np.full((self.capacity, len(rules)), np.nan)
+            fired = np.zeros((self.capacity, len(rules)), dtype=bool)
+            for j, name in enumerate(self.rule_names):
+                if name in old_names:
+                    i = old_names.index(name)
+                    since[:, j] = self.since[:, i]
+                    fired[:, j] = self.fired[:, i]
+            self.since = since
+            self.fired = fired
+            self.device_thresholds = np.tile(self.rule_threshold, (self.capacity, 1))
+            for device_id, row in self.device_rows.items():
+                if device_id in self.overrides:
+                    self.device_thresholds[row] = self.overrides[device_id]
+
+    def _threshold_row(self, values):
+        row = self.rule_threshold.copy()
+        for name, value in values.items():
+            if name in self.rule_names:
+                row[self.rule_names.index(name)] = _threshold(value)
+        return row
+
+    # Make room for more devices by doubling the state arrays
+    def _grow(self, capacity):
+        extra = capacity - self.capacity
+        n_rules = len(self.rules)
+        self.prev_value = np.vstack([self.prev_value, np.full((extra, len(METRICS)), np.nan)])
+        self.prev_ts = np.vstack([self.prev_ts, np.full((extra, len(METRICS)), np.nan)])
+        self.since = np.vstack([self.since.reshape(-1, n_rules), np.full((extra, n_rules), np.nan)])
+        self.fired = np.vstack([self.fired.reshape(-1, n_rules), np.zeros((extra, n_rules), dtype=bool)])
+        self.device_thresholds = np.vstack([
+            self.device_thresholds.reshape(-1, n_rules),
+            np.tile(self.rule_threshold, (extra, 1))
+        ])
+        self.free_rows.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def _row_for(self, device_id):
+        row = self.device_rows.get(device_id)
+        if row is not None:
+            return row
+        if not self.free_rows:
+            self._grow(self.capacity * 2)
+        row = self.free_rows.pop()
+        self.device_rows[device_id] = row
+        self.device_thresholds[row] = self.overrides.get(device_id, self.rule_threshold)
+        return row
+
+    # Drop all state for a device, e.g. when it goes inactive
+    def forget(self, device_id):
+        with self.lock:
+            row = self.device_rows.pop(device_id, None)
+            if row is None:
+                return
+            self.prev_value[row] = np.nan
+            self.prev_ts[row] = np.nan
+            self.since[row] = np.nan
+            self.fired[row] = False
+            self.free_rows.append(row)
+
+    # Re-read the rules file if it changed since the last load
+    def maybe_reload(self):
+        now = time.time()
+        if now - self._last_reload_check < self.reload_interval:
+            return False
+        self._last_reload_check = now
+
+        if self.rules_path and os.path.exists(self.rules_path):
+            mtime = os.path.getmtime(self.rules_path)
+        else:
+            mtime = None
+        if mtime == self._rules_mtime:
+            return False
+        return self.reload()
+
+    def reload(self):
+        with self.lock:
+            try:
+                self._compile(self._read_rules_file())
+                if self.log:
+                    self.log.info("threshold_rules_loaded", rules=self.rule_names)
+                return True
+            except Exception as e:
+                # The previous rules stay in force
+                if self.log:
+                    self.log.error("threshold_rules_compile_failed", path=self.rules_path, error=str(e))
+                return False
+
+    # Evaluate a batch of samples, given as (device_id, heart_rate, spo2,
+    # timestamp_ms) tuples. Values <= 0 are treated as missing. Returns the
+    # alert dicts in sample order.
+    def evaluate(self, samples):
+        if not samples:
+            return []
+        self.maybe_reload()
+
+        with self.lock:
+            # A device may appear several times in one batch; rate and
+            # sustained rules depend on the previous sample, so split the batch
+            # into waves in which every device appears at most once
+            waves = []
+            seen = {}
+            for index, sample in enumerate(samples):
+                occurrence = seen.get(sample[0], 0)
+                seen[sample[0]] = occurrence + 1
+                if occurrence == len(waves):
+                    waves.append([])
+                waves[occurrence].append(index)
+
+            alerts = []
+            for wave in waves:
+                alerts.extend(self._evaluate_wave([samples[i] for i in wave], wave))
+            alerts.sort(key=lambda item: item[0])
+            return [alert for _, alert in alerts]
+
+    def _evaluate_wave(self, samples, indices):
+        rows = np.array([self._row_for(sample[0]) for sample in samples], dtype=np.intp)
+        values = np.array([sample[1:3] for sample in samples], dtype=float)
+        values[values <= 0] = np.nan
+        ts = np.array([sample[3] for sample in samples], dtype=float)
+
+        value = values[:, self.rule_metric]
+        prev = self.prev_value[rows][:, self.rule_metric]
+        prev_ts = self.prev_ts[rows][:, self.rule_metric]
+        threshold = self.device_thresholds[rows]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dt_min = (ts[:, None] - prev_ts) / 60000.0
+            rate = np.where(dt_min > 0, (value - prev) / dt_min, np.nan)
+        subject = np.where(self.rule_kind == KIND_RATE, rate, value)
+
+        # NaN compares False, so missing values and disabled rules never fire
+        with np.errstate(invalid='ignore'):
+            breach = np.where(
+                self.rule_op == OP_GT, subject > threshold,
+                np.where(self.rule_op == OP_LT, subject < threshold, np.abs(subject) > threshold)
+            )
+
+        # Sustained rules fire once per episode, when the breach has lasted
+        # long enough; a missing value leaves the episode untouched
+        present = ~np.isnan(value)
+        since = self.since[rows]
+        fired = self.fired[rows]
+        since = np.where(present, np.where(breach, np.fmin(since, ts[:, None]), np.nan), since)
+        fired = np.where(present & ~breach, False, fired)
+        sustained = self.rule_kind == KIND_SUSTAINED
+        fire_sustained = sustained & breach & ~fired & (ts[:, None] - since >= self.rule_duration_ms)
+        fired = fired | fire_sustained
+        self.since[rows] = since
+        self.fired[rows] = fired
+
+        fire = np.where(sustained, fire_sustained, breach)
+
+        present_metric = ~np.isnan(values)
+        self.prev_value[rows] = np.where(present_metric, values, self.prev_value[rows])
+        self.prev_ts[rows] = np.where(present_metric, ts[:, None], self.prev_ts[rows])
+
+        alerts = []
+        for i, j in zip(*np.nonzero(fire)):
+            rule = self.rules[j]
+            alert = {
+                "device_id": samples[i][0],
+                "alert_type": "threshold",
+                "source": rule["name"],
+                "value": float(subject[i, j]),
+                "threshold": float(threshold[i, j]),
+                "timestamp": samples[i][3]
+            }
+            if self.rule_kind[j] == KIND_RATE:
+                alert["metric_value"] = float(value[i, j])
+            elif self.rule_kind[j] == KIND_SUSTAINED:
+                alert["duration_s"] = float((ts[i] - since[i, j]) / 1000.0)
+            alerts.append((indices[i], alert))
+        return alerts
+
+
+def _threshold(value):
+    return np.nan if value is None else float(value)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Append-only capture of the server's inbound traffic, for replay.py.
+#
+# Every MQTT message (topic, payload) and every HTTP upload is appended with
+# its arrival time. An upload's body isn't copied: the server has already
+# saved it (the image store blob, the audio file), so the record holds the
+# request's headers and the saved file's path.
+#
+# File layout: MAGIC, then one record after another, each a fixed header
+#   kind (u8), arrival time (f8, Unix seconds), name length (u16),
+#   data length (u32)
+# followed by the name (MQTT topic or HTTP path) and the data (MQTT payload,
+# or a JSON object {"headers", "body_path", "size"} for an upload). A record
+# cut short by a crash ends the capture when it is read back.
+import json
+import time
+import struct
+import threading
+from collections import namedtuple
+
+import metrics
+
+MAGIC = b"RPICAP1\n"
+HEADER = struct.Struct('<BdHI')
+MQTT = 1
+HTTP = 2
+
+metric_records = metrics.registry.counter(
+    "capture_records_total", "Inbound messages and uploads written to the traffic capture", ("kind",))
+metric_dropped = metrics.registry.counter(
+    "capture_dropped_total", "Records not captured because the capture reached max_bytes")
+
+CaptureRecord = namedtuple("CaptureRecord", ["kind", "time", "name", "data"])
+
+
+class TrafficCapture:
+    def __init__(self, path, max_bytes=1024 ** 3, flush_interval=1.0, log=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.log = log
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+            self.file.flush()
+        self.size = self.file.tell()
+        self.last_flush = time.monotonic()
+        self.full = False
+
+    def _append(self, kind, name, data):
+        name = name.encode()
+        record = HEADER.pack(kind, time.time(), len(name), len(data)) + name + data
+        with self.lock:
+            if self.file is None:
+                return
+            if self.size + len(record) > self.max_bytes:
+                if not self.full and self.log:
+                    self.log.warning("capture_full", path=self.path, max_bytes=self.max_bytes)
+                self.full = True
+                metric_dropped.inc()
+                return
+            self.file.write(record)
+            self.size += len(record)
+            now = time.monotonic()
+            if now - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = now
+        metric_records.labels("mqtt" if kind == MQTT else "http").inc()
+
+    def record_mqtt(self, topic, payload):
+        self._append(MQTT, topic, bytes(payload))
+
+    # An upload the server saved to `body_path`
+    def record_http(self, path, headers, body_path, size):
+        data = json.dumps({"headers": headers, "body_path": body_path, "size": size}).encode()
+        self._append(HTTP, path, data)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# Records of a capture file, oldest first; an upload's data is decoded
+def read_capture(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a traffic capture")
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            kind, arrival, name_length, data_length = HEADER.unpack(header)
+            name = f.read(name_length)
+            data = f.read(data_length)
+            if len(name) < name_length or len(data) < data_length:
+                return
+            if kind == HTTP:
+                data = json.loads(data)
+            yield CaptureRecord(kind, arrival, name.decode(), data)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Forked worker processes, each handling a shard of the devices.
+#
+# Items are routed by key (the device id), so a device's messages are always
+# handled, in order, by the same worker, which holds that device's state.
+# Each worker has its own inbox and takes up to batch_size items at a time.
+# A worker that dies is forked again; the items waiting in its inbox are lost.
+#
+# Workers are forked from the calling process, so start() must run before it
+# starts threads that the workers shouldn't inherit mid-operation (the MQTT
+# loop, the HTTP server).
+import queue
+import signal
+import threading
+import zlib
+import multiprocessing
+
+import metrics
+
+metric_restarts = metrics.registry.counter(
+    "worker_restarts_total", "Worker processes forked again after dying")
+metric_dropped = metrics.registry.counter(
+    "worker_dropped_total", "Items dropped because a worker's inbox was full")
+
+
+def shard(key, count):
+    return zlib.crc32(str(key).encode()) % count
+
+
+class WorkerPool:
+    # In each worker, `init(index)` runs first, then `handle(items)` for each
+    # batch and `finish()` once stopped. `on_exit(index)` runs in this
+    # process when a worker dies, before it is replaced.
+    def __init__(self, workers, init, handle, finish=None, on_exit=None,
+                 batch_size=64, queue_size=10000, log=None):
+        self.count = workers
+        self.init = init
+        self.handle = handle
+        self.finish = finish
+        self.on_exit = on_exit
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.log = log
+        self.context = multiprocessing.get_context("fork")
+        self.inboxes = [None] * workers
+        self.processes = [None] * workers
+        self.stopping = threading.Event()
+        self.monitor = None
+        metrics.registry.gauge(
+            "workers_alive", "Worker processes running").set_function(
+                lambda: sum(1 for p in self.processes if p is not None and p.is_alive()))
+
+    def start(self):
+        for index in range(self.count):
+            self._fork(index)
+        self.monitor = threading.Thread(target=self._watch, name="worker-monitor", daemon=True)
+        self.monitor.start()
+
+    def _fork(self, index):
+        # A new inbox each time: a worker killed mid-read can leave the old
+        # one locked
+        inbox = self.context.Queue(self.queue_size)
+        process = self.context.Process(
+            target=self._run, args=(index, inbox), name=f"worker-{index}", daemon=True)
+        process.start()
+        self.inboxes[index] = inbox
+        self.processes[index] = process
+        if self.log:
+            self.log.info("worker_started", index=index, pid=process.pid)
+
+    # Worker process main loop
+    def _run(self, index, inbox):
+        # Ctrl-C goes to the whole process group; the parent stops the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.init(index)
+        running = True
+        while running:
+            items = [inbox.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(inbox.get_nowait())
+                except queue.Empty:
+                    break
+            if None in items:
+                items = items[:items.index(None)]
+                running = False
+            if items:
+                try:
+                    self.handle(items)
+                except Exception as e:
+                    if self.log:
+                        self.log.exception("worker_batch_failed", index=index, error=str(e))
+        if self.finish:
+            self.finish()
+
+    def _watch(self):
+        while not self.stopping.wait(1.0):
+            for index, process in enumerate(self.processes):
+                if process.is_alive() or self.stopping.is_set():
+                    continue
+                if self.log:
+                    self.log.error("worker_died", index=index, pid=process.pid, exitcode=process.exitcode)
+                if self.on_exit:
+                    self.on_exit(index)
+                metric_restarts.inc()
+                self._fork(index)
+
+    def submit(self, key, item):
+        try:
+            self.inboxes[shard(key, self.count)].put_nowait(item)
+        except queue.Full:
+            metric_dropped.inc()
+            return False
+        return True
+
+    # Stand-in for processing_queue.put(): tasks are routed by device id
+    def put(self, task):
+        self.submit(task['device_id'], task)
+
+    def qsize(self):
+        return sum(inbox.qsize() for inbox in self.inboxes)
+
+    # Let the workers finish what is in their inboxes, then wait for them
+    def stop(self, timeout=10.0):
+        self.stopping.set()
+        for inbox in self.inboxes:
+            try:
+                inbox.put(None, timeout=1.0)
+            except queue.Full:
+                pass
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
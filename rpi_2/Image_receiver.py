@@ -1,29 +1,84 @@
-from flask import Flask, request
+from flask import Flask, Response, request, jsonify
 import paho.mqtt.client as mqtt
 import json
 import os
-from datetime import datetime
+import time
+import bisect
+import hashlib
+import threading
+from vitals_cache import VitalsCache
+from live_feed import LiveFeed
 
 app = Flask(__name__)
 
+# Received images are streamed to disk and named by content hash, so
+# concurrent uploads never collide and a resent image is stored once
+IMAGE_DIR = 'received_images'
+TMP_DIR = os.path.join(IMAGE_DIR, '.incoming')
+INDEX_PATH = os.path.join(IMAGE_DIR, 'index.jsonl')
+CHUNK_SIZE = 64 * 1024
+MAX_IMAGE_BYTES = 16 * 1024 * 1024
+MAX_CONCURRENT_UPLOADS = 8   # Bodies being written at once; others wait briefly, then get 503
+UPLOAD_WAIT_SECONDS = 2.0
+
+os.makedirs(TMP_DIR, exist_ok=True)
+upload_slots = threading.BoundedSemaphore(MAX_CONCURRENT_UPLOADS)
+
 # MQTT setup
 mqtt_broker = "localhost"
 mqtt_port = 1883
 mqtt_user = "hiotgrp1"
 mqtt_password = "12341234"
 
+# Local cache of recent vitals and alerts per device, served by the /devices
+# endpoints so the dashboard does not have to read them back from Firebase
+vitals_cache = VitalsCache(history=3600, alert_history=200)
+
+# Per-device Server-Sent Events stream of new vitals, alerts and images
+live_feed = LiveFeed(max_pending=256, replay=100)
+
+# MQTT messages skipped because they were not a JSON object
+ignored_messages = 0
+
 def on_connect(client, userdata, flags, rc):
     print("Connected with result code "+str(rc))
-    client.subscribe("health/image_metadata")
-    client.subscribe("health/vitals")
+    client.subscribe("health/image_metadata/#")
+    client.subscribe("health/vitals/#")
+    client.subscribe("health/parameters/#")
+    client.subscribe("health/alerts/#")
+    client.subscribe("health/detected_anomalies")
 
 def on_message(client, userdata, msg):
-    if msg.topic == "health/image_metadata":
-        metadata = json.loads(msg.payload.decode())
-        print(f"Received image metadata: {metadata}")
-    elif msg.topic == "health/vitals":
-        vitals = json.loads(msg.payload.decode())
-        print(f"Received vitals: {vitals}")
+    global ignored_messages
+    try:
+        payload = json.loads(msg.payload.decode())
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        ignored_messages += 1
+        print(f"Ignoring malformed message on {msg.topic} ({ignored_messages} ignored)")
+        return
+    # Device ID from the payload, else from a per-device topic (health/vitals/<id>)
+    parts = msg.topic.split('/')
+    device_id = payload.get("device_id") or (parts[2] if len(parts) > 2 else "unknown")
+
+    if msg.topic.startswith("health/vitals") or msg.topic.startswith("health/parameters"):
+        reading = vitals_cache.add_vitals(device_id, payload)
+        if reading is not None:
+            live_feed.publish(device_id, "vitals", reading)
+    elif msg.topic.startswith("health/alerts") or msg.topic == "health/detected_anomalies":
+        live_feed.publish(device_id, "alert", vitals_cache.add_alert(device_id, payload))
+    elif msg.topic.startswith("health/image_metadata"):
+        print(f"Received image metadata: {payload}")
+
+def expire_devices():
+    while True:
+        time.sleep(900)
+        for device_id in vitals_cache.expire():
+            live_feed.forget(device_id)
+
+expire_thread = threading.Thread(target=expire_devices, daemon=True)
+expire_thread.start()
 
 client = mqtt.Client()
 client.username_pw_set(mqtt_user, mqtt_password)
@@ -33,21 +88,170 @@ client.on_message = on_message
 client.connect(mqtt_broker, mqtt_port, 60)
 client.loop_start()
 
+# Index of received images, kept in memory sorted by timestamp and appended
+# to a JSON-lines file so it survives restarts
+index_lock = threading.Lock()
+index_timestamps = []
+index_entries = []
+index_hashes = set()
+
+def load_index():
+    if not os.path.exists(INDEX_PATH):
+        return
+    with open(INDEX_PATH, 'r') as f:
+        for line in f:
+            try:
+                add_index_entry(json.loads(line))
+            except ValueError:
+                continue  # Torn last line after a crash
+
+def add_index_entry(entry):
+    i = bisect.bisect_right(index_timestamps, entry["timestamp"])
+    index_timestamps.insert(i, entry["timestamp"])
+    index_entries.insert(i, entry)
+    index_hashes.add(entry["hash"])
+
+load_index()
+index_file = open(INDEX_PATH, 'a')
+
+# Write the request body to a temp file in chunks, hashing as it goes
+def receive_body(tmp_path):
+    digest = hashlib.sha256()
+    size = 0
+    with open(tmp_path, 'wb') as f:
+        while True:
+            chunk = request.stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > MAX_IMAGE_BYTES:
+                raise ValueError("Image too large")
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest(), size
+
+# Capture time (ms) from the X-Timestamp header, or None if it is missing
+# or not an integer
+def header_timestamp():
+    value = request.headers.get('X-Timestamp')
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Ignoring invalid X-Timestamp {value[:40]!r}; using the receive time")
+        return None
+
 @app.route('/upload', methods=['POST'])
 def upload_image():
     if 'image/jpeg' not in request.headers.get('Content-Type', ''):
         return 'Invalid Content-Type', 400
+    timestamp = header_timestamp()
+    if request.content_length is not None and request.content_length > MAX_IMAGE_BYTES:
+        return 'Image too large', 413
+    if not upload_slots.acquire(timeout=UPLOAD_WAIT_SECONDS):
+        return 'Too many concurrent uploads', 503
+
+    tmp_path = os.path.join(TMP_DIR, f"{threading.get_ident()}_{time.monotonic_ns()}.part")
+    try:
+        try:
+            digest, size = receive_body(tmp_path)
+        except ValueError:
+            return 'Image too large', 413
+        if size == 0:
+            return 'No image data received', 400
+        expected = request.headers.get('X-Content-SHA256')
+        if expected and expected != digest:
+            return 'Content hash mismatch', 400
 
-    image_data = request.data
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"image_{timestamp}.jpg"
-    
-    os.makedirs('received_images', exist_ok=True)
-    with open(f"received_images/{filename}", "wb") as f:
-        f.write(image_data)
-    
-    print(f"Received and saved image: {filename}")
+        filename = f"{digest}.jpg"
+        os.replace(tmp_path, os.path.join(IMAGE_DIR, filename))
+    finally:
+        upload_slots.release()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    received_at = int(time.time() * 1000)
+    entry = {
+        "timestamp": timestamp if timestamp is not None else received_at,
+        "received_at": received_at,
+        "device_id": request.headers.get('Device-ID', 'unknown'),
+        "filename": filename,
+        "hash": digest,
+        "size": size
+    }
+    with index_lock:
+        duplicate = digest in index_hashes
+        add_index_entry(entry)
+        index_file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        index_file.flush()
+
+    live_feed.publish(entry["device_id"], "image", entry)
+    print(f"Received and saved image: {filename}" + (" (duplicate)" if duplicate else ""))
     return 'Image received', 200
 
+# List received images, newest last, optionally filtered by device and time
+# range (ms): GET /images?device_id=cam1&start=...&end=...&limit=50
+@app.route('/images', methods=['GET'])
+def list_images():
+    device_id = request.args.get('device_id')
+    start = request.args.get('start', type=int)
+    end = request.args.get('end', type=int)
+    limit = request.args.get('limit', default=100, type=int)
+    with index_lock:
+        lo = bisect.bisect_left(index_timestamps, start) if start is not None else 0
+        hi = bisect.bisect_right(index_timestamps, end) if end is not None else len(index_entries)
+        selected = index_entries[lo:hi]
+    if device_id:
+        selected = [entry for entry in selected if entry["device_id"] == device_id]
+    return jsonify({"images": selected[-limit:] if limit > 0 else []})
+
+# Devices seen recently, with their latest values
+@app.route('/devices', methods=['GET'])
+def list_devices():
+    return jsonify({"devices": vitals_cache.devices_summary()})
+
+@app.route('/devices/<device_id>', methods=['GET'])
+def device_latest(device_id):
+    status = vitals_cache.latest(device_id, alerts=request.args.get('alerts', default=5, type=int))
+    if status is None:
+        return jsonify({"error": "Device not found"}), 404
+    return jsonify(status)
+
+# Recent readings, oldest first: GET /devices/<id>/vitals?since=<ms>&limit=100
+@app.route('/devices/<device_id>/vitals', methods=['GET'])
+def device_vitals(device_id):
+    vitals = vitals_cache.vitals(device_id, request.args.get('since', type=int),
+                                 request.args.get('limit', default=100, type=int))
+    if vitals is None:
+        return jsonify({"error": "Device not found"}), 404
+    return jsonify({"device_id": device_id, "vitals": vitals})
+
+@app.route('/devices/<device_id>/alerts', methods=['GET'])
+def device_alerts(device_id):
+    alerts = vitals_cache.alerts(device_id, request.args.get('since', type=int),
+                                 request.args.get('limit', default=50, type=int))
+    if alerts is None:
+        return jsonify({"error": "Device not found"}), 404
+    return jsonify({"device_id": device_id, "alerts": alerts})
+
+# Live deltas for one device as Server-Sent Events. Clients load the current
+# state from the endpoints above, then apply "vitals", "alert" and "image"
+# events; EventSource resends Last-Event-ID on reconnect to replay any missed.
+@app.route('/devices/<device_id>/stream', methods=['GET'])
+def device_stream(device_id):
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    subscription = live_feed.subscribe(device_id, last_event_id)
+    return Response(subscription.frames(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# The dashboard is served from a different port
+@app.after_request
+def allow_dashboard(response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    app.run(host='0.0.0.0', port=5000, threaded=True)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Server-Sent Events fan-out of per-device deltas (new vitals, new alerts).
+#
+# Each event is serialized to its SSE wire form once, in publish(), and the
+# same bytes object is handed to every subscriber of that device, so adding
+# viewers costs a queue put per event rather than a JSON encode. Every
+# subscriber has a bounded queue; one that falls too far behind is
+# disconnected instead of buffering without limit, and resumes from where it
+# left off by reconnecting with Last-Event-ID, served from a short per-device
+# replay buffer.
+import json
+import queue
+import threading
+from collections import deque
+
+_CLOSE = object()
+
+
+class Subscription:
+    def __init__(self, feed, device_id, max_pending):
+        self.feed = feed
+        self.device_id = device_id
+        self.queue = queue.Queue(maxsize=max_pending)
+
+    def push(self, frame):
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except queue.Full:
+            return False
+
+    # Yield SSE frames until the client goes away or falls behind, with a
+    # comment line every `heartbeat` seconds to keep proxies from timing out
+    def frames(self, heartbeat=15.0):
+        try:
+            while True:
+                try:
+                    frame = self.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield b": keep-alive\n\n"
+                    continue
+                if frame is _CLOSE:
+                    return
+                yield frame
+        finally:
+            self.feed.unsubscribe(self)
+
+
+class LiveFeed:
+    def __init__(self, max_pending=256, replay=100):
+        self.max_pending = max_pending
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.subscribers = {}   # device_id -> set of Subscription
+        self.recent = {}        # device_id -> deque of (event id, frame)
+
+    def publish(self, device_id, event, data):
+        with self.lock:
+            event_id = self.next_id
+            self.next_id += 1
+            payload = json.dumps(data, separators=(',', ':'))
+            frame = f"id: {event_id}\nevent: {event}\ndata: {payload}\n\n".encode()
+            recent = self.recent.get(device_id)
+            if recent is None:
+                recent = self.recent[device_id] = deque(maxlen=self.replay)
+            recent.append((event_id, frame))
+            subscribers = self.subscribers.get(device_id)
+            if not subscribers:
+                return
+            lagging = [s for s in subscribers if not s.push(frame)]
+            for subscription in lagging:
+                subscribers.discard(subscription)
+                self._close(subscription)
+
+    @staticmethod
+    def _close(subscription):
+        # Make room for the close marker; the client reconnects and replays
+        try:
+            subscription.queue.get_nowait()
+        except queue.Empty:
+            pass
+        subscription.queue.put_nowait(_CLOSE)
+
+    # Subscribe to a device's events, first replaying any buffered events
+    # newer than last_event_id
+    def subscribe(self, device_id, last_event_id=None):
+        subscription = Subscription(self, device_id, self.max_pending)
+        with self.lock:
+            if last_event_id is not None:
+                for event_id, frame in self.recent.get(device_id, ()):
+                    if event_id > last_event_id:
+                        subscription.push(frame)
+            self.subscribers.setdefault(device_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(subscription.device_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscribers[subscription.device_id]
+
+    def subscriber_count(self):
+        with self.lock:
+            return sum(len(s) for s in self.subscribers.values())
+
+    def forget(self, device_id):
+        with self.lock:
+            self.recent.pop(device_id, None)
@@ -19,6 +19,43 @@ const firebaseConfig = {
 const app = initializeApp(firebaseConfig);
 const database = getDatabase(app);
 
+// rpi_2 data service (Image_receiver.py): cached vitals and alerts plus a
+// live event stream per device
+const DATA_API = `http://${window.location.hostname}:5000`;
+const MAX_CACHED_VITALS = 1000;
+const MAX_CACHED_ALERTS = 200;
+
+// Key-order independent form of a cached item, to tell stream events the
+// snapshot already holds from new ones received in the same millisecond
+function itemKey(item) {
+  return JSON.stringify(Object.keys(item).sort().map(key => [key, item[key]]));
+}
+
+// Format a cached vitals reading for the charts; its timestamp is the time
+// rpi_2 received it (the device's own uptime is in device_ms)
+function formatVital(vital) {
+  return {
+    timestamp: new Date(vital.timestamp).toLocaleTimeString(),
+    rawTimestamp: vital.timestamp,
+    heart_rate: vital.heart_rate,
+    spo2: vital.spo2
+  };
+}
+
+function formatAlert(alert, index) {
+  return {
+    id: `${alert.timestamp}-${index}`,
+    timestamp: new Date(alert.timestamp).toLocaleString(),
+    type: alert.alert_type,
+    source: alert.source,
+    value: alert.value,
+    threshold: alert.threshold,
+    keyword: alert.keyword,
+    confidence: alert.confidence,
+    anomaly_score: alert.anomaly_score
+  };
+}
+
 // Patient data configuration
 const patients = [
   {
@@ -217,129 +254,146 @@ function PatientDashboard({ patientId, onBack }) {
   useEffect(() => {
     if (!patient) return;
 
-    // For Patient 1, fetch real data from Firebase
+    // For Patient 1, load recent vitals and alerts from the rpi_2 cache and
+    // apply live deltas from its event stream; audio and the latest image
+    // still come from Firebase
     if (patient.id === 1) {
-      const deviceRef = ref(database, `devices/${patient.Device_ID}`);
-      
-      onValue(deviceRef, (snapshot) => {
-        const data = snapshot.val();
-        if (data) {
-          // Process vitals data
-          const vitalsArray = [];
-          const alertsArray = [];
-          const audioArray = [];
-          let latestImageUrl = null;
-          
-          // Process vitals
-          if (data.vitals) {
-            Object.entries(data.vitals).forEach(([id, vital]) => {
-              const timestamp = new Date(vital.timestamp);
-              vitalsArray.push({
-                id,
-                timestamp: timestamp.toLocaleTimeString(),
-                rawTimestamp: vital.timestamp,
-                heart_rate: vital.heart_rate,
-                spo2: vital.spo2
-              });
-            });
-            
-            // Sort by timestamp
-            vitalsArray.sort((a, b) => a.rawTimestamp - b.rawTimestamp);
-            
-            // Update state with the last 20 readings
-            const recentVitals = vitalsArray.slice(-20);
-            setheart_rate(recentVitals.map(v => ({ 
-              timestamp: v.timestamp, 
-              value: v.heart_rate 
-            })));
-            setspo2(recentVitals.map(v => ({ 
-              timestamp: v.timestamp, 
-              value: v.spo2 
-            })));
-            
-            // Extract historical data - format for historical view
-            // Use all available data points for historical view
-            const formattedHeartRate = vitalsArray.map((v, index) => ({
-              id: index + 1,
-              date: new Date(v.rawTimestamp).toISOString().slice(0, 10) + ' ' + v.timestamp,
-              value: v.heart_rate,
-              anomaly: v.heart_rate > 100 || v.heart_rate < 60
-            }));
-            
-            const formattedSpO2 = vitalsArray.map((v, index) => ({
-              id: index + 1,
-              date: new Date(v.rawTimestamp).toISOString().slice(0, 10) + ' ' + v.timestamp,
-              value: v.spo2,
-              anomaly: v.spo2 < 94
-            }));
-            
-            setHistoricalHeartRate(formattedHeartRate);
-            setHistoricalSpO2(formattedSpO2);
-            
-            // Set latest timestamp
-            if (recentVitals.length > 0) {
-              const latestVital = recentVitals[recentVitals.length - 1];
-              settimestamp(new Date(latestVital.rawTimestamp));
-            }
-          }
-          
-          // Process alerts
-          if (data.alerts) {
-            Object.entries(data.alerts).forEach(([id, alert]) => {
-              alertsArray.push({
-                id,
-                timestamp: new Date(alert.timestamp).toLocaleString(),
-                type: alert.alert_type,
-                source: alert.source,
-                value: alert.value,
-                threshold: alert.threshold,
-                keyword: alert.keyword,
-                confidence: alert.confidence,
-                anomaly_score: alert.anomaly_score
-              });
-            });
-            
-            // Sort alerts by timestamp (newest first)
-            alertsArray.sort((a, b) => new Date(b.timestamp) - new Date(a.timestamp));
-            setAlertsData(alertsArray);
-          }
-          
-          // Process audio data
-          if (data.audio) {
-            Object.entries(data.audio).forEach(([id, audio]) => {
-              audioArray.push({
-                id,
-                timestamp: new Date(audio.timestamp).toLocaleString(),
-                filepath: audio.filepath,
-                processed: audio.processed,
-                keyword_detected: audio.keyword_detected,
-                keyword: audio.keyword,
-                confidence: audio.confidence
-              });
-            });
-            
-            // Sort audio by timestamp (newest first)
-            audioArray.sort((a, b) => new Date(b.timestamp) - new Date(a.timestamp));
-            setAudioData(audioArray);
+      const deviceUrl = `${DATA_API}/devices/${encodeURIComponent(patient.Device_ID)}`;
+      const audioRef = ref(database, `devices/${patient.Device_ID}/audio`);
+      const imagesRef = ref(database, `latest/${patient.Device_ID}/image`);
+      let vitals = [];
+      let alerts = [];
+      let pending = [];  // Stream events received before the snapshot
+      let loaded = false;
+      let cancelled = false;
+
+      const showVitals = () => {
+        // Update state with the last 20 readings
+        const recentVitals = vitals.slice(-20).map(formatVital);
+        setheart_rate(recentVitals.map(v => ({
+          timestamp: v.timestamp,
+          value: v.heart_rate
+        })));
+        setspo2(recentVitals.map(v => ({
+          timestamp: v.timestamp,
+          value: v.spo2
+        })));
+
+        // Use all cached data points for historical view
+        const vitalsArray = vitals.map(formatVital);
+        setHistoricalHeartRate(vitalsArray.map((v, index) => ({
+          id: index + 1,
+          date: new Date(v.rawTimestamp).toISOString().slice(0, 10) + ' ' + v.timestamp,
+          value: v.heart_rate,
+          anomaly: v.heart_rate > 100 || v.heart_rate < 60
+        })));
+        setHistoricalSpO2(vitalsArray.map((v, index) => ({
+          id: index + 1,
+          date: new Date(v.rawTimestamp).toISOString().slice(0, 10) + ' ' + v.timestamp,
+          value: v.spo2,
+          anomaly: v.spo2 < 94
+        })));
+
+        // Set latest timestamp
+        if (vitals.length > 0) {
+          settimestamp(new Date(vitals[vitals.length - 1].timestamp));
+        }
+      };
+
+      // Alerts newest first
+      const showAlerts = () => {
+        setAlertsData(alerts.map(formatAlert).reverse());
+      };
+
+      const applyEvent = (type, item) => {
+        if (type === 'vitals') {
+          vitals.push(item);
+          if (vitals.length > MAX_CACHED_VITALS) vitals.shift();
+          showVitals();
+        } else {
+          alerts.push(item);
+          if (alerts.length > MAX_CACHED_ALERTS) alerts.shift();
+          showAlerts();
+        }
+      };
+
+      // Open the stream first so nothing is missed while the snapshot loads
+      const source = new EventSource(`${deviceUrl}/stream`);
+      ['vitals', 'alert'].forEach(type => {
+        source.addEventListener(type, (event) => {
+          const item = JSON.parse(event.data);
+          if (loaded) {
+            applyEvent(type, item);
+          } else {
+            pending.push([type, item]);
           }
-          
-          // Get latest image if any
-          if (data.images) {
-            const images = Object.values(data.images);
-            if (images.length > 0) {
-              // Sort by timestamp and get the latest
-              const latestImage = images.sort((a, b) => b.timestamp - a.timestamp)[0];
-              // Use a placeholder for the image
-              latestImageUrl = `/api/placeholder/320/240`;
-              setpath(latestImageUrl);
-            }
+        });
+      });
+
+      Promise.all([
+        fetch(`${deviceUrl}/vitals?limit=${MAX_CACHED_VITALS}`).then(r => r.ok ? r.json() : { vitals: [] }),
+        fetch(`${deviceUrl}/alerts?limit=${MAX_CACHED_ALERTS}`).then(r => r.ok ? r.json() : { alerts: [] })
+      ]).then(([vitalsBody, alertsBody]) => {
+        if (cancelled) return;
+        vitals = vitalsBody.vitals;
+        alerts = alertsBody.alerts;
+        // Both are in receive order, so a stream event is new if it was
+        // received after the snapshot's last item, or in the same
+        // millisecond but is not among the snapshot's items from then
+        const last = { vitals: -Infinity, alert: -Infinity };
+        const seen = { vitals: new Set(), alert: new Set() };
+        [['vitals', vitals], ['alert', alerts]].forEach(([type, items]) => {
+          if (!items.length) return;
+          last[type] = items[items.length - 1].timestamp;
+          items.filter(item => item.timestamp === last[type])
+            .forEach(item => seen[type].add(itemKey(item)));
+        });
+        loaded = true;
+        showVitals();
+        showAlerts();
+        // Apply stream events the snapshot did not already include
+        pending.forEach(([type, item]) => {
+          if (item.timestamp > last[type] ||
+              (item.timestamp === last[type] && !seen[type].has(itemKey(item)))) {
+            applyEvent(type, item);
           }
+        });
+        pending = [];
+      }).catch(error => console.error('Failed to load device data:', error));
+
+      // Process audio data
+      onValue(audioRef, (snapshot) => {
+        const audio = snapshot.val();
+        if (!audio) return;
+        const audioArray = Object.entries(audio).map(([id, item]) => ({
+          id,
+          timestamp: new Date(item.timestamp).toLocaleString(),
+          filepath: item.filepath,
+          processed: item.processed,
+          keyword_detected: item.keyword_detected,
+          keyword: item.keyword,
+          confidence: item.confidence
+        }));
+
+        // Sort audio by timestamp (newest first)
+        audioArray.sort((a, b) => new Date(b.timestamp) - new Date(a.timestamp));
+        setAudioData(audioArray);
+      });
+
+      // Get latest image if any
+      onValue(imagesRef, (snapshot) => {
+        if (snapshot.val()) {
+          // Use a placeholder for the image
+          setpath(`/api/placeholder/320/240`);
         }
       });
-      
+
       return () => {
         // Cleanup
-        off(deviceRef);
+        cancelled = true;
+        source.close();
+        off(audioRef);
+        off(imagesRef);
       };
     } else {
       // For other patients, use mock data
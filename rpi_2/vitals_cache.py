@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# In-memory, per-device cache of vitals and alerts, fed from MQTT.
+#
+# Each device keeps its latest reading plus bounded ring buffers of recent
+# vitals and alerts, so the dashboard can be served from rpi_2 without
+# reading the device's whole subtree from Firebase. Buffers are sorted by
+# arrival, and readings and alerts are stamped with their receive time (ms)
+# for filtering: the firmware's timestamp is its millis() uptime, which
+# restarts at boot, so it is only kept as "device_ms".
+import time
+import threading
+from collections import deque
+
+
+class DeviceCache:
+    __slots__ = ('vitals', 'alerts', 'latest', 'alert_count', 'last_update')
+
+    def __init__(self, history, alert_history):
+        self.vitals = deque(maxlen=history)
+        self.alerts = deque(maxlen=alert_history)
+        self.latest = {}
+        self.alert_count = 0
+        self.last_update = 0.0
+
+
+def _since(items, since, limit):
+    if since is not None:
+        items = [item for item in items if item["timestamp"] > since]
+    else:
+        items = list(items)
+    if limit is not None:
+        items = items[-limit:] if limit > 0 else []
+    return items
+
+
+class VitalsCache:
+    def __init__(self, history=3600, alert_history=200, idle_seconds=3600):
+        self.history = history
+        self.alert_history = alert_history
+        self.idle_seconds = idle_seconds
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def _device(self, device_id):
+        device = self.devices.get(device_id)
+        if device is None:
+            device = self.devices[device_id] = DeviceCache(self.history, self.alert_history)
+        return device
+
+    # Record a vitals payload; returns the cached reading, or None if it held
+    # no valid values
+    def add_vitals(self, device_id, payload):
+        reading = {"timestamp": int(time.time() * 1000)}
+        for key in ("heart_rate", "spo2"):
+            value = payload.get(key)
+            if isinstance(value, (int, float)) and value > 0:
+                reading[key] = float(value)
+        if len(reading) == 1:
+            return None
+        if isinstance(payload.get("timestamp"), (int, float)):
+            reading["device_ms"] = payload["timestamp"]
+        with self.lock:
+            device = self._device(device_id)
+            device.vitals.append(reading)
+            device.latest.update(reading)
+            device.last_update = time.time()
+        return reading
+
+    def add_alert(self, device_id, payload):
+        alert = dict(payload)
+        if "timestamp" in alert:
+            alert["device_ms"] = alert["timestamp"]
+        alert["timestamp"] = int(time.time() * 1000)
+        with self.lock:
+            device = self._device(device_id)
+            device.alerts.append(alert)
+            device.alert_count += 1
+            device.last_update = time.time()
+        return alert
+
+    def devices_summary(self):
+        with self.lock:
+            return [
+                {
+                    "device_id": device_id,
+                    "latest": dict(device.latest),
+                    "alert_count": device.alert_count,
+                    "last_update": device.last_update
+                }
+                for device_id, device in self.devices.items()
+            ]
+
+    # Latest values and the most recent alerts for one device
+    def latest(self, device_id, alerts=5):
+        with self.lock:
+            device = self.devices.get(device_id)
+            if device is None:
+                return None
+            return {
+                "device_id": device_id,
+                "latest": dict(device.latest),
+                "recent_alerts": list(device.alerts)[-alerts:] if alerts > 0 else [],
+                "alert_count": device.alert_count,
+                "last_update": device.last_update
+            }
+
+    # Readings newer than `since` (ms), oldest first
+    def vitals(self, device_id, since=None, limit=None):
+        with self.lock:
+            device = self.devices.get(device_id)
+            if device is None:
+                return None
+            return _since(device.vitals, since, limit)
+
+    def alerts(self, device_id, since=None, limit=None):
+        with self.lock:
+            device = self.devices.get(device_id)
+            if device is None:
+                return None
+            return _since(device.alerts, since, limit)
+
+    # Drop devices that have been silent for idle_seconds; returns their IDs
+    def expire(self):
+        cutoff = time.time() - self.idle_seconds
+        with self.lock:
+            expired = [d for d, device in self.devices.items() if device.last_update < cutoff]
+            for device_id in expired:
+                del self.devices[device_id]
+        return expired